@@ -10,6 +10,11 @@ it through _with_ expression
 with SEM_API(state='remote') as sem:
     do_something(sem)
 
+Without the microscope the control can be replaced by a simulator:
+
+with SEM_API(state='remote', backend=SimulatedEMApi()) as sem:
+    do_something(sem)
+
 Alternatively, the class can be initiated and closed manually.
 
 sem = SEM_API(state='remote')
@@ -35,15 +40,29 @@ The interface provides following functions:
     MoveStage(coord)
     Grab(self, fname, X=0, Y=0, W=1024, H=768, overlay = False)
     GetCurrentUserName()
+    get_many(names)
+        Several AP (float) and DP (string) values with one multi parameter call,
+        one Get per parameter if the control does not support it.
+    set_many(values, force=False)
+        Several AP/DP values from a dict, values equal to the last known value
+        (last_known, cleared by notifications) are skipped.
 
 2.  Interface to get real time image. The real time image will be updated in
     following properties:
     img_array   
         If running remotely, it provides uint8 array of current image using the current 
         pixel store. If running locally, it provides uint16 array instead.
+        Remotely the image is grabbed into a bmp through grab_backend (grab_backend.py),
+        grab_dir can point it to a RAM disk. grab_backend.timings has the time of
+        every stage (grab, file ready, read, decode).
     img_array_reduced   
         Only present if running locally. It provides uint8 array of current image in 
         1024x768 pixel store.
+    frames
+        FrameRing (frame_ring.py) with the last frame_count frames. img_array is a
+        read-only view into it and stays valid until frame_count-1 newer frames are
+        grabbed. Readers should use frames.latest(), frames.wait_next(timeout) or
+        frames.iter_frames() instead of polling img_array.
                         
     The following commands control the start, pause and terminate of continuous
     image acquisition:
@@ -55,7 +74,13 @@ The interface provides following functions:
             possible values from 0.01 to 10
     
 3.  Often used high level function:
-    wait_for_stage_idle()
+    wait_for_state(DP_name, value, timeout=None)
+        Wait till a digital state has the value (a string, a tuple of strings or
+        a function of the state). The state is polled with growing intervals up
+        to 0.1 s, Set_Notify events wake the wait earlier.
+    wait_for_frozen(timeout=None)
+        Wait till the scan is frozen.
+    wait_for_stage_idle(timeout=None)
         Wait till the stage arrives in destination.
     grab_full_image(fname)
         Freeze and wait till scan finished to capture a full image.
@@ -84,10 +109,17 @@ The interface provides following functions:
 
 
 
-Version: 0.3.4
+Version: 0.3.5
 Author: Luyang Han
 
 ChangLog:
+v 0.3.5
+Real time frames go into a preallocated ring buffer. The CZ.MMF mapping is kept until DP_IMAGE_STORE changes.
+Remote frames are decoded from a reused buffer by a grab backend with per stage timings.
+Waits for states are woken by notifications, the polling backs off from 10 ms to 100 ms.
+Add get_many/set_many.
+The control can be replaced by a backend object (sem_simulator.SimulatedEMApi), pywin32 is only imported for the microscope.
+The generated bindings of the control are shared with SEM_API_CUSTOM and only generated once (com_bindings.py).
 v 0.3.4
 Change the early binding method. Now it is faster.
 v 0.3.3
@@ -99,14 +131,20 @@ Change to the grab function.
 v 0.3
 04.09.2019 : Add event interface
 """
-__version__ = "0.3.4"
+__version__ = "0.3.5"
 
 import sys
 sys.coinit_flags = 0
 
-from win32com import client
-import pythoncom
-import threading, time, tempfile, mmap, warnings
+try:
+    from win32com import client
+    import pythoncom
+except ImportError:
+    # only a simulated backend can be used (sem_simulator.py)
+    client = pythoncom = None
+from com_bindings import load_bindings
+from sem_params import same_value, get_buffers, call_multi
+import threading, time, mmap, warnings
 
 try:
     from imageio import imread
@@ -122,14 +160,12 @@ except:
 
 try:
     import numpy as np
+    from frame_ring import FrameRing
+    from grab_backend import BmpGrabBackend
 except:
     np = None
     print("Cannot find the numpy. Realtime image array will be disabled.")
 
-# following changes are necessary for event to work
-from win32com.client import gencache
-gencache.EnsureModule("{71BD42C1-EBD3-11D0-AB3A-444553540000}", 0, 1, 0)
-
 #from win32com.client import makepy
 #sys.argv = ["makepy", r"CZ.EmApiCtrl.1"]
 #makepy.main()
@@ -228,10 +264,11 @@ class SwitchThread(threading.Thread):
     def terminate(self):
         self.stop = True
 
-EventBase = client.getevents("CZ.EMApiCtrl.1")
-
-
-class SEM_Handle(EventBase):
+class SEM_Handle():
+    """
+    Event handler, SEM_API combines it with the event class of the control
+    (client.getevents, or getevents of a simulated backend).
+    """
     def __init__(self, sem):
         self.subscribers = []
         super().__init__(sem)
@@ -252,13 +289,30 @@ class SEM_API:
     
     """
     
-    def __init__(self, state='local'):
+    def __init__(self, state='local', frame_count=8, grab_dir=None, backend=None):
         """
         Function to initialize the API interface.
         This function uses the long InitialiseRemote(void) command.
+        frame_count is the number of real time frames kept in self.frames.
+        grab_dir is the directory of the remote live image bmp, ideally a RAM disk.
+        backend is an object with the interface of the control instead of
+        CZ.EMApiCtrl.1, ie: sem_simulator.SimulatedEMApi(). The local state
+        maps the named Windows memory of the EM server and needs Windows.
         
         """
-        self.mic = client.Dispatch('CZ.EMApiCtrl.1')
+        if backend is None:
+            if client is None:
+                raise ImportError("pywin32 is needed for the microscope, pass a backend to use a simulator")
+            # following changes are necessary for event to work,
+            # the bindings are generated once and then loaded from gen_py
+            load_bindings()
+            self.mic = client.Dispatch('CZ.EMApiCtrl.1')
+            EventBase = client.getevents("CZ.EMApiCtrl.1")
+        else:
+            self.mic = backend
+            EventBase = backend.getevents()
+        # a simulated backend delivers its events itself, there are no messages to pump
+        self.__com = backend is None
         if not (state == "remote" or state == "local"):
             raise ValueError("state is either remote or local")
         self.__state = state
@@ -269,8 +323,13 @@ class SEM_API:
             # prepare the background working
             # prepare the MMF for local operation
             if imread is not None:
+                self.frames = FrameRing(frame_count)
+                if self.__state == "remote":
+                    self.grab_backend = BmpGrabBackend(grab_dir, fallback=imread)
                 if self.__state == "local":
                     self.__pymap = mmap.mmap(-1, 1024*768+1064,"Capture0.MMF",mmap.ACCESS_READ)
+                    # view of the live 8 bit image, it does not need to be recreated every frame
+                    self.img_array_reduce = np.flip(np.frombuffer(self.__pymap, dtype="uint8", offset=1064).reshape((768,1024)), axis=0)
                 time.sleep(0.1)
                 self.__background_worker = SwitchThread(target=self.__update_image, delay = 1.0)
                 self.__background_worker.start()
@@ -279,10 +338,21 @@ class SEM_API:
             # self.subs = []
             # self.event = SEM_Handle(self.mic, self.subs)
             self.event_time = 0.1
-            self.event = SEM_Handle(self.mic)
+            self.event = type("SEM_Handle", (SEM_Handle, EventBase), {})(self.mic)
             self.__event_stop = False
             self.__event_thread = threading.Thread(target = self.__pump)
             self.__event_thread.start()
+            # notification counter per parameter, wait_for_state sleeps until it changes
+            self.__notify_condition = threading.Condition()
+            self.__notify_count = {}
+            self.__notify_watched = {}
+            self.last_known = {} # last value read or set through get_many/set_many
+            self.multi_supported = None # None until the first GetMulti/SetMulti call
+            self.Add_Event(self.__count_notify)
+            if imread is not None and self.__state == "local":
+                # the image store is only read again when the server reports a change
+                self.Add_Event(self.__image_store_changed)
+                self.__watch_image_store = self.__watch("DP_IMAGE_STORE")
         else:
             raise API_ERROR(res)
     
@@ -307,11 +377,14 @@ class SEM_API:
     
 
     def __pump(self):
-        pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
+        if self.__com:
+            pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
         while self.__event_stop is not True:
-            pythoncom.PumpWaitingMessages()
+            if self.__com:
+                pythoncom.PumpWaitingMessages()
             time.sleep(self.event_time)
-        pythoncom.CoUninitialize()
+        if self.__com:
+            pythoncom.CoUninitialize()
 
     def Add_Event(self, func):
         self.event.subscribers.append(func)
@@ -329,26 +402,59 @@ class SEM_API:
         res = self.mic.SetNotify(PARAM, False)
         return res
 
+    def __count_notify(self, ParameterName, Reason, ParameterID, LastKnownValue):
+        self.last_known.pop(ParameterName, None)
+        with self.__notify_condition:
+            self.__notify_count[ParameterName] = self.__notify_count.get(ParameterName, 0) + 1
+            self.__notify_condition.notify_all()
+
+    def __watch(self, PARAM):
+        """Set_Notify once per parameter, False if the parameter can not be notified."""
+        if PARAM not in self.__notify_watched:
+            try:
+                self.Set_Notify(PARAM)
+                self.__notify_watched[PARAM] = True
+            except API_ERROR:
+                self.__notify_watched[PARAM] = False
+        return self.__notify_watched[PARAM]
+
     # some variables to hold the data
-    __fname = tempfile.TemporaryFile(suffix='.bmp').name
-    
+    __image_store = None
+    __watch_image_store = False
+    __frame_map = None
+    __frame_map_store = None
+    __frame_view = None
+
+    def __image_store_changed(self, ParameterName, Reason, ParameterID, LastKnownValue):
+        if ParameterName == "DP_IMAGE_STORE":
+            self.__image_store = None
+
+    def __map_frame(self, pixel_density):
+        # the frame size only changes with the image store, so the mapping is kept until then
+        if self.__frame_map is not None:
+            self.__frame_view = None
+            self.__frame_map.close()
+        self.__frame_map = mmap.mmap(-1, pixel_density[0]*pixel_density[1]*2,"CZ.MMF",mmap.ACCESS_READ)
+        self.__frame_map_store = pixel_density
+        self.__frame_view = np.frombuffer(self.__frame_map, dtype="uint16").reshape((pixel_density[1],pixel_density[0]))
+
     # function to update the image file
     def __update_image(self):
         if self.__state == 'remote':
             # when working remote, write the image to a bmp file and read back.
-            self.mic.Grab(0,0,1024,768,0,self.__fname)
-            self.img_array = imread(self.__fname)
+            image = self.grab_backend.grab(self.mic)
+            if image is not None:
+                self.img_array = self.frames.publish(image).array
         elif self.__state == 'local':
             # when working local, write the image to mmap file and read back.
-            # as each time the size of the frame can change, we create a mmap
-            # every time on the fly to grab the image
-            pixel_density = tuple(map(int,self.GetState("DP_IMAGE_STORE").split("*")))
+            pixel_density = self.__image_store
+            if pixel_density is None or not self.__watch_image_store:
+                pixel_density = tuple(map(int,self.GetState("DP_IMAGE_STORE").split("*")))
+                self.__image_store = pixel_density
             self.mic.Grab(0,0,1024,768,0,"CZ.MMF")
-            py_map = mmap.mmap(-1, pixel_density[0]*pixel_density[1]*2,"CZ.MMF",mmap.ACCESS_READ)
-            self.img_array = np.copy(np.frombuffer(py_map, dtype="uint16").reshape((pixel_density[1],pixel_density[0])))
-            py_map.close()
-            # update local image
-            self.img_array_reduce = np.flip(np.frombuffer(self.__pymap, dtype="uint8", offset=1064).reshape((768,1024)), axis=0)
+            if pixel_density != self.__frame_map_store:
+                self.__map_frame(pixel_density)
+            self.img_array = self.frames.publish(self.__frame_view).array
         return
     
     @property
@@ -406,6 +512,7 @@ class SEM_API:
             pass
         else:
             value = float(value)
+        self.last_known.pop(AP_name, None)
         res = self.mic.Set(AP_name, value)
         return res
     
@@ -439,14 +546,60 @@ class SEM_API:
             pass
         else:
             value = int(value)
+        self.last_known.pop(DP_name, None)
         res = self.mic.Set(DP_name, value)
         return res
     
     # function for CMD
     @__error_handling
     def Execute(self, CMD_name):
+        if CMD_name.startswith("CMD_SCANRATE"):
+            self.last_known.pop("DP_SCANRATE", None)
         res = self.mic.Execute(CMD_name)
         return res
+
+    # batched parameters, see sem_params.py
+
+    def get_many(self, names):
+        """
+        function to get several AP (as float) and DP (as string) values in one call.
+        returns a dict name -> value.
+        """
+        names = list(names)
+        res = call_multi(self, self.mic, "GetMulti", names, get_buffers(names))
+        if res is not None:
+            values = list(res[1])
+        else:
+            values = [self.GetValue(name) if name.startswith("AP_") else self.GetState(name) for name in names]
+        values = dict(zip(names, values))
+        self.last_known.update(values)
+        return values
+
+    def set_many(self, values, force=False):
+        """
+        function to set several AP/DP values from a dict, in the order of the dict.
+        Values equal to the last known value are skipped unless force is set.
+        DP_SCANRATE is set with the CMD_SCANRATE<n> command.
+        returns the names that were set.
+        """
+        todo = {name: value for name, value in values.items()
+                if force or name not in self.last_known or not same_value(name, self.last_known[name], value)}
+        # the scan rate is a command, it can not go into SetMulti
+        multi = {name: value for name, value in todo.items() if name != "DP_SCANRATE"}
+        if len(multi) > 1 and call_multi(self, self.mic, "SetMulti", list(multi), list(multi.values())) is not None:
+            self.last_known.update(multi)
+            multi = {}
+        for name, value in todo.items():
+            if name == "DP_SCANRATE":
+                self.set_scan_speed(value)
+            elif name not in multi:
+                continue
+            elif name.startswith("AP_"):
+                self.SetValue(name, value)
+            else:
+                self.SetState(name, value)
+            self.last_known[name] = value
+        return list(todo)
     
     # function about stage
     @__error_handling
@@ -521,12 +674,53 @@ class SEM_API:
         pos = self.GetStagePosition()
         self.MoveStage((pos[0] + dx, pos[1]+dy, pos[2],pos[3],pos[4],pos[5]))
     
-    def wait_for_stage_idle(self):
+    # poll intervals while waiting for a state, a notification ends the wait earlier.
+    # The server may accept SetNotify and never fire, so the cap stays the old 0.1 s poll
+    wait_poll_min = 0.01
+    wait_poll_max = 0.1
+
+    def wait_for_state(self, DP_name, value, timeout=None):
+        """
+        wait until the digital state DP_name matches value and return the state.
+        value is a string, a tuple of strings or a function of the state.
+        raises TimeoutError if timeout (in s) is given and passed.
+        """
+        if callable(value):
+            match = value
+        elif isinstance(value, str):
+            match = lambda state: state == value
+        else:
+            match = lambda state: state in value
+        self.__watch(DP_name)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = self.wait_poll_min
+        while True:
+            with self.__notify_condition:
+                count = self.__notify_count.get(DP_name, 0)
+            state = self.GetState(DP_name)
+            if match(state):
+                return state
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError("%s is still %s after %.1f s" % (DP_name, state, timeout))
+            with self.__notify_condition:
+                wait = delay
+                delay = min(delay * 2, self.wait_poll_max)
+                if remaining is not None:
+                    wait = min(wait, remaining)
+                self.__notify_condition.wait_for(lambda: self.__notify_count.get(DP_name, 0) != count, wait)
+
+    def wait_for_frozen(self, timeout=None):
+        """
+        wait until the scan is frozen.
+        """
+        return self.wait_for_state("DP_FROZEN", lambda state: state != "Live", timeout)
+
+    def wait_for_stage_idle(self, timeout=None):
         """
         wait for the stage movement to finish.
         """
-        while not self.GetState("DP_STAGE_IS") == "Idle":
-            time.sleep(0.1)
+        return self.wait_for_state("DP_STAGE_IS", "Idle", timeout)
             
     def set_scan_speed(self, DP_Param):
         c_dict = {
@@ -569,9 +763,12 @@ class SEM_API:
         self.SetState("DP_AUTOFOCUS_VERSION", "Line Scan based Autofocus Version")
         time.sleep(0.5)
         self.Execute("CMD_AUTO_FOCUS_FINE")
-        time.sleep(2)
-        while self.GetState("DP_AUTO_FN_STATUS") == "Busy":
-            time.sleep(0.1)
+        # the autofocus needs a moment to start, at most 2 s like before
+        try:
+            self.wait_for_state("DP_AUTO_FN_STATUS", "Busy", timeout=2)
+        except TimeoutError:
+            pass
+        self.wait_for_state("DP_AUTO_FN_STATUS", lambda state: state != "Busy")
     
     
     def grab_full_image(self, fname, overlay = False):
@@ -588,8 +785,7 @@ class SEM_API:
                         "Pixel Avg.", "Continuous Avg.", "Drift Comp. Frame Avg."):
             time.sleep(0.1)
             self.Execute("CMD_FREEZE_ALL")
-        while self.GetState("DP_FROZEN") == "Live":
-            time.sleep(0.1)
+        self.wait_for_frozen()
         self.Grab(fname, overlay = overlay)
     
     def close(self):
@@ -604,6 +800,7 @@ class SEM_API:
     def __exit__(self, *arg):
         self.__background_worker.terminate()
         self.__background_worker.join()
+        self.frames.close()
         # stop event interface
         self.__event_stop = True
         self.__event_thread.join()
@@ -611,6 +808,10 @@ class SEM_API:
         del self.event
         # clear the MMF
         if self.__state == 'local':
+            self.__frame_view = None
+            if self.__frame_map is not None:
+                self.__frame_map.close()
+            self.img_array_reduce = None
             self.__pymap.close()
             self.mic.Grab(0,0,0,0,0,"CZ.MMF")
         self.mic.ClosingControl()
@@ -1,5 +1,11 @@
-import sys
-from win32com.client import makepy, Dispatch
+try:
+    from win32com.client import Dispatch, WithEvents
+    import pythoncom
+except ImportError:
+    # only a simulated backend can be used (sem_simulator.py)
+    Dispatch = pythoncom = None
+from com_bindings import load_bindings
+from sem_params import same_value, get_buffers, call_multi, scanrate_index
 import time
 import warnings
 
@@ -67,16 +73,97 @@ class API_ERROR(Exception):
         self.error_text = ('\n').join(_excpetion_dict[error_code])
         warnings.warn(self.error_text)
 
+class ParameterCache():
+    """
+    Last value set or read for every AP/DP parameter. Sets of the same value
+    are skipped for watched parameters, those with a working notification.
+    A notification of a change at the console marks the entry stale, stale
+    entries are read again before they are trusted. The notifications of our
+    own sets are ignored: AP ones carry the new value, which is compared with
+    the entry, DP ones are expected once for every set that changed the value.
+    DP_SCANRATE is kept as the index of CMD_SCANRATE<n>.
+    """
+    # skip sets of parameters without notification, changes at the console are not seen then
+    skip_unwatched = False
+
+    def __init__(self):
+        self.values = {}
+        self.stale = set()
+        self.watched = set()
+        self.expected = {} # DP parameter -> notifications still to come for our own sets
+        self.skipped = 0
+        self.sent = 0
+        self.refreshed = 0
+        self.invalidated = 0
+        self.own = 0 # notifications of our own sets
+
+    def put(self, name, value, changed=False):
+        """changed: value was set by us and differs from the known one, a notification follows"""
+        if name == "DP_SCANRATE":
+            value = scanrate_index(value)
+            if value is None:
+                # a label of the control, it can not be compared with the commands
+                self.forget(name)
+                return
+        self.values[name] = value
+        self.stale.discard(name)
+        if changed and not name.startswith("AP_"):
+            self.expected[name] = self.expected.get(name, 0) + 1
+    def forget(self, name):
+        self.values.pop(name, None)
+        self.stale.discard(name)
+        self.expected.pop(name, None)
+    def invalidate(self, name, last=None):
+        """A notification of name, last is the current value for AP parameters."""
+        if name.startswith("AP_"):
+            own = name in self.values and last is not None and same_value(name, self.values[name], last)
+        else:
+            own = self.expected.get(name, 0) > 0
+            if own:
+                self.expected[name] -= 1
+        if own:
+            self.own += 1
+        elif name in self.values:
+            self.stale.add(name)
+            self.invalidated += 1
+    def trusted(self, name):
+        return name in self.watched or self.skip_unwatched
+    def print_stats(self):
+        print("Parameter cache: %d sets skipped, %d sent, %d values read again, %d invalidated by notifications, %d own notifications" % (
+            self.skipped, self.sent, self.refreshed, self.invalidated, self.own))
+
+class ParameterEvents():
+    # event sink of the control, the cache attribute is set after WithEvents
+    cache = None
+    def OnNotifyWithCurrentValue(self, lpszParameter, Reason, paramid, dLastKnownValue):
+        if self.cache is not None:
+            self.cache.invalidate(lpszParameter, dLastKnownValue)
+
 class SEM_API_CUSTOM():
     ocx = None
     initial_parameters = None # mag, rot, detector, scanrate, wd
     dataset_path = None
     busy = False
+    # parameters of initial_parameters, DP_SCANRATE is set with CMD_SCANRATE<n>
+    initial_parameter_names = ("AP_MAG", "AP_SCANROTATION", "DP_DETECTOR_CHANNEL", "DP_SCANRATE", "AP_WD")
 
-    def __init__(self):
-        sys.argv = ["makepy", r"CZ.EmApiCtrl.1"]
-        makepy.main()
-        self.ocx = Dispatch("CZ.EMApiCtrl.1")
+    def __init__(self, backend=None):
+        """
+        backend: object with the interface of the control instead of CZ.EMApiCtrl.1,
+        ie: sem_simulator.SimulatedEMApi()
+        """
+        if backend is None:
+            if Dispatch is None:
+                raise ImportError("pywin32 is needed for the microscope, pass a backend to use a simulator")
+            # generated once per version of the control, then loaded from gen_py
+            load_bindings()
+            self.ocx = Dispatch("CZ.EMApiCtrl.1")
+        else:
+            self.ocx = backend
+        self.backend = backend
+        self.cache = ParameterCache() # last value read or set through get_many/set_many
+        self.events = None
+        self.multi_supported = None # None until the first GetMulti/SetMulti call
 
     def __error_handling(func):
             def func_wrapper(*arg, **kwargs):
@@ -97,6 +184,36 @@ class SEM_API_CUSTOM():
     @__error_handling
     def openConnection(self):
         res = self.ocx.InitialiseRemoting()
+        if res == 0:
+            self.enable_notifications()
+    @__error_handling
+    def Set_Notify(self, PARAM):
+        return self.ocx.SetNotify(PARAM, True)
+    @__error_handling
+    def Unset_Notify(self, PARAM):
+        return self.ocx.SetNotify(PARAM, False)
+    def enable_notifications(self, names=initial_parameter_names):
+        """
+        Watch the parameters so the cache notices changes made at the console.
+        The notifications are delivered when this thread pumps its messages,
+        set_many does that before it compares with the cache.
+        """
+        if self.events is None:
+            try:
+                if self.backend is None:
+                    self.events = WithEvents(self.ocx, ParameterEvents)
+                else:
+                    self.events = self.backend.WithEvents(ParameterEvents)
+            except Exception as e:
+                warnings.warn("No notifications from the control (%s), parameters are always set" % e)
+                return
+            self.events.cache = self.cache
+        for name in names:
+            try:
+                self.Set_Notify(name)
+                self.cache.watched.add(name)
+            except API_ERROR:
+                pass
     @__error_handling
     def getVersion(self):
         return self.ocx.GetVersion()
@@ -104,17 +221,82 @@ class SEM_API_CUSTOM():
     def closeConnection(self):
         return self.ocx.ClosingControl()
     def getInitialParameters(self):
-        self.initial_parameters = (self.getAPMag(), self.getAPRot(), self.getDPDetector(), self.getDPScanrate(), self.getAPWD())
+        values = self.get_many(self.initial_parameter_names)
+        self.initial_parameters = tuple(values[name] for name in self.initial_parameter_names)
         print("Initial parameters saved")
         return self.initial_parameters
     def restoreInitialParameters(self):
-        self.setAPMag(self.initial_parameters[0])
-        self.setAPRot(self.initial_parameters[1])
-        self.setDPDetector(self.initial_parameters[2])
-        self.setDPScanrate(self.initial_parameters[3])
-        self.setAPWD(self.initial_parameters[4])
+        mag, rot, detector, scanrate, wd = self.initial_parameters
+        self.set_many({"AP_MAG": str(mag), "AP_SCANROTATION": str(rot), "DP_DETECTOR_CHANNEL": str(detector), "DP_SCANRATE": str(scanrate), "AP_WD": float(wd)})
         self.ocx.Execute("CMD_UNFREEZE_ALL")
         print("All parameters set to initial values")
+
+    # batched parameters, see sem_params.py
+    def __get(self, name):
+        res = self.ocx.Get(name, get_buffers([name])[0])
+        if res[0] != 0:
+            raise API_ERROR(res[0])
+        return res[1]
+    def __set(self, name, value):
+        if name == "DP_SCANRATE":
+            res = self.ocx.Execute('CMD_SCANRATE%s' % str(value))
+        else:
+            res = self.ocx.Set(name, value)
+        if res != 0:
+            # like the single setters a failed set does not stop a sweep, API_ERROR only warns
+            API_ERROR(res)
+        return res == 0
+    def get_many(self, names):
+        """
+        Read several AP (as float) and DP (as string) values in one call.
+        :return: dict name -> value
+        """
+        names = list(names)
+        res = None
+        if len(names) > 1:
+            res = call_multi(self, self.ocx, "GetMulti", names, get_buffers(names))
+        values = list(res[1]) if res is not None else [self.__get(name) for name in names]
+        values = dict(zip(names, values))
+        for name, value in values.items():
+            self.cache.put(name, value)
+        return values
+    def set_many(self, values, force=False):
+        """
+        Set several AP/DP values in one call, in the order of the dict.
+        Values equal to the cached value are skipped unless force is set.
+        :return: names that were set successfully
+        """
+        cache = self.cache
+        if self.events is not None and self.backend is None:
+            # deliver pending notifications before the cache is trusted,
+            # a simulated backend delivers them on its own thread
+            pythoncom.PumpWaitingMessages()
+        if not force:
+            stale = [name for name in values if name in cache.stale and cache.trusted(name)]
+            if stale:
+                cache.refreshed += len(stale)
+                self.get_many(stale)
+        todo = {name: value for name, value in values.items()
+                if force or not cache.trusted(name) or name not in cache.values or not same_value(name, cache.values[name], value)}
+        cache.skipped += len(values) - len(todo)
+        cache.sent += len(todo)
+        # the control only notifies changes, a notification is expected for values known to differ
+        changed = {name for name in todo if name in cache.values and not same_value(name, cache.values[name], todo[name])}
+        # the scan rate is a command, it can not go into SetMulti
+        multi = {name: value for name, value in todo.items() if name != "DP_SCANRATE"}
+        if len(multi) > 1 and call_multi(self, self.ocx, "SetMulti", list(multi), list(multi.values())) is not None:
+            for name, value in multi.items():
+                cache.put(name, value, name in changed)
+            multi = {}
+        done = []
+        for name, value in todo.items():
+            if name in multi or name == "DP_SCANRATE":
+                if not self.__set(name, value):
+                    cache.forget(name)
+                    continue
+                cache.put(name, value, name in changed)
+            done.append(name)
+        return done
     @__error_handling
     def Grab(self, fname, X = 0, Y = 0, W = 1024, H = 768, overlay = False):
         """
@@ -155,42 +337,28 @@ class SEM_API_CUSTOM():
         print('Image saved')
         return res
     def grabImageWithParameters(self, dest, mag, rot, detector, scanrate, wd):
-        self.setAPMag(mag)
-        self.setAPRot(rot)
-        self.setDPDetector(detector)
-        self.setDPScanrate(scanrate)
-        self.setAPWD(wd)
+        self.set_many({"AP_MAG": str(mag), "AP_SCANROTATION": str(rot), "DP_DETECTOR_CHANNEL": str(detector), "DP_SCANRATE": str(scanrate), "AP_WD": float(wd)})
         self.grabFullImage(dest)
-    @__error_handling
     def getAPMag(self):
-        return self.ocx.Get("AP_MAG", 0)
-    @__error_handling
+        return self.get_many(["AP_MAG"])["AP_MAG"]
     def setAPMag(self, mag):
-        self.ocx.Set("AP_MAG", str(mag))
-    @__error_handling
+        self.set_many({"AP_MAG": str(mag)})
     def getAPWD(self):
-        return self.ocx.Get("AP_WD", 0)
-    @__error_handling
+        return self.get_many(["AP_WD"])["AP_WD"]
     def setAPWD(self, wd):
-        self.ocx.Set("AP_WD", float(wd))
-    @__error_handling
+        self.set_many({"AP_WD": float(wd)})
     def getAPRot(self):
-        return self.ocx.Get("AP_SCANROTATION", 0)
-    @__error_handling
+        return self.get_many(["AP_SCANROTATION"])["AP_SCANROTATION"]
     def setAPRot(self, rot):
-        self.ocx.Set("AP_SCANROTATION", str(rot))
-    @__error_handling
+        self.set_many({"AP_SCANROTATION": str(rot)})
     def getDPDetector(self):
-        return self.ocx.Get("DP_DETECTOR_CHANNEL", '')
-    @__error_handling
+        return self.get_many(["DP_DETECTOR_CHANNEL"])["DP_DETECTOR_CHANNEL"]
     def setDPDetector(self, detector):
-        self.ocx.Set("DP_DETECTOR_CHANNEL", str(detector))
-    @__error_handling
+        self.set_many({"DP_DETECTOR_CHANNEL": str(detector)})
     def getDPScanrate(self):
-        return self.ocx.Get("DP_SCANRATE", '')
-    @__error_handling
+        return self.get_many(["DP_SCANRATE"])["DP_SCANRATE"]
     def setDPScanrate(self, scanrate):
-        self.ocx.Execute('CMD_SCANRATE%s' % str(scanrate))
+        self.set_many({"DP_SCANRATE": str(scanrate)})
     @__error_handling
     def getAPFrameTimeInSeconds(self):
         res = self.ocx.Get('AP_FRAME_TIME', 0)
@@ -224,9 +392,12 @@ class SEM_API_CUSTOM():
             pass
         else:
             value = int(value)
+        self.cache.forget(DP_name)
         res = self.ocx.Set(DP_name, value)
         return res
     @__error_handling
     def Execute(self, CMD_name):
+        if CMD_name.startswith("CMD_SCANRATE"):
+            self.cache.forget("DP_SCANRATE")
         res = self.ocx.Execute(CMD_name)
         return res
\ No newline at end of file
@@ -0,0 +1,92 @@
+"""
+Order of the shots of an augmentor sweep.
+
+Every shot is a tuple (mag, rot, detector, scanrate, wd). Changing a
+parameter between two shots costs the time in the cost model, the order
+of the sweep decides how often the expensive ones (detector, mag, WD)
+change. optimize_order tries the product order, a nested order with the
+most expensive parameter outermost (every other block reversed, so the
+inner parameters do not jump back) and a greedy nearest neighbour order,
+and keeps the cheapest.
+"""
+import numpy as np
+
+FIELDS = ('mag', 'rot', 'detector', 'scanrate', 'wd')
+# seconds per change of a parameter, grab is the time of a shot itself
+DEFAULT_COSTS = {'mag': 1.0, 'rot': 0.2, 'detector': 2.0, 'scanrate': 0.2, 'wd': 1.0, 'grab': 0.0}
+
+
+def normalize(value):
+    # 5000, '5000' and 5000.0 are the same setting
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+def encode(params, start=None):
+    """Integer code of every field, -1 for start values that are not in the sweep."""
+    codes = np.empty((len(params), len(FIELDS)), dtype=np.int64)
+    start_codes = np.full(len(FIELDS), -1, dtype=np.int64)
+    for f in range(len(FIELDS)):
+        values = {}
+        for i, shot in enumerate(params):
+            codes[i, f] = values.setdefault(normalize(shot[f]), len(values))
+        if start is not None:
+            start_codes[f] = values.get(normalize(start[f]), -1)
+    return codes, start_codes
+
+def transition_cost(a, b, costs=DEFAULT_COSTS):
+    return sum(costs[field] for field, x, y in zip(FIELDS, a, b) if normalize(x) != normalize(y))
+
+def order_cost(params, order, costs=DEFAULT_COSTS, start=None):
+    """Estimated time of the sweep in s, the first transition starts at start (current SEM parameters)."""
+    total = costs.get('grab', 0.0) * len(order)
+    previous = start
+    for i in order:
+        if previous is not None:
+            total += transition_cost(previous, params[i], costs)
+        previous = params[i]
+    return total
+
+def greedy_order(params, costs=DEFAULT_COSTS, start=None):
+    """Always go to the cheapest shot left, the earlier shot on ties."""
+    codes, current = encode(params, start)
+    weights = np.array([costs[field] for field in FIELDS])
+    left = np.ones(len(params), dtype=bool)
+    order = []
+    if start is None and len(params):
+        current = codes[0]
+    for _ in range(len(params)):
+        cost = (codes != current) @ weights
+        cost[~left] = np.inf
+        i = int(np.argmin(cost))
+        order.append(i)
+        left[i] = False
+        current = codes[i]
+    return order
+
+def nested_order(params, costs=DEFAULT_COSTS):
+    """Nested loops, most expensive parameter outermost, every other block reversed."""
+    levels = sorted(range(len(FIELDS)), key=lambda f: -costs[FIELDS[f]])
+    def snake(indices, levels):
+        if not levels or len(indices) < 2:
+            return indices
+        groups = {}
+        for i in indices:
+            groups.setdefault(normalize(params[i][levels[0]]), []).append(i)
+        order = []
+        for n, group in enumerate(groups.values()):
+            group = snake(group, levels[1:])
+            order += group[::-1] if n % 2 else group
+        return order
+    return snake(list(range(len(params))), levels)
+
+def optimize_order(params, costs=DEFAULT_COSTS, start=None):
+    """
+    :return: (order, cost) cheapest order of the shots as indices into params
+    """
+    nested = nested_order(params, costs)
+    candidates = [list(range(len(params))), nested, nested[::-1], greedy_order(params, costs, start)]
+    scored = [(order_cost(params, order, costs, start), n, order) for n, order in enumerate(candidates)]
+    cost, _, order = min(scored)
+    return order, cost
@@ -0,0 +1,156 @@
+"""
+Post-processing of grabbed images next to the acquisition.
+
+The augmentor hands every file to the pipeline right after the grab and
+goes on with the parameters and the scan of the next shot. A bounded pool
+of workers waits until the file is complete, reads its header and writes a
+thumbnail. At most max_pending files are in flight, submit() blocks when the
+workers fall behind (e.g. a slow network share) instead of queueing without
+limit.
+
+The EM server writes the tif before Grab returns, so the pipeline overlaps
+the checks of shot N with the parameter changes and the scan of shot N+1.
+python acquisition_pipeline.py runs an augmentor sweep against the simulated
+SEM (sem_simulator.py) with and without workers and compares the throughput.
+"""
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tiff_catalog import read_entry
+
+
+class AcquisitionPipeline():
+    def __init__(self, workers=2, max_pending=4, thumbnail_dir=None, thumbnail_size=(256, 192), ready_timeout=10.0):
+        """
+        workers: threads for the checks, 0 runs them in the grab loop
+        thumbnail_dir: directory of the png thumbnails, None for no thumbnails
+        """
+        self.workers = workers
+        self.thumbnail_dir = thumbnail_dir
+        self.thumbnail_size = thumbnail_size
+        self.ready_timeout = ready_timeout
+        self.results = []
+        self.blocked = 0.0 # time submit() waited for a free slot
+        self.__slots = threading.BoundedSemaphore(max_pending)
+        self.__lock = threading.Lock()
+        self.__futures = []
+        self.__pool = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.__start = time.perf_counter()
+
+    def submit(self, path, params):
+        if self.__pool is None:
+            self.__record(self.process(path, params))
+            return
+        start = time.perf_counter()
+        self.__slots.acquire()
+        self.blocked += time.perf_counter() - start
+        future = self.__pool.submit(self.process, path, params)
+        future.add_done_callback(self.__done)
+        self.__futures.append(future)
+    def __done(self, future):
+        self.__slots.release()
+        self.__record(future.result())
+    def __record(self, result):
+        with self.__lock:
+            self.results.append(result)
+
+    def wait_ready(self, path):
+        """Wait until the file exists and its size stopped changing."""
+        deadline = time.perf_counter() + self.ready_timeout
+        last = -1
+        while True:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = -1
+            if size > 0 and size == last:
+                return size
+            if time.perf_counter() > deadline:
+                raise TimeoutError("%s is not complete after %.1f s" % (path, self.ready_timeout))
+            last = size
+            time.sleep(0.05)
+
+    def process(self, path, params):
+        """Checks of one grabbed file, returns a dict with 'error' set if one failed."""
+        start = time.perf_counter()
+        result = {'path': path, 'params': params, 'size': None, 'mag': None, 'error': None}
+        try:
+            result['size'] = self.wait_ready(path)
+            entry = read_entry(path)
+            if entry['error'] is not None:
+                raise ValueError(entry['error'])
+            result['mag'] = entry['mag']
+            if entry['mag'] is not None and abs(entry['mag'] - float(params[0])) > 0.01 * float(params[0]):
+                raise ValueError("header mag %s, expected %s" % (entry['mag'], params[0]))
+            if self.thumbnail_dir is not None:
+                self.thumbnail(path)
+        except Exception as e:
+            result['error'] = "%s: %s" % (type(e).__name__, e)
+            print('Check failed: %s %s' % (path, result['error']))
+        result['time'] = time.perf_counter() - start
+        return result
+    def thumbnail(self, path):
+        from PIL import Image
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+        with Image.open(path) as image:
+            image = image.convert('L')
+            image.thumbnail(self.thumbnail_size)
+            image.save(os.path.join(self.thumbnail_dir, os.path.splitext(os.path.basename(path))[0] + '.png'))
+
+    def join(self):
+        """Wait for all submitted files, returns the results in order of completion."""
+        for future in self.__futures:
+            future.result()
+        self.__futures = []
+        return self.results
+    def close(self):
+        self.join()
+        if self.__pool is not None:
+            self.__pool.shutdown()
+
+    def print_stats(self):
+        elapsed = time.perf_counter() - self.__start
+        errors = sum(result['error'] is not None for result in self.results)
+        check = sum(result['time'] for result in self.results)
+        print("Pipeline: %d files (%d failed checks), %.1f files/min, checks %.2f s/file, submit blocked %.1f s" % (
+            len(self.results), errors, 60 * len(self.results) / elapsed if elapsed else 0.0,
+            check / len(self.results) if self.results else 0.0, self.blocked))
+
+
+def benchmark(time_scale, worker_counts, max_pending):
+    from augmentor import augmentor
+    from SEM_API_CUSTOM import SEM_API_CUSTOM
+    from sem_simulator import SimulatedEMApi
+    directory = tempfile.mkdtemp()
+    try:
+        for workers in worker_counts:
+            dataset_path = os.path.join(directory, 'workers%d' % workers)
+            os.mkdir(dataset_path)
+            sem = SEM_API_CUSTOM(backend=SimulatedEMApi(time_scale))
+            sem.openConnection()
+            sem.getInitialParameters()
+            aug = augmentor(sem, workers, max_pending)
+            aug.setParameters(dataset_path, 0.005, [5000, 1000, 10000], ['0', '45'], ['InLens', 'SE2'], ['1', '3'])
+            start = time.perf_counter()
+            aug.grabMasks()
+            aug.grabImages()
+            elapsed = time.perf_counter() - start
+            print("workers %d: %d files in %.2f s" % (workers, len(aug.pipeline.results), elapsed), end=", ")
+            aug.pipeline.print_stats()
+            aug.pipeline.close()
+            sem.closeConnection()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Throughput of an augmentor sweep against a fake SEM with and without the pipeline")
+    parser.add_argument('-time_scale', default=0.01, type=float, help='factor of the simulated SEM times')
+    parser.add_argument('-workers', default=[0, 2], type=int, nargs='+', help='worker counts to compare')
+    parser.add_argument('-max_pending', default=4, type=int, help='files in flight before the grab loop waits')
+    args = parser.parse_args()
+    benchmark(args.time_scale, args.workers, args.max_pending)
@@ -0,0 +1,280 @@
+"""
+Runner of the whole process: grab the masks, grab the images, retract the
+tips by one pattern step and start over until the pattern is done.
+
+The phases run in a worker thread, the runner is a state machine that goes
+to the next phase when a phase thread finishes, so the next phase starts
+right away and the GUI thread never waits. Everything the GUI shows is put
+into the events queue, notify() is called after every event (guiv2 passes
+window.write_event_value, which wakes the event loop). Events:
+
+    ('phase', phase, iteration)         a phase started
+    ('progress', phase, done, total)    after every shot
+    ('retract', result)                 FanOutResult of a retract step
+    ('done', phase, seconds)            a phase finished
+    ('finished', state, message)        the runner stopped (DONE, CANCELED or FAILED)
+
+cancel() stops the grab loop of the augmentor before its next shot.
+python acquisition_runner.py runs the state machine against the simulated
+SEM and fake NanoControls and compares it with the sleep polling of the old
+Run handler.
+"""
+import time
+import queue
+import argparse
+import threading
+
+IDLE = 'idle'
+MASKS = 'masks'
+IMAGES = 'images'
+RETRACT = 'retract'
+DONE = 'done'
+CANCELED = 'canceled'
+FAILED = 'failed'
+
+
+class AcquisitionRunner():
+    def __init__(self, aug, con=None, notify=None):
+        """
+        aug: augmentor with its parameters set
+        con: nanocontrol.controller with a pattern assigned, None grabs one iteration only
+        notify: called without arguments after every event, from the worker thread
+        """
+        self.aug = aug
+        self.con = con
+        self.notify = notify
+        self.state = IDLE
+        self.events = queue.Queue()
+        self.timing = {MASKS: [], IMAGES: [], RETRACT: []}
+        self.canceled = False
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    @property
+    def active(self):
+        return self.state in (MASKS, IMAGES, RETRACT)
+
+    def start(self):
+        with self.__lock:
+            if self.active:
+                raise RuntimeError("runner is already running (%s)" % self.state)
+            self.canceled = False
+            self.aug.progress = self.__progress
+            self.__enter(MASKS)
+    def cancel(self):
+        with self.__lock:
+            self.canceled = True
+            self.aug.running = False
+
+    def poll(self):
+        """Events since the last call, never blocks."""
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                return events
+    def join(self, timeout=None):
+        """Wait until the runner stopped, returns the final state."""
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while self.active:
+            # the thread of a phase starts the thread of the next one before it ends
+            self.__thread.join(None if deadline is None else max(0.0, deadline - time.perf_counter()))
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+        return self.state
+
+    def __post(self, *event):
+        self.events.put(event)
+        if self.notify is not None:
+            self.notify()
+    def __progress(self, phase, done, total):
+        # a cancel that came while the grab loop started is seen after this shot
+        if self.canceled:
+            self.aug.running = False
+        self.__post('progress', phase, done, total)
+
+    def __enter(self, state):
+        # called with the lock held
+        self.state = state
+        if not self.active:
+            self.aug.progress = None
+            message = {DONE: 'Iteration done, please relocate tips.', CANCELED: 'Run canceled'}.get(state, '')
+            self.__post('finished', state, message)
+            return
+        self.__post('phase', state, self.aug.iteration)
+        self.__thread = threading.Thread(target=self.__run, args=(state,), daemon=True)
+        self.__thread.start()
+
+    def __run(self, phase):
+        start = time.perf_counter()
+        try:
+            result = self.__phase(phase)
+        except Exception as e:
+            with self.__lock:
+                self.state = FAILED
+                # a grab loop that raised did not reset it
+                self.aug.running = False
+                self.aug.progress = None
+                self.__post('finished', FAILED, '%s failed: %s: %s' % (phase, type(e).__name__, e))
+            return
+        seconds = time.perf_counter() - start
+        with self.__lock:
+            self.timing[phase].append(seconds)
+            self.__post('done', phase, seconds)
+            self.__enter(self.__next(phase, result))
+
+    def __phase(self, phase):
+        if phase == MASKS:
+            self.aug.grabMasks()
+        elif phase == IMAGES:
+            if self.aug.grabImages():
+                self.aug.iteration += 1
+        elif phase == RETRACT:
+            result = self.con.retractStep()
+            if result is not None:
+                self.__post('retract', result)
+            return result
+    def __next(self, phase, result):
+        if self.canceled:
+            return CANCELED
+        if phase == MASKS:
+            return IMAGES
+        if phase == IMAGES:
+            return RETRACT if self.con is not None else DONE
+        # retractStep returns None when the pattern is done
+        return MASKS if result is not None else DONE
+
+    def print_stats(self):
+        for phase, times in self.timing.items():
+            if times:
+                print("%s: %d x, %.2f s total, %.2f s mean" % (phase, len(times), sum(times), sum(times) / len(times)))
+
+
+def polled_run(aug, con, interval):
+    """The Run handler before the runner: start a phase in a thread and check aug.running every interval s."""
+    while True:
+        threading.Thread(target=aug.grabMasks, daemon=True).start()
+        time.sleep(0.001) # grabMasks sets running in its thread
+        while aug.running:
+            time.sleep(interval)
+        threading.Thread(target=aug.grabImages, daemon=True).start()
+        time.sleep(0.001)
+        while aug.running:
+            time.sleep(interval)
+        aug.iteration += 1
+        if con.retractStep() is None:
+            return
+
+def setup(directory, time_scale, tips):
+    from augmentor import augmentor
+    from nanocontrol import controller, nanocontrol, FakeNanoControl
+    from SEM_API_CUSTOM import SEM_API_CUSTOM
+    from sem_simulator import SimulatedEMApi
+    sem = SEM_API_CUSTOM(backend=SimulatedEMApi(time_scale))
+    sem.openConnection()
+    sem.getInitialParameters()
+    aug = augmentor(sem, thumbnails=False)
+    aug.setParameters(directory, 0.005, [5000, 1000], ['0'], ['InLens', 'SE2'], ['1'])
+    fakes = [FakeNanoControl(id=str(n)) for n in range(tips)]
+    con = controller(ncs={fake.id: nanocontrol(fake.port) for fake in fakes})
+    con.assignPattern()
+    def close():
+        aug.pipeline.close()
+        con.closeAll()
+        for fake in fakes:
+            fake.close()
+        sem.closeConnection()
+    return aug, con, close
+
+def check(time_scale):
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        aug, con, close = setup(directory, time_scale, 2)
+        try:
+            notified = threading.Semaphore(0)
+            runner = AcquisitionRunner(aug, con, notify=notified.release)
+            runner.start()
+            assert runner.join(60) == DONE, runner.state
+            events = runner.poll()
+            phases = [event[1] for event in events if event[0] == 'phase']
+            steps = len(con.patterns[0])
+            assert phases == [MASKS, IMAGES, RETRACT] * (steps + 1), phases
+            assert events[-1][:2] == ('finished', DONE) and aug.iteration == steps + 1
+            progress = [event[2:] for event in events if event[:2] == ('progress', MASKS)]
+            assert progress[:len(aug.mask_order)] == [(n + 1, len(aug.mask_order)) for n in range(len(aug.mask_order))]
+            assert sum(1 for _ in iter(lambda: notified.acquire(blocking=False), False)) == len(events)
+            # cancel in the middle of the images stops after the current shot
+            con.assignPattern()
+            runner.start()
+            while not any(event[:2] == ('progress', IMAGES) for event in runner.poll()):
+                time.sleep(0.001)
+            runner.cancel()
+            assert runner.join(10) == CANCELED, runner.state
+            shots = [event for event in runner.poll() if event[:2] == ('progress', IMAGES)]
+            assert len(shots) <= 1 and not aug.running, shots
+            assert aug.iteration == steps + 1, aug.iteration
+            # grabRoutine stops after the masks when they were canceled
+            def cancel(phase, done, total):
+                aug.running = False
+            aug.progress = cancel
+            images = len(os.listdir(os.path.join(directory, 'images')))
+            assert aug.grabRoutine() is False and aug.iteration == steps + 1
+            assert len(os.listdir(os.path.join(directory, 'images'))) == images
+            aug.progress = None
+            # a phase that raises ends the run, the augmentor is not left busy
+            def fail(*args):
+                raise RuntimeError("grab failed")
+            grab = aug.sem.grabImageWithParameters
+            aug.sem.grabImageWithParameters = fail
+            try:
+                con.assignPattern()
+                runner.start()
+                assert runner.join(10) == FAILED, runner.state
+            finally:
+                aug.sem.grabImageWithParameters = grab
+            assert not aug.running and aug.progress is None
+            assert runner.poll()[-1] == ('finished', FAILED, 'masks failed: RuntimeError: grab failed')
+        finally:
+            close()
+    print("check: runner phases, progress events, notify, cancel and a failing phase")
+
+def benchmark(time_scale, tips, interval):
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        aug, con, close = setup(directory, time_scale, tips)
+        try:
+            start = time.perf_counter()
+            polled_run(aug, con, interval)
+            polled = time.perf_counter() - start
+            con.assignPattern()
+            runner = AcquisitionRunner(aug, con)
+            start = time.perf_counter()
+            runner.start()
+            runner.join()
+            elapsed = time.perf_counter() - start
+            busy = sum(sum(times) for times in runner.timing.values())
+            print("%d iterations: sleep polling every %.1f s %.2f s, runner %.2f s (phases %.2f s, between phases %.3f s)" % (
+                len(runner.timing[IMAGES]), interval, polled, elapsed, busy, elapsed - busy))
+            runner.print_stats()
+            # time from cancel() to the stopped runner
+            con.assignPattern()
+            runner.start()
+            while not any(event[:2] == ('progress', IMAGES) for event in runner.poll()):
+                time.sleep(0.001)
+            start = time.perf_counter()
+            runner.cancel()
+            runner.join()
+            print("cancel during the images: stopped after %.3f s" % (time.perf_counter() - start))
+        finally:
+            close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the runner against a simulated SEM and fake NanoControls")
+    parser.add_argument('-time_scale', default=0.01, type=float, help='factor of the simulated SEM times')
+    parser.add_argument('-tips', default=4, type=int, help='fake controllers')
+    parser.add_argument('-interval', default=0.5, type=float, help='polling interval of the old Run handler (it used 3 s)')
+    args = parser.parse_args()
+    check(args.time_scale)
+    benchmark(args.time_scale, args.tips, args.interval)
@@ -1,17 +1,34 @@
 #%%
-import SEM_API_CUSTOM
 import time
 import os
 import itertools
+from acquisition_order import DEFAULT_COSTS, order_cost, optimize_order
+from acquisition_pipeline import AcquisitionPipeline
 
 class augmentor():
-    def __init__(self, sem) -> None:
+    def __init__(self, sem, workers=2, max_pending=4, thumbnails=True) -> None:
+        """
+        workers: threads that check the grabbed files while the next shot is taken, 0 checks in the grab loop
+        max_pending: grabbed files not checked yet before the grab loop waits
+        thumbnails: write a png thumbnail of every image to dataset_path/thumbnails
+        """
         self.sem = sem
         self.sem.SetState("DP_SCAN_ROT", 'On')
         self.running = False
         self.iteration = 0
+        self.workers = workers
+        self.max_pending = max_pending
+        self.thumbnails = thumbnails
+        self.pipeline = None
+        # called after every shot with (phase, shots done, shots of the phase)
+        self.progress = None
     
-    def setParameters(self, dataset_path, wd_deviation, mags, rotations, detectors, scanrates):
+    def setParameters(self, dataset_path, wd_deviation, mags, rotations, detectors, scanrates, costs=None, optimize=True):
+        """
+        costs: seconds per parameter change (see acquisition_order.DEFAULT_COSTS)
+        optimize: grab in the order with the least switching time, the file
+        names still use the index of the shot in the product order
+        """
         self.dataset_path = dataset_path
         self.wd_deviation = wd_deviation
         self.mags = mags
@@ -21,38 +38,83 @@ class augmentor():
         self.wds = [self.sem.initial_parameters[-1], self.sem.initial_parameters[-1]*(1+(float(wd_deviation)))]
         self.mask_params = list(itertools.product(self.mags, self.rotations))
         self.image_params = list(itertools.product(self.mags, self.rotations, self.detectors, self.scanrates, self.wds))
+
+        # masks are grabbed with InLens at scan rate 10 and the initial WD, then the images follow
+        self.costs = dict(DEFAULT_COSTS, **(costs or {}))
+        mask_shots = [(mag, rot, 'InLens', '10', self.sem.initial_parameters[4]) for mag, rot in self.mask_params]
+        self.mask_order = list(range(len(mask_shots)))
+        self.image_order = list(range(len(self.image_params)))
+        mask_cost = order_cost(mask_shots, self.mask_order, self.costs, self.sem.initial_parameters)
+        image_start = mask_shots[-1] if mask_shots else self.sem.initial_parameters
+        image_cost = order_cost(self.image_params, self.image_order, self.costs, image_start)
+        print('Estimated time in product order: masks %.1f s, images %.1f s' % (mask_cost, image_cost))
+        if optimize:
+            self.mask_order, mask_cost = optimize_order(mask_shots, self.costs, self.sem.initial_parameters)
+            image_start = mask_shots[self.mask_order[-1]] if mask_shots else self.sem.initial_parameters
+            self.image_order, image_cost = optimize_order(self.image_params, self.costs, image_start)
+            print('Estimated time in optimized order: masks %.1f s, images %.1f s' % (mask_cost, image_cost))
+        if self.pipeline is not None:
+            self.pipeline.close()
+        thumbnail_dir = os.path.join(self.dataset_path, 'thumbnails') if self.thumbnails else None
+        self.pipeline = AcquisitionPipeline(self.workers, self.max_pending, thumbnail_dir)
         return len(self.mask_params), len(self.image_params)
     def grabMasks(self):
+        """Grab the masks, returns False if it was canceled (running set to False)."""
         self.running = True
+        completed = True
         if not os.path.exists(os.path.join(self.dataset_path, 'masks')):
             os.mkdir(os.path.join(self.dataset_path, 'masks'))
-        for i, (mag, rot) in enumerate(self.mask_params):
+        for n, i in enumerate(self.mask_order):
+            mag, rot = self.mask_params[i]
             if not self.running:
-                exit()
+                completed = False
+                break
             # print(mag, rot)
             #image_path = os.path.join(self.dataset_path, 'masks', 'mag%s_rot%s.tif' % (mag,rot))
             image_path = os.path.join(self.dataset_path, 'masks', '%s_mag%s_rot%s.tif' % (self.iteration, mag, rot))
             print(image_path)
             print(image_path, mag, rot, 'InLens', '10', self.sem.initial_parameters[4])
             self.sem.grabImageWithParameters(image_path, mag, rot, 'InLens', '10', self.sem.initial_parameters[4])
+            # checked while the next shot is taken
+            self.pipeline.submit(image_path, (mag, rot, 'InLens', '10', self.sem.initial_parameters[4]))
+            if self.progress is not None:
+                self.progress('masks', n + 1, len(self.mask_order))
+        self.pipeline.join()
         self.running = False
+        return completed
     def grabImages(self):
+        """Grab the images, returns False if it was canceled (running set to False)."""
         self.running = True
+        completed = True
         if not os.path.exists(os.path.join(self.dataset_path, 'images')):
             os.mkdir(os.path.join(self.dataset_path, 'images'))
-        for i, (mag, rot, detector, scanrate, wd) in enumerate(self.image_params):
+        for n, i in enumerate(self.image_order):
+            mag, rot, detector, scanrate, wd = self.image_params[i]
             if not self.running:
-                exit()
+                completed = False
+                break
             # print(i)
             # print(mag, rot, detector, scanrate, wd)
             #image_path = os.path.join(self.dataset_path, 'images', 'mag%s_rot%s_d%s_sr%s_wd%s.tif' % (mag, rot, detector, scanrate, wd))
             image_path = os.path.join(self.dataset_path, 'images', '%s_mag%s_rot%s_%s.tif' % (self.iteration, mag, rot, i))
             self.sem.grabImageWithParameters(image_path, mag, rot, detector, scanrate, wd)
+            self.pipeline.submit(image_path, (mag, rot, detector, scanrate, wd))
+            if self.progress is not None:
+                self.progress('images', n + 1, len(self.image_order))
+        self.pipeline.join()
         self.running = False
+        return completed
     def grabRoutine(self):
-        self.grabMasks()
-        self.grabImages()
-        self.iteration += 1
+        """Masks and images of one iteration, returns False if it was canceled."""
+        completed = self.grabMasks() and self.grabImages()
+        if completed:
+            self.iteration += 1
+        # only SEM_API_CUSTOM has a parameter cache
+        cache = getattr(self.sem, 'cache', None)
+        if cache is not None:
+            cache.print_stats()
+        self.pipeline.print_stats()
+        return completed
         
     def wait(self, seconds):
         print('Waiting for %s seconds' % seconds)
@@ -0,0 +1,71 @@
+"""
+Generated Python bindings (makepy) of the SmartSEM API control.
+
+SEM_API and SEM_API_CUSTOM need the generated module of the CZ.EMApiCtrl
+type library for early binding and events. load_bindings() generates it the
+first time through gencache, which keeps it in gen_py keyed by the GUID and
+the version of the type library, so it is only generated again when the
+control is updated. In a process the module is looked up once, later calls
+return it directly.
+
+load_time has the seconds every load_bindings call took for the first time
+in this process:
+
+    python com_bindings.py      # generate the bindings and print the time
+"""
+import time
+import threading
+
+PROGID = "CZ.EMApiCtrl.1"
+# type library of CZ.EMApiCtrl.1 (GUID, lcid, major, minor), used if the registry can not be read
+TYPELIB = {PROGID: ("{71BD42C1-EBD3-11D0-AB3A-444553540000}", 0, 1, 0)}
+
+load_time = {}
+_modules = {}
+_lock = threading.Lock()
+
+
+def registered_typelib(progid):
+    """(GUID, lcid, major, minor) of the newest registered type library of progid, None if unknown."""
+    try:
+        import winreg
+        import pythoncom
+        import pywintypes
+    except ImportError:
+        return None
+    try:
+        clsid = str(pythoncom.MakeIID(progid, True))
+        with winreg.OpenKey(winreg.HKEY_CLASSES_ROOT, r"CLSID\%s\TypeLib" % clsid) as key:
+            guid = winreg.QueryValue(key, None)
+        with winreg.OpenKey(winreg.HKEY_CLASSES_ROOT, r"TypeLib\%s" % guid) as key:
+            versions = [winreg.EnumKey(key, n) for n in range(winreg.QueryInfoKey(key)[0])]
+        major, minor = max(tuple(int(part, 16) for part in version.split('.')) for version in versions)
+        return (guid, 0, major, minor)
+    except (pywintypes.com_error, OSError):
+        # not registered
+        return None
+
+def load_bindings(progid=PROGID):
+    """
+    Generated module of the type library of progid, generated only if gen_py
+    has no module for the registered version.
+    """
+    with _lock:
+        if progid in _modules:
+            return _modules[progid]
+        start = time.perf_counter()
+        from win32com.client import gencache
+        guid, lcid, major, minor = registered_typelib(progid) or TYPELIB[progid]
+        module = gencache.EnsureModule(guid, lcid, major, minor)
+        load_time[progid] = time.perf_counter() - start
+        _modules[progid] = module
+        return module
+
+
+if __name__ == '__main__':
+    module = load_bindings()
+    print("Bindings of %s: %s (typelib %s) in %.3f s" % (
+        PROGID, getattr(module, '__file__', module), registered_typelib(PROGID) or TYPELIB[PROGID], load_time[PROGID]))
+    start = time.perf_counter()
+    load_bindings()
+    print("Second call in %.6f s" % (time.perf_counter() - start))
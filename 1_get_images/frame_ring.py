@@ -0,0 +1,214 @@
+"""
+Ring buffer for the real time image of the SEM.
+
+The background worker of SEM_API publishes every frame into one of N
+preallocated slots, readers get read-only views together with the sequence
+number and the time stamp of the frame:
+
+    frame = sem.frames.latest()
+    frame = sem.frames.wait_next(timeout=2)
+    for frame in sem.frames.iter_frames():
+        show(frame.array)
+
+A view stays valid until N-1 newer frames are published. Readers that keep
+a frame longer copy it, or check valid(frame) after reading it.
+
+FakeFrameProducer writes frames into a named shared memory block like the EM
+server does with Grab(..., "CZ.MMF"), so the ring can be used without the
+microscope. python frame_ring.py runs a check and a benchmark with it.
+"""
+import time
+import threading
+import argparse
+from collections import namedtuple
+from multiprocessing import shared_memory
+import numpy as np
+
+Frame = namedtuple('Frame', ['seq', 'timestamp', 'array'])
+
+
+class FrameRing():
+    def __init__(self, size=8):
+        if size < 2:
+            raise ValueError("the ring needs at least 2 frames")
+        self.size = size
+        self.seq = 0  # sequence number of the latest frame, 0 before the first one
+        self.closed = False
+        self.__buffer = None
+        self.__views = []
+        self.__frames = [None] * size
+        self.__condition = threading.Condition()
+
+    def __allocate(self, shape, dtype):
+        # frames handed out before keep the old buffer alive, so their views stay intact
+        self.__buffer = np.empty((self.size,) + shape, dtype=dtype)
+        self.__views = [self.__buffer[i] for i in range(self.size)]
+        for view in self.__views:
+            view.flags.writeable = False
+
+    def publish(self, source, timestamp=None):
+        """
+        Copy a frame into the next slot. The slots are only reallocated if
+        the shape or dtype of the frames change (new image store).
+        """
+        source = np.asarray(source)
+        if self.__buffer is None or self.__buffer.shape[1:] != source.shape or self.__buffer.dtype != source.dtype:
+            self.__allocate(source.shape, source.dtype)
+        seq = self.seq + 1
+        slot = seq % self.size
+        np.copyto(self.__buffer[slot], source)
+        frame = Frame(seq, time.time() if timestamp is None else timestamp, self.__views[slot])
+        with self.__condition:
+            self.__frames[slot] = frame
+            self.seq = seq
+            self.__condition.notify_all()
+        return frame
+
+    def latest(self):
+        """Newest frame, None before the first one."""
+        with self.__condition:
+            return self.__frames[self.seq % self.size] if self.seq else None
+    def wait_next(self, timeout=None, after=None):
+        """
+        Wait for a frame newer than sequence number after (default: the
+        latest frame) and return the newest one. None on timeout or close().
+        """
+        with self.__condition:
+            after = self.seq if after is None else after
+            if not self.__condition.wait_for(lambda: self.seq > after or self.closed, timeout):
+                return None
+            if self.seq <= after:
+                return None
+            return self.__frames[self.seq % self.size]
+    def iter_frames(self, timeout=None):
+        """Yield every new frame, frames are skipped if the reader is slower than the producer."""
+        seq = self.seq
+        while True:
+            frame = self.wait_next(timeout, seq)
+            if frame is None:
+                return
+            yield frame
+            seq = frame.seq
+    def valid(self, frame):
+        """False once the slot of the frame may have been overwritten."""
+        return self.seq - frame.seq < self.size - 1
+
+    def close(self):
+        """Wake up all waiting readers."""
+        with self.__condition:
+            self.closed = True
+            self.__condition.notify_all()
+
+
+class FakeFrameProducer():
+    """
+    Stand-in for the EM server, grab() writes a uint16 frame into the shared
+    memory block name. All pixels of frame k have the value k % 65536.
+    set_store() changes the image store like DP_IMAGE_STORE, the block is
+    recreated with the new size.
+    """
+    def __init__(self, name="CZ.MMF", store=(1024, 768)):
+        self.name = name
+        self.count = 0
+        self.__shm = None
+        self.set_store(store)
+
+    def set_store(self, store):
+        self.close()
+        self.store = store
+        self.__shm = shared_memory.SharedMemory(self.name, create=True, size=store[0] * store[1] * 2)
+        self.__frame = np.ndarray((store[1], store[0]), dtype="uint16", buffer=self.__shm.buf)
+    def grab(self):
+        self.count += 1
+        self.__frame.fill(self.count % 65536)
+    def close(self):
+        if self.__shm is not None:
+            del self.__frame
+            self.__shm.close()
+            self.__shm.unlink()
+            self.__shm = None
+
+
+class SharedFrameSource():
+    """
+    Reader side of the shared memory block, maps it once per image store
+    like SEM_API does with CZ.MMF.
+    """
+    def __init__(self, name="CZ.MMF"):
+        self.name = name
+        self.store = None
+        self.maps = 0
+        self.__shm = None
+        self.frame = None
+
+    def view(self, store):
+        if store != self.store:
+            self.close()
+            self.__shm = shared_memory.SharedMemory(self.name)
+            self.frame = np.ndarray((store[1], store[0]), dtype="uint16", buffer=self.__shm.buf)
+            self.store = store
+            self.maps += 1
+        return self.frame
+    def close(self):
+        if self.__shm is not None:
+            self.frame = None
+            self.__shm.close()
+            self.__shm = None
+
+def check(frames=300, stores=((1024, 768), (2048, 1536), (512, 384))):
+    producer = FakeFrameProducer()
+    source = SharedFrameSource()
+    ring = FrameRing(8)
+    seen = []
+    def read():
+        for frame in ring.iter_frames(timeout=2):
+            value = frame.array[0, 0]
+            ok = bool(np.all(frame.array == value))
+            if ring.valid(frame):
+                seen.append((frame.seq, ok))
+    reader = threading.Thread(target=read)
+    reader.start()
+    for i in range(frames):
+        if i % (frames // len(stores)) == 0:
+            producer.set_store(stores[(i * len(stores)) // frames])
+        producer.grab()
+        ring.publish(source.view(producer.store))
+        time.sleep(0.001)
+    ring.close()
+    reader.join()
+    source.close()
+    producer.close()
+    seqs = [seq for seq, ok in seen]
+    assert seqs == sorted(set(seqs)), "frames out of order"
+    assert all(ok for seq, ok in seen), "torn frame"
+    assert ring.latest().array[0, 0] == frames % 65536
+    print("check: %d frames published, %d read in order, %d mappings for %d image stores" % (frames, len(seen), source.maps, len(stores)))
+
+def benchmark(frames=200, store=(2048, 1536)):
+    producer = FakeFrameProducer(store=store)
+    # previous update: new mapping and a new array for every frame
+    start = time.perf_counter()
+    for _ in range(frames):
+        producer.grab()
+        shm = shared_memory.SharedMemory(producer.name)
+        img_array = np.copy(np.ndarray((store[1], store[0]), dtype="uint16", buffer=shm.buf))
+        shm.close()
+    t_copy = (time.perf_counter() - start) / frames
+    # ring: the mapping is kept, the frame is copied into a preallocated slot
+    source = SharedFrameSource()
+    ring = FrameRing(8)
+    start = time.perf_counter()
+    for _ in range(frames):
+        producer.grab()
+        ring.publish(source.view(producer.store))
+    t_ring = (time.perf_counter() - start) / frames
+    source.close()
+    producer.close()
+    print("%dx%d frames: new mapping + copy %.2f ms, ring %.2f ms per frame" % (store[0], store[1], t_copy * 1e3, t_ring * 1e3))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check and benchmark the frame ring with a fake shared memory producer")
+    parser.add_argument('-frames', default=300, type=int, help='number of frames')
+    args = parser.parse_args()
+    check(args.frames)
+    benchmark(args.frames)
@@ -0,0 +1,214 @@
+"""
+Grab backends for the real time image of SEM_API in remote mode.
+
+The EM server can only grab into a file. FileGrabBackend is the previous
+path (grab into a temporary bmp, read it back with imread).
+BmpGrabBackend writes the bmp into a RAM disk/tmpfs directory if one is
+given, reads it into a reused buffer and decodes the pixel rows straight
+into a preallocated array. Both measure the time of every stage:
+
+    grab    the Grab call of the server
+    ready   until the file has the size written in its header
+    read    reading the file
+    decode  bmp to array
+
+python grab_backend.py checks the decoder against PIL and compares both
+backends with a fake server.
+"""
+import os
+import time
+import struct
+import tempfile
+import argparse
+import numpy as np
+
+STAGES = ['grab', 'ready', 'read', 'decode']
+
+
+class GrabTimings():
+    def __init__(self):
+        self.count = 0
+        self.total = dict.fromkeys(STAGES, 0.0)
+        self.last = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, stage, seconds):
+        self.last[stage] = seconds
+        self.total[stage] += seconds
+    def mean(self, stage):
+        return self.total[stage] / self.count if self.count else 0.0
+    def print_stats(self):
+        print("Grab (%d frames): " % self.count + ", ".join("%s %.2f ms" % (stage, self.mean(stage) * 1e3) for stage in STAGES))
+
+
+def decode_bmp(data, out=None):
+    """
+    Decode an uncompressed 8 bit (grey or palette) or 24 bit bmp.
+    Grey images give (H, W) uint8 like PIL, everything else (H, W, 3) RGB.
+    out is used if it has the right shape, rows are copied into it directly.
+    :return: the image, None if the format is not supported
+    """
+    data = memoryview(data)
+    if len(data) < 54 or data[:2] != b'BM':
+        return None
+    offset, = struct.unpack_from('<I', data, 10)
+    header_size, width, height, planes, bits, compression = struct.unpack_from('<IiiHHI', data, 14)
+    if compression != 0 or bits not in (8, 24):
+        return None
+    colors, = struct.unpack_from('<I', data, 46)
+    bottom_up = height > 0
+    height = abs(height)
+    stride = (width * bits // 8 + 3) & ~3
+    if len(data) < offset + stride * height:
+        return None
+    rows = np.frombuffer(data, dtype=np.uint8, count=stride * height, offset=offset).reshape(height, stride)
+    if bottom_up:
+        rows = rows[::-1]
+
+    if bits == 8:
+        colors = colors or 256
+        palette = np.frombuffer(data, dtype=np.uint8, count=colors * 4, offset=14 + header_size).reshape(colors, 4)[:, 2::-1]
+        pixels = rows[:, :width]
+        if colors == 256 and np.array_equal(palette, np.repeat(np.arange(256, dtype=np.uint8)[:, None], 3, axis=1)):
+            shape = (height, width)
+        else:
+            pixels = palette[pixels]
+            shape = (height, width, 3)
+    else:
+        pixels = rows[:, :width * 3].reshape(height, width, 3)[:, :, ::-1]
+        shape = (height, width, 3)
+    if out is None or out.shape != shape or out.dtype != np.uint8:
+        out = np.empty(shape, dtype=np.uint8)
+    np.copyto(out, pixels)
+    return out
+
+
+class FileGrabBackend():
+    """Grab into a bmp file and read it back with imread."""
+    def __init__(self, imread, directory=None):
+        self.imread = imread
+        self.path = os.path.join(directory or tempfile.gettempdir(), "sem_live_%d.bmp" % os.getpid())
+        self.timings = GrabTimings()
+
+    def grab(self, mic, X=0, Y=0, W=1024, H=768):
+        start = time.perf_counter()
+        res = mic.Grab(X, Y, W, H, 0, self.path)
+        grabbed = time.perf_counter()
+        self.timings.add('grab', grabbed - start)
+        if res != 0:
+            return None
+        image = self.imread(self.path)
+        self.timings.add('decode', time.perf_counter() - grabbed)
+        self.timings.count += 1
+        return image
+
+
+class BmpGrabBackend():
+    """
+    Grab into a bmp on directory (a RAM disk or /dev/shm for speed), read it
+    into a reused buffer and decode it into a reused array. Formats the
+    decoder does not know are read with fallback (imread).
+    The returned array is overwritten by the next grab.
+    """
+    def __init__(self, directory=None, fallback=None, ready_timeout=1.0):
+        self.path = os.path.join(directory or tempfile.gettempdir(), "sem_live_%d.bmp" % os.getpid())
+        self.fallback = fallback
+        self.ready_timeout = ready_timeout
+        self.timings = GrabTimings()
+        self.__buffer = bytearray()
+        self.__image = None
+
+    def __wait_ready(self):
+        # the file is complete once it has the size from its header
+        deadline = time.perf_counter() + self.ready_timeout
+        while True:
+            try:
+                size = os.path.getsize(self.path)
+                if size >= 6:
+                    with open(self.path, 'rb') as f:
+                        expected, = struct.unpack('<2sI', f.read(6))[1:]
+                    if size >= expected:
+                        return size
+            except (OSError, struct.error):
+                pass
+            if time.perf_counter() > deadline:
+                raise TimeoutError("%s was not written within %.1f s" % (self.path, self.ready_timeout))
+            time.sleep(0.001)
+
+    def grab(self, mic, X=0, Y=0, W=1024, H=768):
+        start = time.perf_counter()
+        res = mic.Grab(X, Y, W, H, 0, self.path)
+        grabbed = time.perf_counter()
+        self.timings.add('grab', grabbed - start)
+        if res != 0:
+            return None
+        size = self.__wait_ready()
+        ready = time.perf_counter()
+        self.timings.add('ready', ready - grabbed)
+
+        if len(self.__buffer) < size:
+            self.__buffer = bytearray(size)
+        with open(self.path, 'rb', buffering=0) as f:
+            n = f.readinto(memoryview(self.__buffer)[:size])
+        read = time.perf_counter()
+        self.timings.add('read', read - ready)
+
+        image = decode_bmp(memoryview(self.__buffer)[:n], self.__image)
+        if image is None:
+            image = self.fallback(self.path)
+        else:
+            self.__image = image
+        self.timings.add('decode', time.perf_counter() - read)
+        self.timings.count += 1
+        return image
+
+
+class FakeGrabServer():
+    """Writes a prepared bmp on Grab like the EM server."""
+    def __init__(self, width=1024, height=768, mode='L'):
+        from PIL import Image
+        import io
+        pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+        image = Image.fromarray(pixels[:, :, 0] if mode == 'L' else pixels)
+        buffer = io.BytesIO()
+        image.save(buffer, format='BMP')
+        self.bmp = buffer.getvalue()
+
+    def Grab(self, X, Y, W, H, overlay, fname):
+        with open(fname, 'wb') as f:
+            f.write(self.bmp)
+        return 0
+
+def check():
+    from PIL import Image
+    import io
+    for mode, size in [('L', (1024, 768)), ('L', (1023, 767)), ('RGB', (1021, 77)), ('P', (33, 17))]:
+        pixels = np.random.default_rng(1).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        image = Image.fromarray(pixels if mode == 'RGB' else pixels[:, :, 0])
+        if mode == 'P':
+            image = image.convert('P', palette=Image.ADAPTIVE)
+        buffer = io.BytesIO()
+        image.save(buffer, format='BMP')
+        reference = np.array(Image.open(io.BytesIO(buffer.getvalue())).convert('RGB' if mode == 'P' else mode))
+        decoded = decode_bmp(buffer.getvalue())
+        assert decoded is not None and np.array_equal(decoded, reference), mode
+    print("check: decode_bmp matches PIL for grey, RGB and palette bmp")
+
+def benchmark(frames, directory=None):
+    from PIL import Image
+    def imread(path):
+        return np.array(Image.open(path))
+    server = FakeGrabServer()
+    for backend in FileGrabBackend(imread), BmpGrabBackend(directory, imread):
+        for _ in range(frames):
+            backend.grab(server)
+        print(type(backend).__name__, end=": ")
+        backend.timings.print_stats()
+        os.remove(backend.path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the bmp decoder and time the grab backends with a fake server")
+    parser.add_argument('-frames', default=200, type=int, help='number of frames')
+    parser.add_argument('-dir', default=None, type=str, help='directory of the bmp for BmpGrabBackend (ie: /dev/shm or R:\\ramdisk)')
+    args = parser.parse_args()
+    check()
+    benchmark(args.frames, args.dir)
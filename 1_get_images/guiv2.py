@@ -3,11 +3,12 @@ import augmentor
 import SEM_API_CUSTOM
 import os
 import nanocontrol
-import time
+import acquisition_runner
 
 sem = None
 aug = None
 con = None
+runner = None
 
 rot_keys = ['r0', 'r45', 'r90', 'r135', 'r180', 'r225', 'r270', 'r315']
 detector_keys = ['InLens', 'SE2', 'EBIC']
@@ -50,16 +51,17 @@ nc_control = [
     [sg.Button('Retract', disabled=True, key='nc_retract')],
 ]
 
-runner = [
+runner_control = [
     [sg.Text('Here you can run the whole process')],
-    [sg.Button('Run')]
+    [sg.Button('Run'), sg.Button('Cancel', key='run_cancel', disabled=True)],
+    [sg.Text('', key='run_status', size=(50, 1))]
 ]
 
 layout = [
     [sg.TabGroup([[ sg.Tab('SEM Control', [[sg.Column(sem_control), sg.VSeparator(), sg.Column(sem_parameter)]]),
                     sg.Tab('Augmentation Control', aug_control, disabled=False),
                     sg.Tab('Nanocontrol', nc_control),
-                    sg.Tab('Runner', runner)
+                    sg.Tab('Runner', runner_control)
                 ]])],
     [sg.Multiline(size=(50, 20), key='log', autoscroll=True)],
     [sg.Button('Exit'), sg.Button('Test')],
@@ -150,6 +152,8 @@ while True:
         window.start_thread(aug.grabImages, "grab")
     if event == 'Cancel':
         aug.running = False
+        if runner is not None:
+            runner.cancel()
         window['Grab Masks'].update(disabled=False)
         window['Grab Images'].update(disabled=False)
         window['Augment'].update(disabled=False)
@@ -177,6 +181,8 @@ while True:
         window['log'].print('Nanocontrols disconnected')
         for nc in con.ncs.keys():
             window["tip"+str(nc)].update(False)
+        # the ports stay open in the connection pool for the next connect
+        con.closeAll()
         con = None
         window['nc_connect'].update(disabled=False)
         window['nc_disconnect'].update(disabled=True)
@@ -187,45 +193,40 @@ while True:
         window['nc_retract'].update(disabled=False)
     if event == 'nc_retract':
         ret = con.retractStep()
-        if ret == 0:
+        if ret is None:
             window['log'].print('Retraction complete')
             window['nc_retract'].update(disabled=True)
         else:
-            window['log'].print('Retracted')
+            window['log'].print('Retracted' if ret.ok else ret)
 
     ## runner
     if event == 'Run':
+        # the phases run in a worker thread, it sends 'runner' for every event of the runner
         window['Run'].update(disabled=True)
-        running = True
-        while running:
-            window['log'].print('Grabbing masks')
-            window.start_thread(aug.grabMasks, "nix")
-
-            while aug.running:
-                time.sleep(3)
-                print('waiting')
-
-            window['log'].print('Grabbing images')
-            window.start_thread(aug.grabImages, "nix")
-
-            while aug.running:
-                time.sleep(3)
-                print('waiting')
-
-            aug.iteration += 1
-            window['log'].print('Grabbing done')
-            ret = con.retractStep()
-            if ret == 0:
-                running = False
+        window['run_cancel'].update(disabled=False)
+        runner = acquisition_runner.AcquisitionRunner(aug, con, notify=lambda: window.write_event_value('runner', None))
+        runner.start()
+    if event == 'run_cancel':
+        runner.cancel()
+        window['log'].print('Canceling after the current shot')
+    if event == 'runner':
+        for ev in runner.poll():
+            if ev[0] == 'phase':
+                window['log'].print('Grabbing %s' % ev[1] if ev[1] != acquisition_runner.RETRACT else 'Retracting')
+            elif ev[0] == 'progress':
+                window['run_status'].update('Iteration %d, %s: %d/%d' % (aug.iteration, ev[1], ev[2], ev[3]))
+            elif ev[0] == 'retract':
+                if not ev[1].ok:
+                    window['log'].print(ev[1])
+            elif ev[0] == 'done':
+                window['log'].print('%s done in %.1f s' % (ev[1], ev[2]))
+            elif ev[0] == 'finished':
+                window['log'].print(ev[2])
+                window['run_status'].update(ev[1])
                 window['Run'].update(disabled=False)
-                window['log'].print('Iteration done, please relocate tips.')
+                window['run_cancel'].update(disabled=True)
+                runner.print_stats()
 
-
-
-
-
-
-    
     if event == 'Test':
         print(values)
 window.close()
\ No newline at end of file
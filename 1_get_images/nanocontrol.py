@@ -1,79 +1,350 @@
 #%%
+"""
+Driver of the Kleindiek NanoControl on a serial port.
+
+Every command is answered with one line <status char><tab><message><CR>. A
+reader thread takes the replies off the port as soon as they arrive and
+hands them to the commands in the order they were sent, the protocol has no
+other way to match them. A command that timed out keeps its place until its
+reply comes; if it got lost, the input is flushed before the next command.
+submit() returns a future of the reply, the methods below wait for it with
+a per command timeout. max_in_flight > 1 sends the next commands before the
+reply of the first arrived (the controller reads its input while it
+executes), 1 keeps one command on the line. AsyncNanoControl offers the
+same with asyncio.
+
+nanocontrol.state (PositionState) follows the coarse counters and fine
+positions from the acknowledged commands, the get* methods answer from it
+and only ask the controller for values that are unknown (at the start,
+after errors, timeouts and stop) or with refresh=True. resync() reads all
+of them again, checkConsistency() compares them with the controller.
+
+FakeNanoControl answers on a pty like a NanoControl, python nanocontrol.py
+measures latency and throughput against it (Linux).
+"""
 import time
 import os
 import serial
 import serial.tools.list_ports
 import random
+import asyncio
+import argparse
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 
 import warnings
 
+def parse_reply(res):
+    # <status char><tab><message string><CR>
+    # <status char> can have one of the following values:
+    # 'o' for okay, 'e' for error, 'i' for info (e.g. Piezo Voltage Breakdown)
+    status = res[0]
+    message = res[2:-1]
+    if status == 'e':
+        raise Exception(message)
+    elif status == 'i':
+        warnings.warn(message)
+    return message
+
+def parse_axes(message, axes='ABCD'):
+    """'12 -3 0 7' -> {'A': 12, 'B': -3, 'C': 0, 'D': 7}, a single axis takes the last number"""
+    values = message.split()
+    if len(axes) == 1:
+        return {axes: int(values[-1])}
+    return {axis: int(value) for axis, value in zip(axes, values)}
+
+class PositionState():
+    """
+    Coarse counters and fine positions (per unit, fine, fine16 and fineu) of
+    the channels of one NanoControl, kept from the acknowledged commands.
+    None is unknown: after a failed or stopped command, a move whose effect
+    is not known (channel, knob) or a fine position set in another unit. The
+    getters of nanocontrol read unknown values from the controller.
+    """
+    FINE_RANGE = {'fine': (-2048, 2047), 'fine16': (-32768, 32767), 'fineu': (-80000, 80000)}
+    STEP_UNIT = {'finestep': 'fine', 'finestep16': 'fine16'}
+
+    def __init__(self):
+        self.coarse = dict.fromkeys('ABCD')
+        self.fine = {unit: dict.fromkeys('ABCD') for unit in self.FINE_RANGE}
+        self.hits = 0 # values answered from the state
+        self.reads = 0 # queries sent to the controller
+
+    def forget(self, axes='ABCD', coarse=True, fine=True):
+        for axis in axes:
+            if coarse:
+                self.coarse[axis] = None
+            if fine:
+                for values in self.fine.values():
+                    values[axis] = None
+    def values(self, kind):
+        return self.coarse if kind == 'coarse' else self.fine[kind]
+    def known(self, kind, axes):
+        return all(self.values(kind)[axis] is not None for axis in axes)
+    def store(self, kind, values):
+        self.values(kind).update(values)
+
+    def acknowledged(self, cmd):
+        """Apply a command the controller acknowledged."""
+        words = cmd.split()
+        if not words or words[-1] == '?':
+            return
+        name, args = words[0], words[1:]
+        try:
+            if name == 'coarse' and len(args) >= 2:
+                if self.coarse[args[0]] is not None:
+                    self.coarse[args[0]] += int(args[1])
+            elif name == 'coarsereset':
+                for axis in (args[0] if args else 'ABCD'):
+                    self.coarse[axis] = 0
+            elif name in self.FINE_RANGE and len(args) == 2:
+                self.forget(args[0], coarse=False)
+                self.fine[name][args[0]] = int(args[1])
+            elif name in self.STEP_UNIT:
+                unit, axis = self.STEP_UNIT[name], args[0]
+                position = self.fine[unit][axis]
+                self.forget(axis, coarse=False)
+                low, high = self.FINE_RANGE[unit]
+                # at the end of the range the step is not fully executed, the position is read again
+                if position is not None and low <= position + int(args[1]) <= high:
+                    self.fine[unit][axis] = position + int(args[1])
+            elif name in ('channel', 'knob'):
+                # fine with coarse, how the steps are split is up to the controller
+                self.forget([axis for axis, steps in zip('ABCD', args[:4]) if int(steps) != 0])
+            elif name in ('stop', 'stopnack'):
+                # the stopped move did only part of its steps
+                self.forget()
+        except (IndexError, KeyError, ValueError):
+            self.failed(cmd)
+    def failed(self, cmd):
+        """A command failed or got no reply, what it moved is unknown."""
+        words = cmd.split()
+        if not words or words[-1] == '?':
+            return
+        if len(words) > 1 and words[1] in self.coarse and words[0] not in ('channel', 'knob'):
+            self.forget(words[1])
+        else:
+            self.forget()
+
 class nanocontrol():
-    def __init__(self, port):
+    # s until the reply of a command, a move of many coarse steps takes a while
+    timeout = 10.0
+    # commands sent before the reply of the first one, 1 waits for every reply
+    max_in_flight = 1
+    # s without input before the reply of a command that timed out is taken as lost
+    drain_time = 0.1
+
+    def __init__(self, port, timeout=None, max_in_flight=None):
         self.port = port
-        self.ser = serial.Serial(self.port, 115200, timeout=10)
+        if timeout is not None:
+            self.timeout = timeout
+        if max_in_flight is not None:
+            self.max_in_flight = max_in_flight
+        # the read timeout only bounds how long the reader thread blocks
+        self.ser = serial.Serial(self.port, 115200, timeout=0.05)
+        self.__lock = threading.Lock()
+        self.__pending = deque() # sent, waiting for their reply
+        self.__queued = deque() # (cmd, future) waiting for a free slot
+        self.__expired = set() # pending commands that timed out, their reply is dropped if it still comes
+        self.__resync = None # time to flush the input if the late replies did not come until then
+        self.state = PositionState()
+        self.speed_changes = 0 # speed commands sent, the steps of a channel step may differ since
+        self.__closed = False
+        self.__reader = threading.Thread(target=self.__read_replies, daemon=True)
+        self.__reader.start()
     def close(self):
+        self.__closed = True
+        self.__reader.join()
+        with self.__lock:
+            futures = [future for future in self.__pending if future not in self.__expired]
+            futures += [future for _, future in self.__queued]
+            self.__pending.clear()
+            self.__queued.clear()
+            self.__expired.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionError("%s was closed" % self.port))
         self.ser.close()
-    
-    # The NanoControl sends a carriage return terminated line after execution of a command:
-    # <status char><tab><message string><CR>
-    # <status char> can have one of the following values:
-    # ‘o’ for okay, ‘e’ for error, ‘i’ for info (e.g. Piezo Voltage Breakdown)
-    def __return_handling(func):
-            def func_wrapper(*arg, **kwargs):
-                res = func(*arg, **kwargs)
-                status = res[0]
-                message = res[2:-1]
-                if status == 'e':
-                    raise Exception(message)
-                elif status == 'i':
-                    warnings.warn(message)
-                return message
-            return func_wrapper 
-    @__return_handling
-    def __send(self, cmd):
-        #print(cmd)
-        leftover = self.ser.inWaiting()
-        self.ser.flushInput()
+
+    def __read_replies(self):
+        buffer = b''
+        while not self.__closed:
+            with self.__lock:
+                if self.__resync is not None and time.monotonic() > self.__resync:
+                    buffer = b''
+                    self.__flush()
+            try:
+                data = self.ser.read(self.ser.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError):
+                # the port was closed or unplugged
+                break
+            if not data:
+                continue
+            if self.__resync is not None:
+                # still draining
+                self.__resync = time.monotonic() + self.drain_time
+            buffer += data
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                with self.__lock:
+                    # lines without a command are leftovers, ie: the second output of stop
+                    future = self.__pending.popleft() if self.__pending else None
+                    if future in self.__expired:
+                        # the late reply of a command that timed out
+                        self.__expired.discard(future)
+                        future = None
+                    self.__dispatch()
+                if future is not None and not future.done():
+                    future.set_result((line + b'\r').decode('ascii', errors='replace'))
+    def __write(self, cmd, future):
+        # called with the lock held, the order of pending is the order on the line
+        self.__pending.append(future)
         self.ser.write((cmd + '\r').encode('utf-8'))
         self.ser.flush()
-        time.sleep(1)
-        buffer = self.ser.read_until(b'\r').decode('ascii')
-        #print(buffer)
-        return buffer
+    def __dispatch(self):
+        # called with the lock held, writes queued commands while there are free slots
+        if self.__queued and self.__expired:
+            # a command behind one that timed out would get its reply if it still comes, or
+            # none at all if it was lost. Wait for the commands still running and drain the
+            # late replies, the reader flushes the input after drain_time without any
+            if len(self.__expired) == len(self.__pending) and self.__resync is None:
+                self.__resync = time.monotonic() + self.drain_time
+            return
+        self.__resync = None
+        while self.__queued and len(self.__pending) < self.max_in_flight:
+            self.__write(*self.__queued.popleft())
+    def __flush(self):
+        # called by the reader with the lock held, drops the replies of the expired commands
+        self.__resync = None
+        if len(self.__expired) != len(self.__pending):
+            # an urgent command (stop) was written since, its reply follows the late ones
+            return
+        self.ser.reset_input_buffer()
+        self.__pending.clear()
+        self.__expired.clear()
+        self.__dispatch()
+
+    def submit(self, cmd, reply=True, urgent=False):
+        """
+        Send cmd, returns a future of the raw reply line.
+        reply: False for commands without a reply (stopnack), the future is done at once
+        urgent: send even if max_in_flight commands are waiting for their reply (stop)
+        """
+        future = Future()
+        with self.__lock:
+            if self.__closed:
+                raise ConnectionError("%s is closed" % self.port)
+            if cmd.startswith('speed ') and cmd != 'speed ?':
+                self.speed_changes += 1
+            if not reply:
+                self.ser.write((cmd + '\r').encode('utf-8'))
+                self.ser.flush()
+                future.set_result(None)
+            elif urgent:
+                # stop ends the running command, its reply comes before the one of stop
+                self.__write(cmd, future)
+            else:
+                self.__queued.append((cmd, future))
+                self.__dispatch()
+        return future
+    def expire(self, future):
+        """
+        Give up a command without reply. It keeps its place in pending, the
+        reply that still comes for it is dropped. If it never comes, the input
+        is flushed before the next command is written.
+        """
+        with self.__lock:
+            if future in self.__pending:
+                self.__expired.add(future)
+            else:
+                self.__queued = deque(entry for entry in self.__queued if entry[1] is not future)
+            self.__dispatch()
+    def result(self, future, cmd='', timeout=None):
+        """Wait for the reply of a submitted command, the message or raises like every command."""
+        try:
+            res = future.result(self.timeout if timeout is None else timeout)
+        except FutureTimeoutError:
+            self.expire(future)
+            self.state.failed(cmd)
+            raise TimeoutError("%s: no reply to '%s' within %.1f s" % (self.port, cmd, self.timeout if timeout is None else timeout))
+        return self.handle_reply(cmd, res)
+    def handle_reply(self, cmd, res):
+        """Message of the reply line of cmd, the position state follows the command."""
+        try:
+            message = None if res is None else parse_reply(res)
+        except Exception:
+            self.state.failed(cmd)
+            raise
+        self.state.acknowledged(cmd)
+        return message
+    def send(self, cmd, timeout=None):
+        return self.result(self.submit(cmd), cmd, timeout)
+    def send_many(self, cmds, timeout=None):
+        """Send several commands, pipelined up to max_in_flight, returns their messages in order."""
+        futures = [self.submit(cmd) for cmd in cmds]
+        return [self.result(future, cmd, timeout) for future, cmd in zip(futures, cmds)]
+    def __send(self, cmd):
+        return self.send(cmd)
 
 
     # Stops any commands that are currently being executed by the NanoControl. Command itself returns an output. Thus two outputs are returned. Output from the stopped command and from stop.
     # If ack is False, stop command itself returns no acknowledgement
     def stop(self, ack=True):
         if ack:
-            return self.__send('stop')
+            return self.result(self.submit('stop', urgent=True), 'stop')
         else:
-            return self.__send('stopnack')
+            return self.result(self.submit('stopnack', reply=False, urgent=True), 'stopnack')
     def getVersion(self):
         return self.__send('version')
-    def getInfo(self):
-        ret = self.__send('knbus ?').split(' ')
+    def getInfo(self, timeout=None):
+        ret = self.send('knbus ?', timeout).split(' ')
         return {'id' : ret[0], 'rank' : ret[1], 'slottype' : ret[2]}
 
     # Returns values of coarse step counters for channels A to D in <message string> separated by blank if axis not specified or returns value of coarse step counter in <message string>
-    def getCoarseCounters(self, axis = None):
-        if axis is None:
-            ret = self.__send('coarse ?').split(' ')
-            return {'A' : ret[0], 'B' : ret[1], 'C' : ret[2], 'D' : ret[3]}
+    # The counters are answered from the position state, refresh reads them from the controller.
+    def getCoarseCounters(self, axis = None, refresh = False):
+        return self.__positions('coarse', axis, refresh)
+    def __positions(self, kind, axis, refresh):
+        axes = 'ABCD' if axis is None else axis
+        assert axes in ('ABCD', 'A', 'B', 'C', 'D'), 'Axis must be A, B, C or D'
+        if refresh or not self.state.known(kind, axes):
+            self.state.reads += 1
+            cmd = '%s ?' % kind if axis is None else '%s %s ?' % (kind, axis)
+            self.state.store(kind, parse_axes(self.__send(cmd), axes))
         else:
-            assert axis in 'ABCD', 'Axis must be A, B, C or D'
-            ret = self.__send('coarse %s ?' % axis)
-            return {axis : int(ret[1])}
+            self.state.hits += 1
+        values = self.state.values(kind)
+        return {axis: values[axis] for axis in axes}
+    def resync(self):
+        """Read all counters and fine positions from the controller into the position state."""
+        for kind in ['coarse'] + list(PositionState.FINE_RANGE):
+            self.__positions(kind, None, True)
+    def checkConsistency(self):
+        """
+        Compare the position state with the controller and take the values of the controller.
+        :return: {(kind, axis): (tracked, controller)} of the values that differ, unknown ones are not compared
+        """
+        differences = {}
+        for kind in ['coarse'] + list(PositionState.FINE_RANGE):
+            tracked = dict(self.state.values(kind))
+            for axis, value in self.__positions(kind, None, True).items():
+                if tracked[axis] is not None and tracked[axis] != value:
+                    differences[(kind, axis)] = (tracked[axis], value)
+        return differences
     # Executes <-65536.. 65535> coarse steps in channel <A.. D> at specified speed <1..6> if speed not specified, executes at current speed.
     # TODO: sending speed does not work
     def moveCoarse(self, axis, steps, speed = None):
+        return self.__send(self.coarseCommand(axis, steps, speed))
+    @staticmethod
+    def coarseCommand(axis, steps, speed = None):
         assert axis in 'ABCD', 'Axis must be A, B, C or D'
         assert steps in range(-65536, 65535), 'Steps must be between -65536 and 65535'
         if speed is None:
-            return self.__send('coarse %s %s' % (axis, steps))
+            return 'coarse %s %s' % (axis, steps)
         else:
             assert speed in range(1, 7), 'Speed must be between 1 and 6'
-            return self.__send('coarse %s %s %s' % (axis, steps, speed))
+            return 'coarse %s %s %s' % (axis, steps, speed)
     # Resets coarse step counter in channel <A.. D> (no parameter resets all counters)
     def resetCoarseCounter(self, axis = None):
         if axis:
@@ -82,30 +353,12 @@ class nanocontrol():
         else:
             return self.__send('coarsereset')
     # Returns fine positions for all channels or fine position for specified channel
-    def getFinePos12Bit(self, axis = None):
-        if axis is None:
-            ret = self.__send('fine ?').split(' ')
-            return {'A' : ret[0], 'B' : ret[1], 'C' : ret[2], 'D' : ret[3]}
-        else:
-            assert axis in 'ABCD', 'Axis must be A, B, C or D'
-            ret = self.__send('fine %s ?' % axis)
-            return {axis : int(ret)}
-    def getFinePos16Bit(self, axis = None):
-        if axis is None:
-            ret = self.__send('fine16 ?').split(' ')
-            return {'A' : ret[0], 'B' : ret[1], 'C' : ret[2], 'D' : ret[3]}
-        else:
-            assert axis in 'ABCD', 'Axis must be A, B, C or D'
-            ret = self.__send('fine16 %s ?' % axis)
-            return {axis : int(ret)}
-    def getFinePosVoltage(self, axis = None):
-        if axis is None:
-            ret = self.__send('fineu ?').split(' ')
-            return {'A' : ret[0], 'B' : ret[1], 'C' : ret[2], 'D' : ret[3]}
-        else:
-            assert axis in 'ABCD', 'Axis must be A, B, C or D'
-            ret = self.__send('fineu %s ?' % axis)
-            return {axis : int(ret)}
+    def getFinePos12Bit(self, axis = None, refresh = False):
+        return self.__positions('fine', axis, refresh)
+    def getFinePos16Bit(self, axis = None, refresh = False):
+        return self.__positions('fine16', axis, refresh)
+    def getFinePosVoltage(self, axis = None, refresh = False):
+        return self.__positions('fineu', axis, refresh)
     # Sets fine position to <-2048.. 2047> in channel <A.. D>
     def setFinePos12Bit(self, axis, position):
         assert axis in 'ABCD', 'Axis must be A, B, C or D'
@@ -148,7 +401,7 @@ class nanocontrol():
         assert all([steps[0] in 'cf' and steps[1] in range(1, 65) for steps in movement.values()]), 'Steps must be coarse/fine and in range [1,64]'
         assert speed in range(1, 7), 'Speed must be in [1,6]'
         cmd = 'speed %s' % speed
-        for axis, move in dict.items():
+        for axis, move in movement.items():
             cmd += ' %s%s' % (move[0], '0' * (2 - len(str(move[1]))) + str(move[1]))
         return self.__send(cmd)
     #Simulates turning the knobs by the specified amount of ticks.
@@ -162,12 +415,15 @@ class nanocontrol():
         return self.__send(cmd)
     # Steps in the range <-100.. +100> for each channel are executed at the current speed. Will use fine with coarse if it is enabled.
     def moveAxesFWC(self, a, b, c, d):
+        return self.__send(self.channelCommand(a, b, c, d))
+    @staticmethod
+    def channelCommand(a, b, c, d):
         # range is -100 to 100
         assert a in range(-100, 101), 'Steps A must be in [-100, 100]'
         assert b in range(-100, 101), 'Steps B must be in [-100, 100]'
         assert c in range(-100, 101), 'Steps C must be in [-100, 100]'
         assert d in range(-100, 101), 'Steps D must be in [-100, 100]'
-        return self.__send('channel %s %s %s %s' % (a, b, c, d))
+        return 'channel %s %s %s %s' % (a, b, c, d)
     # Steps in the range <-100.. +100> for each channel are executed every few milliseconds <ms> at the current speed. Loop will
     def moveAxisContinuousFWC(self, a, b, c, d, ms):
         # range is -100 to 100
@@ -178,13 +434,207 @@ class nanocontrol():
         assert ms in range(1, 1000), 'Time must be in [1, 999]'
         return self.__send('channel %s %s %s %s %s' % (a, b, c, d, ms))
 
-class controller():
-    ncs = {}
-    stage = {}
-    ncs_pattern = {}
-    step = 0
-    stagestep = 0
+class AsyncNanoControl():
+    """
+    asyncio interface of a nanocontrol. send() waits for the reply future of
+    the driver, the other methods of nanocontrol run in a thread:
+
+        nc = AsyncNanoControl(nanocontrol('COM5'))
+        await nc.send('coarse A 100')
+        await asyncio.gather(nc.moveCoarse('A', 100), other.moveCoarse('C', -20))
+    """
+    def __init__(self, nc):
+        self.nc = nc
+    async def send(self, cmd, timeout=None):
+        timeout = self.nc.timeout if timeout is None else timeout
+        future = self.nc.submit(cmd)
+        try:
+            res = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            self.nc.expire(future)
+            self.nc.state.failed(cmd)
+            raise TimeoutError("%s: no reply to '%s' within %.1f s" % (self.nc.port, cmd, timeout))
+        return self.nc.handle_reply(cmd, res)
+    async def send_many(self, cmds, timeout=None):
+        return await asyncio.gather(*[self.send(cmd, timeout) for cmd in cmds])
+    def __getattr__(self, name):
+        method = getattr(self.nc, name)
+        async def run(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return run
+
+def channel_scale(speed_reply):
+    """
+    Coarse steps per channel step of every axis from the reply of 'speed ?'
+    ('3 c01 c01 f10 c02' -> {'A': 1, 'B': 1, 'C': None, 'D': 2}), None for
+    axes that make fine steps.
+    """
+    configs = speed_reply.split()[1:5]
+    return {axis: int(config[1:]) if config[0] == 'c' else None for axis, config in zip('ABCD', configs)}
+
+def compile_step(entries, factor=1, scale=None):
+    """
+    Commands of one pattern step, entries like ['C2', 'A-1'] (coarse steps).
+    With scale (channel_scale of the controller) the moves go into as few
+    'channel a b c d' commands as possible: one per step, a new one when an
+    axis comes again (the order is kept) and more when an axis needs more
+    than 100 channel steps. Steps that need an axis without coarse steps, or
+    a number of steps that is not a multiple of its scale, stay coarse moves.
+    """
+    moves = [(entry[0], int(round(int(entry[1:]) * factor))) for entry in entries]
+    moves = [(axis, steps) for axis, steps in moves if steps != 0]
+    if scale is None or any(scale.get(axis) is None or steps % scale[axis] for axis, steps in moves):
+        return [nanocontrol.coarseCommand(axis, steps) for axis, steps in moves]
+    groups = [{}]
+    for axis, steps in moves:
+        if axis in groups[-1]:
+            groups.append({})
+        groups[-1][axis] = steps // scale[axis]
+    commands = []
+    for remaining in groups:
+        while any(remaining.values()):
+            chunk = {axis: max(-100, min(100, steps)) for axis, steps in remaining.items()}
+            commands.append(nanocontrol.channelCommand(*[chunk.get(axis, 0) for axis in 'ABCD']))
+            remaining = {axis: steps - chunk[axis] for axis, steps in remaining.items()}
+    return commands
+
+# port -> id and USB serial number of the NanoControls found last time
+PORT_CACHE = os.path.join(os.path.expanduser('~'), '.nanocontrol_ports.json')
+
+class ConnectionPool():
+    """
+    Open NanoControl connections by port. discover() probes the N6 ports in
+    parallel with one short 'knbus ?'. Connections stay open when a
+    controller is closed, so a reconnect does not open the ports again, but
+    they are probed as well and opened again if they do not answer. Ports
+    that do not answer are dropped. close() really closes them.
+    list_ports: function returning the ports like serial.tools.list_ports.comports
+    """
+    def __init__(self, cache_path=PORT_CACHE, probe_timeout=0.5, list_ports=None):
+        self.cache_path = cache_path
+        self.probe_timeout = probe_timeout
+        self.list_ports = list_ports or serial.tools.list_ports.comports
+        self.connections = {} # port -> nanocontrol
+        self.ids = {} # port -> id
+        self.probed = 0 # ports opened and probed by the last discover
+        self.revalidated = 0 # open connections probed by the last discover
+        self.revalidation_failures = 0 # of them opened again
+        self.discovery_time = 0.0
+        self.__lock = threading.Lock()
+
+    def load_cache(self):
+        import json
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    def save_cache(self, entries):
+        import json
+        if self.cache_path is None:
+            return
+        try:
+            with open(self.cache_path, 'w') as f:
+                json.dump(entries, f, indent=1)
+        except OSError as e:
+            warnings.warn("Port cache not written: %s" % e)
+
+    def probe(self, port):
+        """(port, nanocontrol, id) of a NanoControl on port, nanocontrol and id are None if it does not answer."""
+        try:
+            nc = nanocontrol(port)
+        except (serial.SerialException, OSError) as e:
+            print(e)
+            return port, None, None
+        try:
+            return port, nc, nc.getInfo(self.probe_timeout)['id']
+        except Exception as e:
+            print(e)
+            nc.close()
+            return port, None, None
+
+    def revalidate(self, port):
+        """probe() on the open connection of port, a new connection is probed if it does not answer."""
+        nc = self.connections[port]
+        try:
+            return port, nc, nc.getInfo(self.probe_timeout)['id']
+        except Exception as e:
+            print(e)
+            nc.close()
+            return self.probe(port)
 
+    def discover(self, verify=False):
+        """
+        :return: {id: nanocontrol} of the NanoControls on the N6 ports
+        verify: open the ports again instead of probing the open connections
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        start = time.perf_counter()
+        with self.__lock:
+            ports = {port.device: port.serial_number for port in self.list_ports()
+                     if port.serial_number and "N6" in port.serial_number}
+            cache = self.load_cache() if self.cache_path is not None else {}
+            for port in list(self.connections):
+                if port not in ports:
+                    # unplugged
+                    self.connections.pop(port).close()
+                    self.ids.pop(port, None)
+            if verify:
+                for port in list(self.connections):
+                    self.connections.pop(port).close()
+            reused = [port for port in ports if port in self.connections]
+            todo = [port for port in ports if port not in self.connections]
+            self.probed = len(todo)
+            self.revalidated = len(reused)
+            if ports:
+                with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+                    futures = [executor.submit(self.revalidate, port) for port in reused] + [executor.submit(self.probe, port) for port in todo]
+                    results = [future.result() for future in futures]
+                self.revalidation_failures = sum(nc is not self.connections[port] for port, nc, _ in results[:len(reused)])
+                for port, nc, id in results:
+                    if nc is None:
+                        self.connections.pop(port, None)
+                        self.ids.pop(port, None)
+                        continue
+                    cached = cache.get(port)
+                    if cached is not None and cached.get('serial_number') == ports[port] and cached.get('id') != id:
+                        warnings.warn("%s answers as NanoControl %s, it was %s" % (port, id, cached.get('id')))
+                    self.connections[port] = nc
+                    self.ids[port] = id
+            self.save_cache({port: {'id': id, 'serial_number': ports[port]} for port, id in self.ids.items()})
+            self.discovery_time = time.perf_counter() - start
+            return {self.ids[port]: nc for port, nc in self.connections.items()}
+
+    def close(self):
+        with self.__lock:
+            for nc in self.connections.values():
+                nc.close()
+            self.connections = {}
+            self.ids = {}
+
+_default_pool = None
+def default_pool():
+    """ConnectionPool shared by the controllers of this process."""
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = ConnectionPool()
+    return _default_pool
+
+class FanOutResult():
+    """Replies, errors and times per tip of one fan_out."""
+    def __init__(self):
+        self.replies = {} # tip -> messages of the commands that were executed
+        self.errors = {} # tip -> error of the command that failed
+        self.times = {} # tip -> s until its last reply
+        self.elapsed = 0.0
+    @property
+    def ok(self):
+        return not self.errors
+    def __repr__(self):
+        errors = ''.join(', %s: %s' % (tip, error) for tip, error in self.errors.items())
+        return "FanOutResult(%d tips in %.2f s%s)" % (len(self.replies), self.elapsed, errors)
+
+class controller():
     patterns = {
         0 : [['C2', 'A-1'], ['C1', 'A2'], ['C2', 'A-1'], []],
         1 : [['C2', 'A1'], ['C1', 'A-1'], ['C2', 'A-1'], ["A1"]],
@@ -193,52 +643,580 @@ class controller():
     }
     stage_pattern = [['A20', 'B20'], ['B20'], ['A-20', 'B20'], ['A-20'], ['A-20', 'B-20'], ['B-20'], ['A20', 'B-20'], ['A20']]
 
-    def __init__(self):
-        ports = serial.tools.list_ports.comports()
-        for port in ports:
-            if "N6" in port.serial_number:
-                nc = nanocontrol(port.device)
-                id = nc.getInfo()['id']
-                if id == '31':
-                    self.stage['31'] = nc
-                else:
-                    self.ncs[id] = nc
+    def __init__(self, ncs=None, stage=None, pool=None):
+        """
+        ncs, stage: {id: nanocontrol} to use instead of the NanoControls found on the serial ports
+        pool: ConnectionPool of the NanoControls, default_pool() if not given
+        """
+        self.ncs = {}
+        self.stage = {}
+        self.ncs_pattern = {}
+        self.blocked_tips = ()
+        self.scales = {}
+        self.scale_versions = {} # nanocontrol.speed_changes when the scales were read
+        self.compiled = {}
+        self.factor = 1
+        self.step = 0
+        self.stagestep = 0
+        # one thread per port, the commands of different tips run at the same time
+        self.__executor = None
+        self.__executor_size = 0
+        self.pool = None
+        if ncs is not None or stage is not None:
+            self.ncs = dict(ncs or {})
+            self.stage = dict(stage or {})
+            return
+        self.pool = pool or default_pool()
+        for id, nc in self.pool.discover().items():
+            if id == '31':
+                self.stage['31'] = nc
+            else:
+                self.ncs[id] = nc
     def closeAll(self):
-        for nc in self.ncs.values():
-            nc.close()
+        """Close the NanoControls, the ones of a pool stay open for the next controller."""
+        if self.pool is None:
+            for nc in list(self.ncs.values()) + list(self.stage.values()):
+                nc.close()
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
+
+    def fan_out(self, commands, timeout=None):
+        """
+        Send the commands of every tip at once, commands is {tip: [command, ...]}.
+        The commands of one tip run one after the other and stop at its first
+        error, the tips do not wait for each other. The errors are returned,
+        not raised.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        nodes = dict(self.ncs, **self.stage)
+        if self.__executor is None or self.__executor_size < len(nodes):
+            if self.__executor is not None:
+                self.__executor.shutdown()
+            self.__executor_size = max(len(nodes), 1)
+            self.__executor = ThreadPoolExecutor(max_workers=self.__executor_size)
+        result = FanOutResult()
+        start = time.perf_counter()
+        def run(tip, cmds):
+            replies = result.replies.setdefault(tip, [])
+            try:
+                for cmd in cmds:
+                    replies.append(nodes[tip].send(cmd, timeout))
+            except Exception as e:
+                result.errors[tip] = "%s: %s" % (type(e).__name__, e)
+            result.times[tip] = time.perf_counter() - start
+        futures = [self.__executor.submit(run, tip, cmds) for tip, cmds in commands.items()]
+        for future in futures:
+            future.result()
+        result.elapsed = time.perf_counter() - start
+        return result
 
-    def assignPattern(self, blocked_tips):
+    # move the channels of a pattern step together with 'channel', if the speed of the controller makes coarse steps
+    batch_axes = True
+
+    def assignPattern(self, blocked_tips=(), factor=1):
+        """
+        Choose a random pattern for every tip and compile its steps into the
+        commands of its controller (compile_step), the speed configuration of
+        the controllers is read for that and again after a speed command.
+        """
         self.blocked_tips = blocked_tips
         self.ncs_pattern = {}
         self.ncs_pattern = {(nc, random.randint(0, len(self.patterns)-1)) for nc in self.ncs.keys()}
         self.step = 0
+        self.scales = {}
+        self.readScales(self.ncs)
+        self.compilePattern(factor)
         return self.ncs_pattern
+    def readScales(self, ncs):
+        for nc in ncs:
+            self.scale_versions[nc] = self.ncs[nc].speed_changes
+            self.scales.pop(nc, None)
+        if self.batch_axes:
+            speeds = self.fan_out({nc: ['speed ?'] for nc in ncs})
+            for nc, replies in speeds.replies.items():
+                if replies:
+                    self.scales[nc] = channel_scale(replies[0])
+    def compilePattern(self, factor=1):
+        self.factor = factor
+        self.compiled = {nc: [compile_step(step, factor, self.scales.get(nc)) for step in self.patterns[pt]]
+                         for nc, pt in self.ncs_pattern}
     
     def retractStep(self, factor=1):
+        """
+        Move every tip that is not blocked by the current step of its pattern,
+        all tips at once. Returns the FanOutResult, None if the pattern is done.
+        """
         if self.step > len(self.patterns[0])-1:
-            return 0
-        else:
-            for nc, pt in self.ncs_pattern:
-                if nc not in self.blocked_tips:
-                    for cmd in self.patterns[pt][self.step]:
-                        self.ncs[nc].moveCoarse(cmd[0], int(cmd[1:])*factor)
-                        print("moved: ", nc, cmd[0], int(cmd[1:])*factor)
-            self.step += 1
-            return 1
+            return None
+        changed = [nc for nc in self.compiled if self.ncs[nc].speed_changes != self.scale_versions.get(nc)]
+        if changed:
+            self.readScales(changed)
+        if changed or factor != self.factor:
+            self.compilePattern(factor)
+        commands = {nc: steps[self.step] for nc, steps in self.compiled.items() if nc not in self.blocked_tips}
+        result = self.fan_out(commands)
+        for nc, replies in result.replies.items():
+            for cmd in commands[nc][:len(replies)]:
+                print("moved: ", nc, cmd)
+        if not result.ok:
+            print("retract step %d failed: %s" % (self.step, result))
+        self.step += 1
+        return result
 
     def retract(self, distance_nm=300):
         factor = distance_nm / 300
-        print(self.nc_pt)
-        for step in range(len(self.patterns[0])):
-            for nc, pt in self.nc_pt:
-                for cmd in self.patterns[pt][step]:
-                    self.ncs[nc].moveCoarse(cmd[0], int(cmd[1:]))
+        self.step = 0
+        while self.retractStep(factor) is not None:
+            pass
     
     def moveStage(self):
         cmd = self.stage_pattern[self.stagestep]
-        for movement in cmd:
-            self.stage['31'].moveCoarse(movement[0], int(movement[1:]))
+        result = self.fan_out({'31': [nanocontrol.coarseCommand(movement[0], int(movement[1:])) for movement in cmd]})
         self.stagestep += 1
         if self.stagestep == len(self.stage_pattern):
             self.stagestep = 0
-#%%
\ No newline at end of file
+        return result
+
+# port as listed by serial.tools.list_ports.comports, for a fake list_ports
+FakePortInfo = namedtuple('FakePortInfo', ['device', 'serial_number'])
+
+# units of the fine position of the fake per 16 bit digit
+FINE_SCALE = {'fine': 1 / 16, 'fine16': 1, 'fineu': 80000 / 32768}
+
+class FakeNanoControl():
+    """
+    NanoControl on a pty (Linux) for tests and benchmarks, port is the device
+    to open. Commands are executed one after the other like on the device,
+    stop ends the running one. latency is the time until a reply, a coarse move takes step_time per step
+    of its largest channel. It knows the commands of nanocontrol with coarse
+    counters and fine positions per channel.
+    """
+    def __init__(self, id='1', latency=0.002, step_time=0.0005):
+        import pty
+        import tty
+        self.id = id
+        self.latency = latency
+        self.step_time = step_time
+        self.coarse = dict.fromkeys('ABCD', 0)
+        self.fine = dict.fromkeys('ABCD', 0)
+        self.speed = 3
+        self.speed_config = ['c01'] * 4
+        self.commands = 0
+        self.drop = 0 # replies that get lost on the line
+        self.__master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self.__slave = slave
+        self.__stop = threading.Event()
+        self.__abort = threading.Event()
+        self.__thread = threading.Thread(target=self.__serve, daemon=True)
+        self.__thread.start()
+
+    def __serve(self):
+        # stop has to be seen while a move runs, the commands are executed in a second thread
+        import queue
+        commands = queue.Queue()
+        def execute():
+            while True:
+                cmd = commands.get()
+                if cmd is None:
+                    return
+                if cmd and cmd[0] in ('stop', 'stopnack'):
+                    self.__abort.clear()
+                    if cmd[0] == 'stop':
+                        self.__reply('o', 'stopped')
+                    continue
+                reply = self.execute(cmd)
+                if self.drop:
+                    self.drop -= 1
+                    continue
+                self.__reply(*reply)
+        worker = threading.Thread(target=execute, daemon=True)
+        worker.start()
+        buffer = b''
+        while not self.__stop.is_set():
+            try:
+                data = os.read(self.__master, 1024)
+            except OSError:
+                break
+            buffer += data
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                self.commands += 1
+                cmd = line.decode('ascii').split()
+                if cmd and cmd[0] in ('stop', 'stopnack'):
+                    self.__abort.set()
+                commands.put(cmd)
+        commands.put(None)
+    def __reply(self, status, message):
+        try:
+            os.write(self.__master, ('%s\t%s\r' % (status, message)).encode('ascii'))
+        except OSError:
+            pass
+    def __wait(self, seconds):
+        # a stop ends the move early
+        self.__abort.wait(seconds)
+
+    def execute(self, cmd):
+        """(status, message) of one command, the list of its words"""
+        time.sleep(self.latency)
+        try:
+            name, args = cmd[0], cmd[1:]
+            if name == 'version':
+                return 'o', 'NanoControl fake 1.0'
+            if name == 'knbus':
+                return 'o', '%s 0 N6' % self.id
+            if name == 'coarse':
+                if args == ['?']:
+                    return 'o', ' '.join(str(self.coarse[axis]) for axis in 'ABCD')
+                if len(args) == 2 and args[1] == '?':
+                    return 'o', str(self.coarse[args[0]])
+                steps = int(args[1])
+                self.__wait(abs(steps) * self.step_time)
+                self.coarse[args[0]] += steps
+                return 'o', 'coarse %s %d' % (args[0], steps)
+            if name == 'coarsereset':
+                for axis in (args or 'ABCD'):
+                    self.coarse[axis] = 0
+                return 'o', 'coarsereset'
+            if name in FINE_SCALE:
+                # the position is kept in 16 bit
+                if args == ['?']:
+                    return 'o', ' '.join(str(round(self.fine[axis] * FINE_SCALE[name])) for axis in 'ABCD')
+                if args[1] == '?':
+                    return 'o', str(round(self.fine[args[0]] * FINE_SCALE[name]))
+                self.fine[args[0]] = max(-32768, min(32767, round(int(args[1]) / FINE_SCALE[name])))
+                return 'o', '%s %s %s' % (name, args[0], args[1])
+            if name in ('finestep', 'finestep16'):
+                step = int(args[1]) * (16 if name == 'finestep' else 1)
+                self.fine[args[0]] = max(-32768, min(32767, self.fine[args[0]] + step))
+                return 'o', '%s %s %s' % (name, args[0], args[1])
+            if name == 'speed':
+                if args == ['?']:
+                    return 'o', '%d %s' % (self.speed, ' '.join(self.speed_config))
+                self.speed = int(args[0])
+                if len(args) == 5:
+                    self.speed_config = args[1:]
+                return 'o', 'speed %s' % ' '.join(args)
+            if name in ('channel', 'knob'):
+                steps = [int(arg) for arg in args[:4]]
+                self.__wait(max(abs(step) for step in steps) * self.step_time)
+                if name == 'channel':
+                    for axis, step, config in zip('ABCD', steps, self.speed_config):
+                        if config[0] == 'c':
+                            self.coarse[axis] += step * int(config[1:])
+                return 'o', ' '.join(args)
+        except (IndexError, KeyError, ValueError):
+            return 'e', 'invalid parameter'
+        return 'e', 'unknown command'
+
+    def close(self):
+        self.__stop.set()
+        self.__abort.set()
+        os.close(self.__slave)
+        os.close(self.__master)
+        self.__thread.join()
+
+
+def check():
+    fake = FakeNanoControl(id='7')
+    nc = nanocontrol(fake.port, timeout=2)
+    try:
+        assert nc.getInfo()['id'] == '7'
+        assert nc.moveCoarse('A', 100) == 'coarse A 100'
+        assert nc.send_many(['coarse B -5', 'coarse B -5', 'coarse ?']) == ['coarse B -5', 'coarse B -5', '100 -10 0 0']
+        try:
+            nc.send('nope')
+            raise AssertionError('error reply was not raised')
+        except Exception as e:
+            assert str(e) == 'unknown command'
+        # the reply of the stopped move and the one of stop
+        move = nc.submit('coarse C 60000')
+        time.sleep(0.05)
+        assert nc.stop() == 'stopped' and nc.result(move) == 'coarse C 60000'
+        async def run():
+            anc = AsyncNanoControl(nc)
+            return await asyncio.gather(anc.send('coarse D 3'), anc.getCoarseCounters())
+        assert asyncio.run(run())[0] == 'coarse D 3'
+        try:
+            nc.send('coarse A 60000', timeout=0.05)
+            raise AssertionError('timeout was not raised')
+        except TimeoutError:
+            pass
+        # the late reply of the stopped move is dropped
+        assert nc.stop() == 'stopped'
+        assert nc.getVersion() == 'NanoControl fake 1.0'
+        # a lost reply only fails its own command
+        fake.drop = 1
+        try:
+            nc.send('version', timeout=0.2)
+            raise AssertionError('timeout was not raised')
+        except TimeoutError:
+            pass
+        assert [nc.moveCoarse('A', n) for n in (1, 2, 3)] == ['coarse A 1', 'coarse A 2', 'coarse A 3']
+    finally:
+        nc.close()
+        fake.close()
+    # a later command expires first, the reply of the first one still goes to it
+    fake = FakeNanoControl(id='7', latency=0.05)
+    nc = nanocontrol(fake.port, timeout=2, max_in_flight=4)
+    try:
+        first, second = nc.submit('coarse A 1'), nc.submit('coarse A 2')
+        nc.expire(second)
+        assert nc.result(first) == 'coarse A 1'
+        assert nc.send('coarse A 3') == 'coarse A 3'
+    finally:
+        nc.close()
+        fake.close()
+    print("check: replies, errors, stop, timeout, lost replies and asyncio against the fake NanoControl")
+
+def benchmark(commands, latency):
+    fake = FakeNanoControl(latency=latency)
+    try:
+        for depth in (1, 4):
+            nc = nanocontrol(fake.port, max_in_flight=depth)
+            start = time.perf_counter()
+            for _ in range(commands):
+                nc.moveCoarse('A', 1)
+            single = time.perf_counter() - start
+            start = time.perf_counter()
+            nc.send_many(['coarse A 1'] * commands)
+            many = time.perf_counter() - start
+            print("max_in_flight %d: %.2f ms per command one by one, %.2f ms per command with send_many (%.0f commands/s), the fixed sleep took >= 1000 ms" % (
+                depth, single / commands * 1e3, many / commands * 1e3, commands / many))
+            nc.close()
+    finally:
+        fake.close()
+
+def check_state():
+    fake = FakeNanoControl()
+    nc = nanocontrol(fake.port, timeout=2)
+    try:
+        assert nc.getCoarseCounters() == {'A': 0, 'B': 0, 'C': 0, 'D': 0}
+        nc.moveCoarse('A', 40)
+        nc.moveCoarse('B', -7)
+        nc.setFinePos16Bit('C', 1600)
+        nc.moveFine12Bit('C', 3)
+        reads = nc.state.reads
+        assert nc.getCoarseCounters() == {'A': 40, 'B': -7, 'C': 0, 'D': 0} and nc.getCoarseCounters('A') == {'A': 40}
+        assert nc.state.reads == reads
+        # 12 bit is known from the set, the step was made in 12 bit, 16 bit is read again
+        assert nc.getFinePos16Bit('C') == {'C': 1648} and nc.state.reads == reads + 1
+        assert nc.checkConsistency() == {}
+        # moved at the controller itself
+        fake.coarse['D'] = 5
+        assert nc.checkConsistency() == {('coarse', 'D'): (0, 5)} and nc.getCoarseCounters('D') == {'D': 5}
+        try:
+            nc.send('coarse B x')
+        except Exception:
+            pass
+        nc.moveAxesFWC(0, 0, 0, 4)
+        assert nc.state.coarse['B'] is None and nc.state.coarse['D'] is None and nc.state.coarse['A'] == 40
+        assert nc.getCoarseCounters('D') == {'D': 9}
+    finally:
+        nc.close()
+        fake.close()
+    print("check: position state follows the moves and is read again when unknown")
+
+def benchmark_state(queries):
+    fake = FakeNanoControl()
+    nc = nanocontrol(fake.port)
+    try:
+        nc.resync()
+        for refresh in (True, False):
+            start = time.perf_counter()
+            for _ in range(queries):
+                for axis in 'ABCD':
+                    nc.getCoarseCounters(axis, refresh=refresh)
+            print("%d coarse counter queries %s: %.3f ms per query" % (
+                queries * 4, 'from the controller' if refresh else 'from the state', (time.perf_counter() - start) / queries / 4 * 1e3))
+    finally:
+        nc.close()
+        fake.close()
+
+def check_fan_out():
+    fakes = [FakeNanoControl(id=str(n)) for n in range(3)]
+    con = controller(ncs={fake.id: nanocontrol(fake.port, timeout=2) for fake in fakes})
+    try:
+        con.assignPattern(blocked_tips=['2'])
+        while con.retractStep() is not None:
+            pass
+        for fake in fakes:
+            moved = any(fake.coarse.values())
+            assert moved == (fake.id != '2'), (fake.id, fake.coarse)
+        result = con.fan_out({'0': ['coarse A 1', 'nope', 'coarse A 1'], '1': ['coarse A 1']})
+        assert result.errors == {'0': 'Exception: unknown command'} and result.replies['0'] == ['coarse A 1']
+        assert result.replies['1'] == ['coarse A 1']
+    finally:
+        con.closeAll()
+        for fake in fakes:
+            fake.close()
+    print("check: fan out to every tip, blocked tips and errors per tip")
+
+def benchmark_fan_out(tips, latency):
+    # every move of a tip takes latency on its controller
+    fakes = [FakeNanoControl(id=str(n), latency=latency) for n in range(tips)]
+    con = controller(ncs={fake.id: nanocontrol(fake.port) for fake in fakes})
+    try:
+        con.assignPattern(blocked_tips=[])
+        start = time.perf_counter()
+        for step in range(len(con.patterns[0])):
+            for nc, pt in con.ncs_pattern:
+                for cmd in con.patterns[pt][step]:
+                    con.ncs[nc].moveCoarse(cmd[0], int(cmd[1:]))
+        serial_time = time.perf_counter() - start
+        con.step = 0
+        start = time.perf_counter()
+        slowest = 0.0
+        while True:
+            result = con.retractStep()
+            if result is None:
+                break
+            slowest += max(result.times.values(), default=0.0)
+        print("%d tips, retract: %.2f s one tip after the other, %.2f s fanned out (sum of the slowest tip per step %.2f s)" % (
+            tips, serial_time, time.perf_counter() - start, slowest))
+    finally:
+        con.closeAll()
+        for fake in fakes:
+            fake.close()
+
+def check_compile():
+    assert channel_scale('3 c01 c02 f01 c01') == {'A': 1, 'B': 2, 'C': None, 'D': 1}
+    scale = channel_scale('3 c01 c02 c01 c01')
+    assert compile_step(['C2', 'A-1'], 1, scale) == ['channel -1 0 2 0']
+    assert compile_step(['C2', 'A-1'], 150, scale) == ['channel -100 0 100 0', 'channel -50 0 100 0', 'channel 0 0 100 0']
+    assert compile_step(['A1', 'C1', 'A1'], 1, scale) == ['channel 1 0 1 0', 'channel 1 0 0 0']
+    assert compile_step(['B4', 'A0'], 1, scale) == ['channel 0 2 0 0']
+    # an odd number of steps on B and fine steps on C stay coarse moves
+    assert compile_step(['B3', 'A1'], 1, scale) == ['coarse B 3', 'coarse A 1']
+    assert compile_step(['C1'], 1, channel_scale('3 c01 c01 f01 c01')) == ['coarse C 1']
+    assert compile_step(['C2', 'A-1'], 1) == ['coarse C 2', 'coarse A -1']
+    # both ways end at the same counters
+    fakes = [FakeNanoControl(id=str(n)) for n in range(2)]
+    con = controller(ncs={fake.id: nanocontrol(fake.port, timeout=2) for fake in fakes})
+    try:
+        positions = []
+        for batch_axes in (False, True):
+            for fake in fakes:
+                fake.coarse = dict.fromkeys('ABCD', 0)
+            con.batch_axes = batch_axes
+            con.assignPattern()
+            con.ncs_pattern = {('0', 0), ('1', 2)}
+            con.compilePattern()
+            con.retract(600)
+            positions.append([dict(fake.coarse) for fake in fakes])
+        assert positions[0] == positions[1] and any(positions[0][0].values()), positions
+        # a speed configuration set after assignPattern is read again before the next step
+        con.assignPattern()
+        con.ncs_pattern = {('0', 0), ('1', 2)}
+        con.compilePattern()
+        con.ncs['0'].setSpeedConfig({'A': ('c', 2), 'B': ('c', 1), 'C': ('c', 1), 'D': ('c', 1)}, 3)
+        for fake in fakes:
+            fake.coarse = dict.fromkeys('ABCD', 0)
+        con.retract(600)
+        assert [dict(fake.coarse) for fake in fakes] == positions[0], [fake.coarse for fake in fakes]
+        assert con.scales['0']['A'] == 2
+    finally:
+        con.closeAll()
+        for fake in fakes:
+            fake.close()
+    print("check: pattern steps compiled into channel commands")
+
+def benchmark_compile(tips, latency):
+    # every command takes latency on its controller, moves are short
+    fakes = [FakeNanoControl(id=str(n), latency=latency) for n in range(tips)]
+    con = controller(ncs={fake.id: nanocontrol(fake.port) for fake in fakes})
+    try:
+        for batch_axes in (False, True):
+            con.batch_axes = batch_axes
+            con.assignPattern()
+            commands = sum(fake.commands for fake in fakes)
+            start = time.perf_counter()
+            con.retract()
+            print("%d tips, retract with %s: %.2f s, %d commands" % (
+                tips, 'channel commands' if batch_axes else 'one coarse move per axis',
+                time.perf_counter() - start, sum(fake.commands for fake in fakes) - commands))
+    finally:
+        con.closeAll()
+        for fake in fakes:
+            fake.close()
+
+def check_discovery():
+    import tempfile
+    fakes = [FakeNanoControl(id=id) for id in ('1', '2', '31')]
+    # a device that does not answer in time and a port of another device
+    silent = FakeNanoControl(id='9', latency=2.0)
+    ports = [FakePortInfo(fake.port, 'N6%04d' % n) for n, fake in enumerate(fakes + [silent])] + [FakePortInfo('/dev/null', 'FTDI')]
+    with tempfile.TemporaryDirectory() as directory:
+        pool = ConnectionPool(os.path.join(directory, 'ports.json'), probe_timeout=0.2, list_ports=lambda: ports)
+        try:
+            con = controller(pool=pool)
+            assert sorted(con.ncs) == ['1', '2'] and list(con.stage) == ['31'] and pool.probed == 4
+            con.closeAll()
+            # the connections of the pool are reused after one exchange
+            reused = dict(pool.connections)
+            con = controller(pool=pool)
+            assert sorted(con.ncs) == ['1', '2'] and pool.probed == 1 and pool.revalidated == 3
+            assert all(pool.connections[port] is nc for port, nc in reused.items())
+            # a connection that does not answer is opened again, a device that stopped answering is dropped
+            fakes[0].drop = 1
+            fakes[2].drop = 2
+            con = controller(pool=pool)
+            assert sorted(con.ncs) == ['1', '2'] and con.stage == {} and pool.revalidation_failures == 2
+            assert con.ncs['1'] is not reused[fakes[0].port] and con.ncs['1'].getInfo()['id'] == '1'
+            pool.close()
+            # a new session probes the ports again
+            pool = ConnectionPool(os.path.join(directory, 'ports.json'), probe_timeout=0.2, list_ports=lambda: ports)
+            con = controller(pool=pool)
+            assert sorted(con.ncs) == ['1', '2'] and list(con.stage) == ['31'] and pool.probed == 4
+        finally:
+            pool.close()
+            for fake in fakes + [silent]:
+                fake.close()
+    print("check: parallel discovery, connection pool probed on reuse")
+
+def benchmark_discovery(tips, latency):
+    import tempfile
+    fakes = [FakeNanoControl(id=str(n), latency=latency) for n in range(1, tips + 1)] + [FakeNanoControl(id='31', latency=latency)]
+    ports = [FakePortInfo(fake.port, 'N6%04d' % n) for n, fake in enumerate(fakes)]
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        for port in ports:
+            nc = nanocontrol(port.device)
+            nc.getInfo()
+            nc.close()
+        one_by_one = time.perf_counter() - start
+        results = []
+        for name in ('first start, probed in parallel', 'reconnect from the pool', 'new session'):
+            if name.startswith('new session'):
+                pool.close()
+            if not name.startswith('reconnect'):
+                pool = ConnectionPool(os.path.join(directory, 'ports.json'), list_ports=lambda: ports)
+            con = controller(pool=pool)
+            results.append("%s %.3f s" % (name, pool.discovery_time))
+            con.closeAll()
+        pool.close()
+    for fake in fakes:
+        fake.close()
+    print("discovery of %d NanoControls: one after the other %.3f s (with the fixed sleep >= %d s), %s" % (
+        len(fakes), one_by_one, len(fakes), ', '.join(results)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the driver and measure it against a fake NanoControl on a pty")
+    parser.add_argument('-commands', default=200, type=int, help='commands per measurement')
+    parser.add_argument('-latency', default=0.002, type=float, help='reply latency of the fake in s')
+    parser.add_argument('-tips', default=8, type=int, help='fake controllers of the retract benchmark')
+    parser.add_argument('-move_time', default=0.05, type=float, help='time of a move of the fake controllers in s')
+    args = parser.parse_args()
+    check()
+    check_state()
+    check_fan_out()
+    check_discovery()
+    check_compile()
+    benchmark(args.commands, args.latency)
+    benchmark_discovery(args.tips, args.move_time)
+    benchmark_state(args.commands // 4)
+    benchmark_fan_out(args.tips, args.move_time)
+    benchmark_compile(args.tips, args.move_time)
+#%%
@@ -0,0 +1,59 @@
+"""
+Batched parameters of the SmartSEM API control, used by SEM_API and
+SEM_API_CUSTOM for get_many/set_many.
+
+The control reports API_E_GET_MULTI_FAIL/API_E_SET_MULTI_FAIL, so it has
+calls for several parameters at once. They are assumed as
+GetMulti(names, buffers) -> (code, values) and SetMulti(names, values) -> code,
+if the control does not have them (or they fail) every parameter is
+read/set with its own Get/Set.
+"""
+API_E_NOT_IMPLEMENTED = 1026
+
+
+def scanrate_index(value):
+    """n of CMD_SCANRATE<n> as string, None for a scan rate label that is not an index."""
+    try:
+        return str(int(float(value)))
+    except (TypeError, ValueError):
+        return None
+
+def same_value(name, a, b):
+    """
+    True if a and b are the same setting of parameter name, AP values are
+    compared as numbers, DP_SCANRATE as the index of its command.
+    """
+    if name == "DP_SCANRATE":
+        a = scanrate_index(a)
+        return a is not None and a == scanrate_index(b)
+    if name.startswith("AP_"):
+        try:
+            return float(a) == float(b)
+        except (TypeError, ValueError):
+            pass
+    return str(a) == str(b)
+
+def get_buffers(names):
+    """Buffers of GetMulti, AP values are read as float and DP values as string."""
+    return [0.0 if name.startswith("AP_") else '' for name in names]
+
+def call_multi(owner, control, call, *args):
+    """
+    control.<call>(*args) (GetMulti or SetMulti), its result or None if it
+    failed. owner.multi_supported is set on the first call, after the control
+    reported that it does not have the call it is not tried again.
+    """
+    if owner.multi_supported is False:
+        return None
+    try:
+        res = getattr(control, call)(*args)
+    except Exception:
+        owner.multi_supported = False
+        return None
+    code = res if type(res) == int else res[0]
+    if code == API_E_NOT_IMPLEMENTED:
+        owner.multi_supported = False
+    if code != 0:
+        return None
+    owner.multi_supported = True
+    return res
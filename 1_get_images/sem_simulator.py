@@ -0,0 +1,595 @@
+"""
+Simulated SEM with the interface of the CZ.EMApiCtrl control.
+
+SEM_API and SEM_API_CUSTOM take it as backend, so the acquisition code runs
+without the microscope and without pywin32:
+
+    sem = SEM_API_CUSTOM(backend=SimulatedEMApi(time_scale=0.01))
+    with SEM_API(state='remote', backend=SimulatedEMApi()) as sem:
+        ...
+
+The calls return the codes of the real control (0, or the API_E_* number)
+and tuples for the calls with buffers. Every call takes call_latency s.
+A changed parameter blocks Set for its settle time (the cost model of
+acquisition_order), a scan takes AP_FRAME_TIME, which follows from the scan
+rate and the image store. Stage moves, autofocus and the end of a frame
+change DP_STAGE_IS, DP_AUTO_FN_STATUS and DP_FROZEN in the background. All
+physical times are multiplied by time_scale.
+
+Grab writes a synthetic frame, a grey bmp, a tif with the CZ_SEM header or
+the uint16 pixel store into the shared memory block CZ.MMF. Notifications
+set with SetNotify are delivered to the event sinks (getevents/WithEvents)
+on a background thread after notify_latency s. console() changes a
+parameter like a user at the microscope.
+
+python sem_simulator.py load tests both wrappers with the simulator.
+"""
+import os
+import time
+import heapq
+import struct
+import argparse
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+
+from acquisition_order import DEFAULT_COSTS
+
+# analog parameters: default, (min, max), unit of the string representation
+ANALOG = {
+    'AP_MAG': (5000.0, (10.0, 1e6), 'X'),
+    'AP_WD': (0.0085, (0.0, 0.05), 'm'),
+    'AP_SCANROTATION': (0.0, (0.0, 360.0), 'deg'),
+    'AP_STAGE_AT_X': (0.0, (0.0, 0.13), 'm'),
+    'AP_STAGE_AT_Y': (0.0, (0.0, 0.13), 'm'),
+    'AP_STAGE_AT_Z': (0.025, (0.0, 0.05), 'm'),
+    'AP_STAGE_AT_T': (0.0, (-4.0, 70.0), 'deg'),
+    'AP_STAGE_AT_R': (0.0, (0.0, 360.0), 'deg'),
+    'AP_STAGE_AT_M': (0.0, (0.0, 0.01), 'm'),
+    'AP_FRAME_TIME': (0.0, (0.0, 1e7), 'ms'),
+    'AP_IMAGE_PIXEL_SIZE': (0.0, (0.0, 1e-3), 'm'),
+}
+# digital parameters: default, possible states (the index is the 'int' style value)
+DIGITAL = {
+    'DP_DETECTOR_CHANNEL': ('InLens', ('InLens', 'SE2', 'ESB', 'AsB')),
+    'DP_SCANRATE': ('5', tuple(str(n) for n in range(16))),
+    'DP_FROZEN': ('Frozen', ('Live', 'Frozen')),
+    'DP_FREEZE_ON': ('End Frame', ('Command', 'End Frame', 'End Line')),
+    'DP_NOISE_REDUCTION': ('Pixel Avg.', ('Pixel Avg.', 'Frame Avg', 'Frame Int. Busy', 'Frame Int. Done', 'Line Avg',
+                                          'Line Int. Busy', 'Line Int. Done', 'Continuous Avg.',
+                                          'Drift Comp. Frame Int. Busy', 'Drift Comp. Frame Int. Done', 'Drift Comp. Frame Avg.')),
+    'DP_IMAGE_STORE': ('1024 * 768', ('512 * 384', '1024 * 768', '2048 * 1536', '3072 * 2304')),
+    'DP_SCAN_ROT': ('Off', ('Off', 'On')),
+    'DP_STAGE_IS': ('Idle', ('Idle', 'Busy')),
+    'DP_AUTO_FN_STATUS': ('Idle', ('Idle', 'Busy')),
+    'DP_AUTOFOCUS_VERSION': ('Line Scan based Autofocus Version', ('Standard Autofocus Version', 'Line Scan based Autofocus Version')),
+}
+NOISE_REDUCTION_COMMANDS = {
+    'CMD_PIXNR': 'Pixel Avg.',
+    'CMD_FRAME_AVERAGE': 'Frame Avg',
+    'CMD_FRAME_INT': 'Frame Int. Done',
+    'CMD_LINE_AVG': 'Line Avg',
+    'CMD_LINE_INT': 'Line Int. Done',
+    'CMD_CONTINUOUS_AVG': 'Continuous Avg.',
+    'CMD_DC_FRAME_INT': 'Drift Comp. Frame Int. Done',
+    'CMD_DC_FRAME_AVG': 'Drift Comp. Frame Avg.',
+}
+STAGE_AXES = ['AP_STAGE_AT_X', 'AP_STAGE_AT_Y', 'AP_STAGE_AT_Z', 'AP_STAGE_AT_T', 'AP_STAGE_AT_R', 'AP_STAGE_AT_M']
+# seconds until a changed parameter is settled, like the switching costs of a sweep
+SETTLE = {'AP_MAG': DEFAULT_COSTS['mag'], 'AP_SCANROTATION': DEFAULT_COSTS['rot'],
+          'DP_DETECTOR_CHANNEL': DEFAULT_COSTS['detector'], 'DP_SCANRATE': DEFAULT_COSTS['scanrate'],
+          'AP_WD': DEFAULT_COSTS['wd']}
+DWELL_TIME = 50e-9 # pixel dwell time of scan rate 0 in s, it doubles with every step
+FIELD_WIDTH = 0.127 # field width at mag 1 in m
+MAG_PREFIX = [(1e6, 'M'), (1e3, 'K')]
+
+
+def parse_number(value):
+    """5000, '5000', '5.00 K X' or '8.5 mm' -> float in the base unit"""
+    if not isinstance(value, str):
+        return float(value)
+    tokens = value.split()
+    number = float(tokens[0])
+    if len(tokens) > 1:
+        number *= {'K': 1e3, 'M': 1e6, 'mm': 1e-3, 'µm': 1e-6, 'um': 1e-6, 'nm': 1e-9}.get(tokens[1], 1.0)
+    return number
+
+def format_analog(name, value):
+    """string style of an analog value, like the console shows it"""
+    unit = ANALOG[name][2]
+    if name == 'AP_MAG':
+        for factor, prefix in MAG_PREFIX:
+            if value >= factor:
+                return '%.2f %s X' % (value / factor, prefix)
+        return '%d X' % value
+    if unit == 'm':
+        for factor, prefix in [(1e-3, 'mm'), (1e-6, 'µm'), (1e-9, 'nm')]:
+            if abs(value) >= factor:
+                return '%.3f %s' % (value / factor, prefix)
+        return '%.3f pm' % (value / 1e-12)
+    return '%.1f %s' % (value, unit)
+
+def write_bmp(path, pixels):
+    """uint8 grey image as 8 bit bmp with a grey palette"""
+    height, width = pixels.shape
+    stride = (width + 3) & ~3
+    offset = 14 + 40 + 256 * 4
+    size = offset + stride * height
+    rows = np.zeros((height, stride), dtype=np.uint8)
+    rows[:, :width] = pixels[::-1]
+    palette = np.repeat(np.arange(256, dtype=np.uint8)[:, None], 4, axis=1)
+    palette[:, 3] = 0
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<2sIHHI', b'BM', size, 0, 0, offset))
+        f.write(struct.pack('<IiiHHIIiiII', 40, width, height, 1, 8, 0, stride * height, 2835, 2835, 256, 0))
+        f.write(palette.tobytes())
+        f.write(rows.tobytes())
+
+
+class SimulatedEMApi():
+    """
+    Stand-in for Dispatch('CZ.EMApiCtrl.1'), see the module docstring.
+    settle: seconds per changed parameter, updates SETTLE
+    multi: support GetMulti/SetMulti, otherwise they return API_E_NOT_IMPLEMENTED
+    """
+    def __init__(self, time_scale=1.0, call_latency=0.002, notify_latency=0.005, grab_latency=0.05,
+                 settle=None, stage_speed=0.005, autofocus_time=3.0, multi=True, seed=0):
+        self.time_scale = time_scale
+        self.call_latency = call_latency
+        self.notify_latency = notify_latency
+        self.grab_latency = grab_latency
+        self.settle = dict(SETTLE, **(settle or {}))
+        self.stage_speed = stage_speed # m/s, the angles move 10 deg/s
+        self.autofocus_time = autofocus_time
+        self.multi = multi
+        self.rng = np.random.default_rng(seed)
+        self.calls = 0
+        self.values = {name: default for name, (default, _, _) in ANALOG.items()}
+        self.values.update({name: default for name, (default, _) in DIGITAL.items()})
+        self.ids = {name: n for n, name in enumerate(self.values)}
+        self.notify = set()
+        self.sinks = []
+        self.initialised = False
+        self.__lock = threading.RLock()
+        self.__scan = 0 # number of the current scan, a freeze scheduled for an older one is dropped
+        self.__frame_end = time.monotonic()
+        self.__events = []
+        self.__event_seq = 0
+        self.__event_condition = threading.Condition()
+        self.__event_thread = None
+        self.__shm = None
+        self.__pattern_key = None
+        self.__pattern = None
+        self.__update_frame_time()
+
+    # background events
+    def __schedule(self, delay, func):
+        with self.__event_condition:
+            if self.__event_thread is None:
+                self.__event_thread = threading.Thread(target=self.__run_events, daemon=True)
+                self.__event_thread.start()
+            self.__event_seq += 1
+            heapq.heappush(self.__events, (time.monotonic() + delay, self.__event_seq, func))
+            self.__event_condition.notify()
+    def __run_events(self):
+        while True:
+            with self.__event_condition:
+                while not self.__events or self.__events[0][0] > time.monotonic():
+                    if self.__event_thread is None:
+                        return
+                    timeout = self.__events[0][0] - time.monotonic() if self.__events else None
+                    self.__event_condition.wait(timeout)
+                _, _, func = heapq.heappop(self.__events)
+            func()
+
+    def __change(self, name, value):
+        with self.__lock:
+            changed = self.values[name] != value
+            self.values[name] = value
+            if name in ('DP_SCANRATE', 'DP_IMAGE_STORE', 'AP_MAG'):
+                self.__update_frame_time()
+        if changed and name in self.notify:
+            last = float(value) if name in ANALOG else 0.0
+            self.__schedule(self.notify_latency, lambda: self.__deliver(name, last))
+    def __deliver(self, name, last):
+        for sink in list(self.sinks):
+            sink.OnNotifyWithCurrentValue(name, 0, self.ids[name], last)
+    def __update_frame_time(self):
+        width, height = self.store()
+        self.values['AP_FRAME_TIME'] = width * height * DWELL_TIME * 2 ** int(self.values['DP_SCANRATE']) * 1e3
+        self.values['AP_IMAGE_PIXEL_SIZE'] = FIELD_WIDTH / self.values['AP_MAG'] / width
+
+    def store(self):
+        return tuple(int(n) for n in self.values['DP_IMAGE_STORE'].split('*'))
+    def frame_time(self):
+        """time of one frame in s, already scaled"""
+        return self.values['AP_FRAME_TIME'] / 1e3 * self.time_scale
+    def __call(self):
+        self.calls += 1
+        if self.call_latency:
+            time.sleep(self.call_latency)
+        return 0 if self.initialised else 1019
+
+    def console(self, name, value):
+        """change a parameter like a user at the console, without settle time"""
+        self.__change(name, parse_number(value) if name in ANALOG else value)
+
+    # connection
+    def InitialiseRemoting(self):
+        self.calls += 1
+        self.initialised = True
+        return 0
+    def ClosingControl(self):
+        self.initialised = False
+        with self.__event_condition:
+            self.__event_thread = None
+            self.__events = []
+            self.__event_condition.notify()
+        if self.__shm is not None:
+            self.__shm.close()
+            self.__shm.unlink()
+            self.__shm = None
+        return 0
+    def GetVersion(self):
+        return (self.__call(), 'SimulatedEMApi')
+    def GetCurrentUserName(self, em_user, windows_user):
+        return (self.__call(), 'simulator', os.environ.get('USER', os.environ.get('USERNAME', '')))
+
+    # parameters
+    def Get(self, name, buffer):
+        res = self.__call()
+        if res != 0:
+            return (res, buffer)
+        return self.__get(name, buffer)
+    def __get(self, name, buffer):
+        with self.__lock:
+            if name in ANALOG:
+                value = self.values[name]
+                return (0, format_analog(name, value) if isinstance(buffer, str) else value)
+            if name in DIGITAL:
+                value = self.values[name]
+                return (0, value if isinstance(buffer, str) else DIGITAL[name][1].index(value))
+        return (1000, buffer)
+    def Set(self, name, value):
+        res = self.__call()
+        if res != 0:
+            return res
+        return self.__set(name, value)
+    def __set(self, name, value):
+        if name in ANALOG:
+            if name in ('AP_FRAME_TIME', 'AP_IMAGE_PIXEL_SIZE'):
+                return 1006
+            try:
+                value = parse_number(value)
+            except (ValueError, IndexError):
+                return 1009
+            low, high = ANALOG[name][1]
+            if value < low:
+                return 1007
+            if value > high:
+                return 1008
+        elif name in DIGITAL:
+            states = DIGITAL[name][1]
+            if not isinstance(value, str):
+                if not 0 <= int(value) < len(states):
+                    return 1005
+                value = states[int(value)]
+            if value not in states:
+                return 1005
+        else:
+            return 1004
+        if self.values[name] != value and name in self.settle:
+            time.sleep(self.settle[name] * self.time_scale)
+        self.__change(name, value)
+        return 0
+    def GetLimits(self, name, low, high):
+        res = self.__call()
+        if res != 0:
+            return (res, low, high)
+        if name not in ANALOG:
+            return (1022, low, high)
+        return (0,) + ANALOG[name][1]
+    def GetMulti(self, names, buffers):
+        res = self.__call()
+        if res != 0:
+            return (res, buffers)
+        if not self.multi:
+            return (1026, buffers)
+        values = []
+        for name, buffer in zip(names, buffers):
+            res = self.__get(name, buffer)
+            if res[0] != 0:
+                return (1023, buffers)
+            values.append(res[1])
+        return (0, tuple(values))
+    def SetMulti(self, names, values):
+        res = self.__call()
+        if res != 0:
+            return res
+        if not self.multi:
+            return 1026
+        for name, value in zip(names, values):
+            if self.__set(name, value) != 0:
+                return 1024
+        return 0
+    def SetNotify(self, name, on):
+        res = self.__call()
+        if res != 0:
+            return res
+        if name not in self.values:
+            return 1020
+        if on:
+            self.notify.add(name)
+        else:
+            self.notify.discard(name)
+        return 0
+
+    # commands
+    def Execute(self, command):
+        res = self.__call()
+        if res != 0:
+            return res
+        if command.startswith('CMD_SCANRATE') and command[12:] in DIGITAL['DP_SCANRATE'][1]:
+            return self.__set('DP_SCANRATE', command[12:])
+        if command in NOISE_REDUCTION_COMMANDS:
+            self.__change('DP_NOISE_REDUCTION', NOISE_REDUCTION_COMMANDS[command])
+        elif command == 'CMD_UNFREEZE_ALL':
+            self.__start_scan()
+        elif command == 'CMD_FREEZE_ALL':
+            self.__freeze_at(self.__scan, self.__frame_end - time.monotonic())
+        elif command in ('CMD_AUTO_FOCUS_FINE', 'CMD_AUTO_FOCUS_COARSE'):
+            self.__change('DP_AUTO_FN_STATUS', 'Busy')
+            self.__schedule(self.autofocus_time * self.time_scale, lambda: self.__change('DP_AUTO_FN_STATUS', 'Idle'))
+        elif command != 'CMD_MODE_NORMAL':
+            return 1011
+        return 0
+    def __start_scan(self):
+        with self.__lock:
+            self.__scan += 1
+            self.__frame_end = time.monotonic() + self.frame_time()
+        self.__change('DP_FROZEN', 'Live')
+        if self.values['DP_FREEZE_ON'] == 'End Frame':
+            self.__freeze_at(self.__scan, self.frame_time())
+    def __freeze_at(self, scan, delay):
+        def freeze():
+            if scan == self.__scan:
+                self.__change('DP_FROZEN', 'Frozen')
+        self.__schedule(max(delay, 0.0), freeze)
+
+    # stage
+    def GetStagePosition(self, *buffers):
+        res = self.__call()
+        with self.__lock:
+            return (res,) + tuple(self.values[axis] for axis in STAGE_AXES)
+    def MoveStage(self, x, y, z, t, r, m):
+        res = self.__call()
+        if res != 0:
+            return res
+        target = (x, y, z, t, r, m)
+        for axis, value in zip(STAGE_AXES, target):
+            low, high = ANALOG[axis][1]
+            if not low <= value <= high:
+                return 1018
+        # linear axes with stage_speed, the angles with 10 deg/s
+        duration = max(abs(value - self.values[axis]) / (10.0 if ANALOG[axis][2] == 'deg' else self.stage_speed)
+                       for axis, value in zip(STAGE_AXES, target))
+        self.__change('DP_STAGE_IS', 'Busy')
+        def arrive():
+            for axis, value in zip(STAGE_AXES, target):
+                self.__change(axis, value)
+            self.__change('DP_STAGE_IS', 'Idle')
+        self.__schedule(duration * self.time_scale, arrive)
+        return 0
+
+    # images
+    def frame(self, width, height):
+        """synthetic uint16 frame of the current parameters"""
+        with self.__lock:
+            key = (width, height, self.values['AP_MAG'], self.values['AP_WD'], self.values['AP_SCANROTATION'],
+                   self.values['DP_DETECTOR_CHANNEL'])
+            scanrate = int(self.values['DP_SCANRATE'])
+        # the noise free image only changes with the parameters
+        if key != self.__pattern_key:
+            self.__pattern = self.pattern(*key)
+            self.__pattern_key = key
+        image = self.rng.standard_normal(self.__pattern.shape, dtype=np.float32)
+        image *= 0.25 / 2 ** (scanrate / 2)
+        image += self.__pattern
+        return (np.clip(image, 0.0, 1.0) * 65535).astype(np.uint16)
+    @staticmethod
+    def pattern(width, height, mag, wd, rot, detector):
+        # lattice of particles (1 µm pitch) in sample coordinates, rotated like the scan
+        pixel = FIELD_WIDTH / mag / width
+        y, x = np.mgrid[-height // 2:height - height // 2, -width // 2:width - width // 2].astype(np.float32) * pixel
+        angle = np.deg2rad(rot)
+        u = x * np.cos(angle) - y * np.sin(angle)
+        v = x * np.sin(angle) + y * np.cos(angle)
+        pitch = 1e-6
+        distance = np.hypot((u % pitch) - pitch / 2, (v % pitch) - pitch / 2) / pitch
+        image = np.where(distance < 0.3, 0.8, 0.3).astype(np.float32)
+        if detector != 'InLens':
+            # topographic contrast, the side facing the detector is brighter
+            image += 0.15 * np.clip((u % pitch) / pitch - 0.5, -0.5, 0.5)
+        # out of focus (the default WD is in focus) reduces the contrast
+        return 0.5 + (image - 0.5) * np.float32(np.exp(-abs(wd - ANALOG['AP_WD'][0]) / 5e-4))
+
+    def header(self):
+        """CZ_SEM tag text of the current parameters"""
+        with self.__lock:
+            lines = ['0', '0']
+            for name, label in [('AP_MAG', 'Mag'), ('AP_WD', 'WD'), ('AP_SCANROTATION', 'Scan Rotation'),
+                                ('AP_IMAGE_PIXEL_SIZE', 'Image Pixel Size'), ('AP_FRAME_TIME', 'Frame Time')]:
+                lines += [name, '%s = %s' % (label, format_analog(name, self.values[name]).replace('µ', 'u'))]
+            lines += ['DP_DETECTOR_CHANNEL', 'Signal A = %s' % self.values['DP_DETECTOR_CHANNEL'],
+                      'DP_SCANRATE', 'Scan Speed = %s' % self.values['DP_SCANRATE']]
+        return '\r\n'.join(lines) + '\x00'
+
+    def Grab(self, X, Y, W, H, overlay, fname):
+        res = self.__call()
+        if res != 0:
+            return res
+        if self.grab_latency:
+            time.sleep(self.grab_latency * self.time_scale)
+        if fname == 'CZ.MMF':
+            # pixel store in full size, W == 0 releases the block like SEM_API does on exit
+            if W == 0:
+                return 0
+            width, height = self.store()
+            size = width * height * 2
+            if self.__shm is None or self.__shm.size < size:
+                if self.__shm is not None:
+                    self.__shm.close()
+                    self.__shm.unlink()
+                self.__shm = shared_memory.SharedMemory(fname, create=True, size=size)
+            np.ndarray((height, width), dtype=np.uint16, buffer=self.__shm.buf)[:] = self.frame(width, height)
+            return 0
+        pixels = (self.frame(1024, 768)[Y:Y + H, X:X + W] >> 8).astype(np.uint8)
+        try:
+            if fname.lower().endswith(('.tif', '.tiff')):
+                import tifffile
+                tifffile.imwrite(fname, pixels, extratags=[(34118, 's', 0, self.header(), True)])
+            else:
+                write_bmp(fname, pixels)
+        except OSError:
+            return 1016
+        return 0
+
+    # event sinks, the counterparts of win32com.client.getevents and WithEvents
+    def getevents(self):
+        simulator = self
+        class SimulatedEvents():
+            def __init__(self, control):
+                simulator.sinks.append(self)
+            def close(self):
+                if self in simulator.sinks:
+                    simulator.sinks.remove(self)
+        return SimulatedEvents
+    def WithEvents(self, user_class):
+        sink = user_class()
+        self.sinks.append(sink)
+        return sink
+
+
+def load_test(time_scale, shots, frames):
+    import tempfile
+    import shutil
+    from SEM_API import SEM_API
+    from SEM_API_CUSTOM import SEM_API_CUSTOM
+    from augmentor import augmentor
+
+    # live image and waits of SEM_API in remote mode
+    control = SimulatedEMApi(time_scale=time_scale)
+    with SEM_API(state='remote', backend=control) as sem:
+        sem.update_rate = 0.01
+        sem.UpdateImage_Start()
+        start = time.perf_counter()
+        for _ in range(frames):
+            frame = sem.frames.wait_next(timeout=5)
+        elapsed = time.perf_counter() - start
+        sem.UpdateImage_Pause()
+        print("SEM_API: %d live frames %s in %.2f s" % (frames, frame.array.shape, elapsed), end=", ")
+        sem.grab_backend.timings.print_stats()
+        start = time.perf_counter()
+        sem.MoveStage((0.01, 0.01, 0.025, 0.0, 0.0, 0.0))
+        sem.wait_for_stage_idle(timeout=10)
+        sem.set_scan_speed(3)
+        sem.Execute("CMD_UNFREEZE_ALL")
+        sem.wait_for_frozen(timeout=10)
+        print("SEM_API: stage move and frame in %.2f s, %d calls" % (time.perf_counter() - start, control.calls))
+
+    # augmentor sweep through SEM_API_CUSTOM with and without GetMulti/SetMulti
+    directory = tempfile.mkdtemp()
+    try:
+        for multi in (True, False):
+            control = SimulatedEMApi(time_scale=time_scale, multi=multi)
+            sem = SEM_API_CUSTOM(backend=control)
+            sem.openConnection()
+            sem.getInitialParameters()
+            dataset_path = os.path.join(directory, 'multi%d' % multi)
+            os.mkdir(dataset_path)
+            aug = augmentor(sem)
+            aug.setParameters(dataset_path, 0.005, [5000, 1000, 10000][:shots], ['0', '45'], ['InLens', 'SE2'], ['1', '3'])
+            start = time.perf_counter()
+            aug.grabMasks()
+            aug.grabImages()
+            print("SEM_API_CUSTOM (multi %s): %d files in %.2f s, %d calls" % (
+                multi, len(aug.pipeline.results), time.perf_counter() - start, control.calls))
+            sem.cache.print_stats()
+            aug.pipeline.print_stats()
+            aug.pipeline.close()
+            sem.restoreInitialParameters()
+            sem.closeConnection()
+    finally:
+        shutil.rmtree(directory)
+
+def check():
+    import tempfile
+    from grab_backend import decode_bmp
+    from tiff_catalog import read_entry
+    control = SimulatedEMApi(time_scale=0.001, call_latency=0)
+    assert control.Get('AP_MAG', 0.0)[0] == 1019
+    control.InitialiseRemoting()
+    assert control.Set('AP_MAG', '10.00 K X') == 0 and control.Get('AP_MAG', 0.0) == (0, 10000.0)
+    assert control.Get('AP_MAG', '') == (0, '10.00 K X')
+    assert control.Set('AP_MAG', 1e9) == 1008 and control.Set('AP_NOPE', 1) == 1004 and control.Get('DP_NOPE', '')[0] == 1000
+    assert control.Set('DP_DETECTOR_CHANNEL', 1) == 0 and control.Get('DP_DETECTOR_CHANNEL', '') == (0, 'SE2')
+    assert control.Execute('CMD_SCANRATE7') == 0 and control.Get('DP_SCANRATE', '') == (0, '7')
+    assert control.Get('AP_FRAME_TIME', 0.0)[1] == 1024 * 768 * DWELL_TIME * 2 ** 7 * 1e3
+    events = []
+    class Sink():
+        def OnNotifyWithCurrentValue(self, name, reason, paramid, last):
+            events.append((name, last))
+    control.WithEvents(Sink)
+    control.SetNotify('DP_FROZEN', True)
+    control.SetNotify('AP_WD', True)
+    control.Execute('CMD_UNFREEZE_ALL')
+    control.console('AP_WD', '9 mm')
+    time.sleep(control.frame_time() + 0.1)
+    assert control.Get('DP_FROZEN', '') == (0, 'Frozen')
+    assert [(name, round(last, 6)) for name, last in events] == [('DP_FROZEN', 0.0), ('AP_WD', 0.009), ('DP_FROZEN', 0.0)], events
+    with tempfile.TemporaryDirectory() as directory:
+        assert control.Grab(0, 0, 1024, 768, 0, os.path.join(directory, 'live.bmp')) == 0
+        with open(os.path.join(directory, 'live.bmp'), 'rb') as f:
+            assert decode_bmp(f.read()).shape == (768, 1024)
+        assert control.Grab(0, 0, 1024, 768, 0, os.path.join(directory, 'image.tif')) == 0
+        entry = read_entry(os.path.join(directory, 'image.tif'))
+        assert entry['mag'] == 10000.0 and entry['detector'] == 'SE2' and entry['scan_rate'] == '7', entry
+    control.ClosingControl()
+    print("check: parameters, commands, notifications and grabbed files of the simulator")
+
+def check_cache():
+    from SEM_API_CUSTOM import SEM_API_CUSTOM
+    control = SimulatedEMApi(time_scale=0.001, call_latency=0)
+    sem = SEM_API_CUSTOM(backend=control)
+    sem.openConnection()
+    sem.getInitialParameters()
+    cache = sem.cache
+    params = {"AP_MAG": "5000", "AP_SCANROTATION": "45", "DP_DETECTOR_CHANNEL": "SE2", "DP_SCANRATE": "3", "AP_WD": 0.006}
+    sem.set_many(params)
+    sem.set_many(dict(params, AP_MAG="1000", DP_DETECTOR_CHANNEL="InLens", DP_SCANRATE="4"))
+    time.sleep(0.05)
+    # the notifications of our own sets do not invalidate the cache
+    assert sem.set_many(dict(params, AP_MAG="1000", DP_DETECTOR_CHANNEL="InLens", DP_SCANRATE="4")) == []
+    assert cache.refreshed == 0 and cache.invalidated == 0 and cache.values["DP_SCANRATE"] == "4", cache.values
+    # changes at the console do
+    control.console('AP_MAG', '2000')
+    control.console('DP_DETECTOR_CHANNEL', 'SE2')
+    control.console('DP_SCANRATE', '6')
+    time.sleep(0.05)
+    assert sem.set_many(dict(params, AP_MAG="1000", DP_DETECTOR_CHANNEL="InLens", DP_SCANRATE="4")) == ["AP_MAG", "DP_DETECTOR_CHANNEL", "DP_SCANRATE"]
+    assert cache.invalidated == 3 and cache.refreshed == 3
+    # a scan rate label is not cached, the next set is sent
+    cache.put("DP_SCANRATE", "Scan Speed 4")
+    assert "DP_SCANRATE" not in cache.values and sem.set_many({"DP_SCANRATE": "4"}) == ["DP_SCANRATE"]
+    sem.closeConnection()
+    print("check: parameter cache ignores its own notifications and sees changes at the console")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the simulated SEM and load test SEM_API and SEM_API_CUSTOM with it")
+    parser.add_argument('-time_scale', default=0.01, type=float, help='factor of the simulated times')
+    parser.add_argument('-mags', default=3, type=int, help='number of magnifications of the augmentor sweep (1-3)')
+    parser.add_argument('-frames', default=50, type=int, help='live frames of SEM_API')
+    args = parser.parse_args()
+    check()
+    check_cache()
+    load_test(args.time_scale, args.mags, args.frames)
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from zeiss_tiff_header_interpreter import read_zeiss_tags
+
+# factors to the unit stored in the catalog
+LENGTH_NM = {'pm': 1e-3, 'nm': 1.0, 'µm': 1e3, 'um': 1e3, 'mm': 1e6}
+LENGTH_MM = {key: value * 1e-6 for key, value in LENGTH_NM.items()}
+MAG_PREFIX = {'': 1.0, 'K': 1e3, 'M': 1e6}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    pixel_size REAL,    -- nm
+    mag REAL,           -- 5.00 K X is stored as 5000
+    wd REAL,            -- mm
+    detector TEXT,
+    scan_rate TEXT,
+    header TEXT,        -- json of the CZ_SEM tag, only with -store_header
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS images_detector_mag ON images (detector, mag);
+"""
+COLUMNS = ['path', 'mtime', 'size', 'pixel_size', 'mag', 'wd', 'detector', 'scan_rate', 'header', 'error']
+
+
+def quantity(entry, units):
+    """('WD', 8.5, 'mm') or ('WD', '8.5 mm') -> value in the unit of the units table, None if unknown."""
+    if entry is None:
+        return None
+    if len(entry) == 3:
+        value, unit = entry[1], entry[2]
+    else:
+        value, _, unit = str(entry[1]).partition(' ')
+    try:
+        return float(value) * units[unit.strip()]
+    except (ValueError, KeyError):
+        return None
+def magnification(entry):
+    """('Mag', '5.00 K X') -> 5000.0"""
+    if entry is None:
+        return None
+    tokens = str(entry[1]).split() + list(entry[2:])
+    try:
+        return float(tokens[0]) * MAG_PREFIX[tokens[1] if len(tokens) > 2 else '']
+    except (ValueError, KeyError, IndexError):
+        return None
+def text(entry):
+    return None if entry is None else str(entry[1])
+
+def read_entry(path, store_header=False):
+    """Catalog fields of one file, the stat fields are filled in by the caller."""
+    row = dict.fromkeys(COLUMNS)
+    row['path'] = path
+    try:
+        tags, _ = read_zeiss_tags(path)
+    except Exception as e:
+        row['error'] = "%s: %s" % (type(e).__name__, e)
+        return row
+    row['pixel_size'] = quantity(tags.get('ap_image_pixel_size'), LENGTH_NM)
+    row['mag'] = magnification(tags.get('ap_mag'))
+    row['wd'] = quantity(tags.get('ap_wd'), LENGTH_MM)
+    row['detector'] = text(tags.get('dp_detector_channel'))
+    row['scan_rate'] = text(tags.get('dp_scanrate'))
+    if store_header:
+        row['header'] = json.dumps({key: value for key, value in tags.items() if key}, default=str)
+    return row
+
+def scan_tree(root):
+    """(path, mtime, size) of every tif below root, DirEntry.stat is free on windows."""
+    stack = [root]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError as e:
+            print(e)
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.lower().endswith(('.tif', '.tiff')):
+                stat = entry.stat()
+                yield entry.path, stat.st_mtime, stat.st_size
+
+
+class TiffCatalog():
+    """
+    SQLite catalog of the SEM parameters of the tif files in a directory tree.
+    update() only reads the tags of new or changed files (mtime and size) and
+    removes files that are gone, so a rescan of an archive costs one directory
+    walk. Files that can not be read are stored with their error and retried
+    when they change.
+
+    catalog = TiffCatalog('catalog.sqlite')
+    catalog.update(r'R:\\images', workers=16)
+    catalog.query("detector = 'InLens' AND mag BETWEEN 4900 AND 5100")
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(SCHEMA)
+
+    def update(self, root, workers=16, store_header=False, batch_size=1000):
+        start = time.perf_counter()
+        root = os.path.abspath(root)
+        # only files below root, not the ones of a sibling like R:\images2
+        prefix = os.path.join(root, '')
+        known = {path: (mtime, size) for path, mtime, size in self.connection.execute(
+            "SELECT path, mtime, size FROM images WHERE path >= ? AND path < ?", (prefix, prefix + '\uffff'))}
+        found = set()
+        todo = []
+        for path, mtime, size in scan_tree(root):
+            found.add(path)
+            if known.get(path) != (mtime, size):
+                todo.append((path, mtime, size))
+        removed = [(path,) for path in known.keys() - found]
+        self.connection.executemany("DELETE FROM images WHERE path = ?", removed)
+        walked = time.perf_counter()
+
+        # reading the tags is io bound (network share), sqlite is only written from this thread
+        errors = 0
+        insert = "INSERT OR REPLACE INTO images VALUES (%s)" % ", ".join("?" * len(COLUMNS))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            rows = []
+            for (path, mtime, size), row in zip(todo, pool.map(lambda item: read_entry(item[0], store_header), todo)):
+                row['mtime'], row['size'] = mtime, size
+                errors += row['error'] is not None
+                rows.append([row[column] for column in COLUMNS])
+                if len(rows) >= batch_size:
+                    self.connection.executemany(insert, rows)
+                    self.connection.commit()
+                    rows = []
+            self.connection.executemany(insert, rows)
+        self.connection.commit()
+
+        print("Catalog %s: %d files, %d read (%d errors), %d removed, walk %.1f s, read %.1f s" % (
+            self.db_path, len(found), len(todo), errors, len(removed), walked - start, time.perf_counter() - walked))
+        return len(todo)
+
+    def query(self, where="1", params=()):
+        """Paths of the files matching an sql condition on the catalog columns."""
+        return [path for path, in self.connection.execute("SELECT path FROM images WHERE %s ORDER BY path" % where, params)]
+
+    def close(self):
+        self.connection.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Index the SEM parameters of ZEISS tif files into a SQLite catalog")
+    parser.add_argument('-db', required=True, type=str, help='catalog file (ie: R:\\images\\catalog.sqlite)')
+    parser.add_argument('-root', type=str, nargs='*', default=[], help='directories to scan (ie: R:\\images)')
+    parser.add_argument('-workers', default=16, type=int, help='number of threads reading the tags')
+    parser.add_argument('-store_header', action='store_true', help='also store the complete CZ_SEM tag as json')
+    parser.add_argument('-query', type=str, help="sql condition (ie: \"detector = 'InLens' AND mag = 5000\")")
+    args = parser.parse_args()
+
+    catalog = TiffCatalog(args.db)
+    for root in args.root:
+        catalog.update(root, args.workers, args.store_header)
+    if args.query:
+        for path in catalog.query(args.query):
+            print(path)
+    catalog.close()
@@ -1,23 +1,33 @@
 import os
-from PIL import Image
-from PIL.TiffTags import TAGS
-import exifread
 import tifffile
 
 rem_path = r'R:\images'
 
-for root, dirs, files in os.walk(rem_path):
-    for file in files:
-        if file.endswith(".tif"):
-            # get the type of the file
-            try:
-                with tifffile.TiffFile(os.path.join(root, file)) as tif:
-                    tag_str1 = tif.pages[0].tags[34118].value
-                    tag_str2 = tif.pages[0].tags[34119].value
 
-                    tag_dict1 = dict(tag_str1)
-                    tag_dict2 = {key.replace('\x00', '').replace('\r', '') : value.replace('\x00', '').replace('\r', '') for key, value in zip(tag_str2.split('\n')[35::2], tag_str2.split('\n')[36::2])}
+def read_zeiss_tags(path):
+    """
+    Read the ZEISS tags of the first page, the pixel data is not read.
+    :return: (tag_dict1, tag_dict2)
+        tag_dict1   CZ_SEM tag 34118 as decoded by tifffile, {'ap_mag': ('Mag', '5.00 K X'), ...}
+        tag_dict2   tag 34119, {'AP_IMAGE_PIXEL_SIZE': 'Image Pixel Size = 2.233 nm', ...}, empty if missing
+    """
+    with tifffile.TiffFile(path) as tif:
+        tags = tif.pages[0].tags
+        tag_str1 = tags[34118].value
+        tag_str2 = tags[34119].value if 34119 in tags else ''
+
+    tag_dict1 = dict(tag_str1)
+    tag_dict2 = {key.replace('\x00', '').replace('\r', '') : value.replace('\x00', '').replace('\r', '') for key, value in zip(tag_str2.split('\n')[35::2], tag_str2.split('\n')[36::2])}
+    return tag_dict1, tag_dict2
+
+if __name__ == '__main__':
+    for root, dirs, files in os.walk(rem_path):
+        for file in files:
+            if file.endswith(".tif"):
+                # get the type of the file
+                try:
+                    tag_dict1, tag_dict2 = read_zeiss_tags(os.path.join(root, file))
                     #print(tag_dict2['AP_IMAGE_PIXEL_SIZE'])
-            except Exception as e:
-                print(os.path.join(root, file))
-                print(e)
\ No newline at end of file
+                except Exception as e:
+                    print(os.path.join(root, file))
+                    print(e)
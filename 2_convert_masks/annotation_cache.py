@@ -0,0 +1,77 @@
+import os
+import json
+import hashlib
+
+
+def file_hash(path, chunk_size=1 << 20):
+    # sha1 of the file content, so renamed or copied masks still hit the cache
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class AnnotationCache():
+    """
+    Content addressed on-disk cache for the polygons of a mask.
+    An entry is stored as json file named by the hash of the mask file
+    content and the conversion parameters. Reading an entry refreshes its
+    modification time, evict() removes the least recently used entries
+    until the cache fits into max_bytes.
+    """
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, mask_path, params):
+        sha = hashlib.sha1(file_hash(mask_path).encode())
+        sha.update(json.dumps(params, sort_keys=True).encode())
+        return sha.hexdigest()
+    def __path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        path = self.__path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        return entry
+    def put(self, key, entry):
+        # write to a temporary file first, workers may store entries concurrently
+        path = self.__path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+    def size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.endswith(".json"))
+    def evict(self):
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".json")]
+        entries = sorted(entries, key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+            self.evicted += 1
+        return total
+
+    def print_stats(self):
+        total = self.hits + self.misses
+        print("Annotation cache: %d hits, %d misses (%.1f%% hit rate), %d evicted, %.1f MB in %s" % (
+            self.hits, self.misses, 100.0 * self.hits / total if total else 0.0,
+            self.evicted, self.size() / (1 << 20), self.cache_dir))
@@ -0,0 +1,307 @@
+#%%
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+from coco_index import load_json
+
+try:
+    from detectron2.structures import BoxMode
+    XYWH_ABS = BoxMode.XYWH_ABS
+except ImportError:
+    BoxMode = None
+    XYWH_ABS = 1  # value of BoxMode.XYWH_ABS
+
+# Columnar sidecar of a COCO instances json
+# <name>_columns/
+#   meta.json                 categories and version
+#   image_ids.npy             (I,)   images sorted by id
+#   file_names.npy            (I,)
+#   heights.npy, widths.npy   (I,)
+#   image_ann_offsets.npy     (I+1,) annotations of image i are [off[i], off[i+1])
+#   ann_ids.npy               (A,)
+#   category_ids.npy          (A,)   original COCO category ids
+#   iscrowd.npy               (A,)
+#   bboxes.npy                (A, 4) x, y, w, h
+#   areas.npy                 (A,)
+#   polygon_offsets.npy       (A+1,) polygons of annotation a are [off[a], off[a+1])
+#   vertex_offsets.npy        (P+1,) coordinates of polygon p are [off[p], off[p+1])
+#   coords.npy                (C,)   flat x0, y0, x1, y1, ...
+#   keypoint_offsets.npy      (A+1,)
+#   keypoints.npy             (K,)   flat x, y, v triplets
+COLUMNS_VERSION = 1
+ARRAYS = ['image_ids', 'file_names', 'heights', 'widths', 'image_ann_offsets',
+          'ann_ids', 'category_ids', 'iscrowd', 'bboxes', 'areas',
+          'polygon_offsets', 'vertex_offsets', 'coords', 'keypoint_offsets', 'keypoints']
+
+
+def get_columns_dir(json_file):
+    return os.path.splitext(json_file)[0] + '_columns'
+def offsets(lengths):
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+
+def write_columns(json_file, columns_dir=None):
+    """
+    Write the columnar sidecar of a COCO instances json.
+    :return: path of the sidecar directory
+    """
+    columns_dir = columns_dir or get_columns_dir(json_file)
+    data = load_json(json_file)
+    images = sorted(data['images'], key=lambda image: image['id'])
+    image_rows = {image['id']: row for row, image in enumerate(images)}
+
+    # annotations grouped by image, file order inside an image
+    annotations = [ann for ann in data['annotations'] if ann['image_id'] in image_rows]
+    if len(annotations) != len(data['annotations']):
+        print("Skipped %d annotations without image" % (len(data['annotations']) - len(annotations)))
+    annotations = sorted(annotations, key=lambda ann: image_rows[ann['image_id']])
+
+    polygons = []
+    for ann in annotations:
+        segmentation = ann.get('segmentation', [])
+        if isinstance(segmentation, dict):
+            raise ValueError("RLE segmentation of annotation %s is not supported" % ann['id'])
+        polygons.append(segmentation)
+    keypoints = [ann.get('keypoints', []) for ann in annotations]
+    flat_polygons = [polygon for segmentation in polygons for polygon in segmentation]
+
+    columns = {
+        'image_ids': np.array([image['id'] for image in images], dtype=np.int64),
+        'file_names': np.array([image['file_name'] for image in images], dtype=np.str_),
+        'heights': np.array([image['height'] for image in images], dtype=np.int32),
+        'widths': np.array([image['width'] for image in images], dtype=np.int32),
+        'image_ann_offsets': offsets(np.bincount([image_rows[ann['image_id']] for ann in annotations], minlength=len(images))),
+        'ann_ids': np.array([ann['id'] for ann in annotations], dtype=np.int64),
+        'category_ids': np.array([ann['category_id'] for ann in annotations], dtype=np.int64),
+        'iscrowd': np.array([ann.get('iscrowd', 0) for ann in annotations], dtype=np.uint8),
+        'bboxes': np.array([ann['bbox'] for ann in annotations], dtype=np.float64).reshape(-1, 4),
+        'areas': np.array([ann['area'] for ann in annotations], dtype=np.float64),
+        'polygon_offsets': offsets([len(segmentation) for segmentation in polygons]),
+        'vertex_offsets': offsets([len(polygon) for polygon in flat_polygons]),
+        'coords': np.fromiter((v for polygon in flat_polygons for v in polygon), dtype=np.float64),
+        'keypoint_offsets': offsets([len(kp) for kp in keypoints]),
+        'keypoints': np.fromiter((v for kp in keypoints for v in kp), dtype=np.float64)
+    }
+
+    os.makedirs(columns_dir, exist_ok=True)
+    for name, array in columns.items():
+        np.save(os.path.join(columns_dir, name + '.npy'), array)
+    with open(os.path.join(columns_dir, 'meta.json'), 'w') as f:
+        json.dump({"version": COLUMNS_VERSION, "json_file": os.path.basename(json_file), "categories": data['categories']}, f)
+    return columns_dir
+
+def load_columns(columns_dir, mmap=True):
+    """
+    Load the arrays of a sidecar, memory mapped by default.
+    :return: dict of name -> array, plus 'meta'
+    """
+    with open(os.path.join(columns_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['version'] != COLUMNS_VERSION:
+        raise ValueError("%s has version %s, expected %s" % (columns_dir, meta['version'], COLUMNS_VERSION))
+    columns = {name: np.load(os.path.join(columns_dir, name + '.npy'), mmap_mode='r' if mmap else None) for name in ARRAYS}
+    columns['meta'] = meta
+    return columns
+
+def coco_annotations(columns_dir):
+    """Rebuild the COCO images and annotations lists (only the stored fields) from a sidecar."""
+    c = load_columns(columns_dir)
+    images = [{"file_name": f, "height": h, "width": w, "id": i} for f, h, w, i in
+              zip(c['file_names'].tolist(), c['heights'].tolist(), c['widths'].tolist(), c['image_ids'].tolist())]
+    image_ids = c['image_ids'].tolist()
+    image_off = c['image_ann_offsets'].tolist()
+    poly_off, vert_off, coords = c['polygon_offsets'].tolist(), c['vertex_offsets'].tolist(), c['coords'].tolist()
+    kp_off, kps = c['keypoint_offsets'].tolist(), c['keypoints'].tolist()
+    ann_ids, category_ids, iscrowd = c['ann_ids'].tolist(), c['category_ids'].tolist(), c['iscrowd'].tolist()
+    bboxes, areas = c['bboxes'].tolist(), c['areas'].tolist()
+    annotations = []
+    for row, image_id in enumerate(image_ids):
+        for a in range(image_off[row], image_off[row + 1]):
+            annotations.append({
+                "segmentation": [coords[vert_off[p]:vert_off[p + 1]] for p in range(poly_off[a], poly_off[a + 1])],
+                "area": areas[a],
+                "iscrowd": iscrowd[a],
+                "image_id": image_id,
+                "bbox": bboxes[a],
+                "category_id": category_ids[a],
+                "id": ann_ids[a],
+                "keypoints": kps[kp_off[a]:kp_off[a + 1]]
+            })
+    return images, annotations
+
+def load_dataset_dicts(columns_dir, image_root=""):
+    """
+    detectron2 dataset dicts from a sidecar, the same as
+    detectron2.data.datasets.load_coco_json returns for the json file.
+    """
+    c = load_columns(columns_dir)
+    category_ids = sorted(category['id'] for category in c['meta']['categories'])
+    id_map = {v: i for i, v in enumerate(category_ids)}
+
+    # one tolist per column is much faster than indexing the memory map per element
+    image_ids, file_names = c['image_ids'].tolist(), c['file_names'].tolist()
+    heights, widths = c['heights'].tolist(), c['widths'].tolist()
+    image_off = c['image_ann_offsets'].tolist()
+    ann_category_ids, iscrowd, bboxes = c['category_ids'].tolist(), c['iscrowd'].tolist(), c['bboxes'].tolist()
+    poly_off, kp_off = c['polygon_offsets'].tolist(), c['keypoint_offsets'].tolist()
+
+    # filter out invalid polygons (< 3 points) for all annotations at once,
+    # valid_off[p] is the number of valid polygons before polygon p
+    vert_off = c['vertex_offsets']
+    lengths = np.diff(vert_off)
+    valid = (lengths % 2 == 0) & (lengths >= 6)
+    valid_off = offsets(valid).tolist()
+    coords = c['coords'].tolist()
+    polygons = [coords[start:end] for start, end in zip(vert_off[:-1][valid].tolist(), vert_off[1:][valid].tolist())]
+    # pixel indices to continuous coordinates, like load_coco_json (x and y + 0.5, not the visibility)
+    kps = np.array(c['keypoints'])
+    kps[np.arange(len(kps)) % 3 != 2] += 0.5
+    kps = kps.tolist()
+
+    dataset_dicts = []
+    for row in range(len(image_ids)):
+        record = {
+            "file_name": os.path.join(image_root, file_names[row]),
+            "height": heights[row],
+            "width": widths[row],
+            "image_id": image_ids[row]
+        }
+        objs = []
+        for a in range(image_off[row], image_off[row + 1]):
+            obj = {
+                "iscrowd": iscrowd[a],
+                "bbox": bboxes[a],
+                "category_id": id_map[ann_category_ids[a]],
+                "bbox_mode": XYWH_ABS
+            }
+            if poly_off[a + 1] > poly_off[a]:
+                segm = polygons[valid_off[poly_off[a]]:valid_off[poly_off[a + 1]]]
+                if len(segm) == 0:
+                    continue
+                obj["segmentation"] = segm
+            if kp_off[a + 1] > kp_off[a]:
+                obj["keypoints"] = kps[kp_off[a]:kp_off[a + 1]]
+            objs.append(obj)
+        record["annotations"] = objs
+        dataset_dicts.append(record)
+    return dataset_dicts
+def json_dataset_dicts(json_file, image_root=""):
+    # Reference conversion straight from the json, follows load_coco_json
+    data = load_json(json_file)
+    id_map = {v: i for i, v in enumerate(sorted(category['id'] for category in data['categories']))}
+    anns_per_image = {}
+    for ann in data['annotations']:
+        anns_per_image.setdefault(ann['image_id'], []).append(ann)
+    dataset_dicts = []
+    for image in sorted(data['images'], key=lambda image: image['id']):
+        record = {"file_name": os.path.join(image_root, image['file_name']), "height": image['height'], "width": image['width'], "image_id": image['id']}
+        objs = []
+        for ann in anns_per_image.get(image['id'], []):
+            obj = {"iscrowd": ann.get('iscrowd', 0), "bbox": ann['bbox'], "category_id": id_map[ann['category_id']], "bbox_mode": XYWH_ABS}
+            segm = ann.get('segmentation')
+            if segm:
+                segm = [poly for poly in segm if len(poly) % 2 == 0 and len(poly) >= 6]
+                if len(segm) == 0:
+                    continue
+                obj["segmentation"] = segm
+            keypts = ann.get('keypoints')
+            if keypts:
+                obj["keypoints"] = [v + 0.5 if i % 3 != 2 else v for i, v in enumerate(keypts)]
+            objs.append(obj)
+        record["annotations"] = objs
+        dataset_dicts.append(record)
+    return dataset_dicts
+
+def register_columnar_instances(name, metadata, columns_dir, image_root):
+    """
+    Like detectron2.data.datasets.register_coco_instances, but the dataset
+    dicts are loaded from the columnar sidecar. The json file is still set
+    in the metadata for the COCOEvaluator.
+    """
+    from detectron2.data import DatasetCatalog, MetadataCatalog
+    with open(os.path.join(columns_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    categories = sorted(meta['categories'], key=lambda category: category['id'])
+    DatasetCatalog.register(name, lambda: load_dataset_dicts(columns_dir, image_root))
+    MetadataCatalog.get(name).set(
+        json_file=os.path.join(os.path.dirname(columns_dir), meta['json_file']),
+        image_root=image_root,
+        evaluator_type="coco",
+        thing_classes=[category['name'] for category in categories],
+        thing_dataset_id_to_contiguous_id={category['id']: i for i, category in enumerate(categories)},
+        **metadata
+    )
+
+def same_values(a, b):
+    """a == b for json values, NaN equals NaN (bboxes of sub-masks without polygon)."""
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same_values(a[key], b[key]) for key in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(same_values(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) and isinstance(b, float):
+        return bool(np.array_equal(a, b, equal_nan=True))
+    return a == b
+
+def verify_columns(json_file, columns_dir=None):
+    """Round trip check of a sidecar against its json file."""
+    columns_dir = columns_dir or get_columns_dir(json_file)
+    data = load_json(json_file)
+    images, annotations = coco_annotations(columns_dir)
+    ok = True
+    json_images = {image['id']: image for image in data['images']}
+    for image in images:
+        if any(json_images[image['id']][key] != image[key] for key in ('file_name', 'height', 'width')):
+            print("Error: image %s differs" % image['id'])
+            ok = False
+    json_annotations = {ann['id']: ann for ann in data['annotations']}
+    for ann in annotations:
+        ref = json_annotations[ann['id']]
+        for key in ('segmentation', 'area', 'iscrowd', 'image_id', 'bbox', 'category_id'):
+            if not same_values(ref[key], ann[key]):
+                print("Error: annotation %s differs in %s" % (ann['id'], key))
+                ok = False
+        if not same_values(ref.get('keypoints', []), ann['keypoints']):
+            print("Error: annotation %s differs in keypoints" % ann['id'])
+            ok = False
+    if len(images) != len(data['images']) or len(annotations) != len(data['annotations']):
+        print("Error: %d/%d images, %d/%d annotations" % (len(images), len(data['images']), len(annotations), len(data['annotations'])))
+        ok = False
+    if not same_values(json_dataset_dicts(json_file), load_dataset_dicts(columns_dir)):
+        print("Error: dataset dicts differ")
+        ok = False
+    print("%s: %s" % (columns_dir, "identical to the json" if ok else "DIFFERENT from the json"))
+    return ok
+
+def benchmark(json_file, columns_dir=None, repeat=3):
+    columns_dir = columns_dir or get_columns_dir(json_file)
+    t_json = t_columns = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        json_dicts = json_dataset_dicts(json_file)
+        t_json = min(t_json, time.perf_counter() - start)
+        start = time.perf_counter()
+        columns_dicts = load_dataset_dicts(columns_dir)
+        t_columns = min(t_columns, time.perf_counter() - start)
+    print("%d images, %d annotations" % (len(json_dicts), sum(len(d["annotations"]) for d in columns_dicts)))
+    print("json:    %8.3f s" % t_json)
+    print("columns: %8.3f s" % t_columns)
+    print("speedup: %8.1fx" % (t_json / t_columns))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Columnar sidecar for COCO instances json files")
+    parser.add_argument('-json', required=True, type=str, nargs='+', help='coco json files (ie: dataset_coco/annotations/train.json)')
+    parser.add_argument('-write', action='store_true', help='write the sidecar next to the json')
+    parser.add_argument('-verify', action='store_true', help='round trip check of the sidecar against the json')
+    parser.add_argument('-benchmark', action='store_true', help='time loading the dataset dicts from json and from the sidecar')
+    args = parser.parse_args()
+
+    for json_file in args.json:
+        if args.write:
+            print("Columnar annotations written to: ", write_columns(json_file))
+        if args.verify:
+            verify_columns(json_file)
+        if args.benchmark:
+            benchmark(json_file)
+# %%
@@ -0,0 +1,118 @@
+import json
+import numpy as np
+
+# optional faster json parsers, the standard library is used if none is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def load_json(path):
+    """
+    Loads a json file with orjson or ujson if available. Files they reject
+    are read with the standard library, ie: the NaN bboxes that
+    convert_dataset writes for sub-masks without polygon.
+    """
+    try:
+        if orjson is not None:
+            with open(path, "rb") as f:
+                return orjson.loads(f.read())
+        if ujson is not None:
+            with open(path) as f:
+                return ujson.load(f)
+    except ValueError:
+        pass
+    with open(path) as f:
+        return json.load(f)
+
+
+class CocoIndex():
+    """
+    Index over the images and annotations of a COCO dict.
+
+    The ids of the annotations are stored in numpy arrays. The annotations
+    are grouped by image with a stable argsort, so every image owns one
+    slice [start, end) of that order and looking up the annotations of an
+    image is a dict lookup plus a slice, independent of the dataset size.
+
+    index = CocoIndex.from_file('train.json')
+    for ann in index.annotations(image_id):
+        ...
+    """
+    def __init__(self, data):
+        self.data = data
+        self.images = data.get("images", [])
+        self.annotation_list = data.get("annotations", [])
+        self.image_rows = {image["id"]: row for row, image in enumerate(self.images)}
+
+        n = len(self.annotation_list)
+        self.ann_ids = np.fromiter((ann["id"] for ann in self.annotation_list), dtype=np.int64, count=n)
+        self.ann_image_ids = np.fromiter((ann["image_id"] for ann in self.annotation_list), dtype=np.int64, count=n)
+        self.ann_category_ids = np.fromiter((ann["category_id"] for ann in self.annotation_list), dtype=np.int64, count=n)
+
+        # annotations grouped by image, the original order is kept inside a group
+        self.order = np.argsort(self.ann_image_ids, kind="stable")
+        group_image_ids, starts, counts = np.unique(self.ann_image_ids[self.order], return_index=True, return_counts=True)
+        self.offsets = np.append(starts, n).astype(np.int64)
+        self.group_rows = {int(image_id): row for row, image_id in enumerate(group_image_ids)}
+        # order of the first annotation of every image, like a dict filled while reading the annotations
+        self.group_image_ids = group_image_ids[np.argsort(self.order[starts], kind="stable")]
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(load_json(path))
+
+    def image(self, image_id):
+        return self.images[self.image_rows[image_id]]
+    def annotation_indices(self, image_id):
+        """Positions of the annotations of an image in data['annotations']."""
+        row = self.group_rows.get(image_id)
+        if row is None:
+            return self.order[:0]
+        return self.order[self.offsets[row]:self.offsets[row + 1]]
+    def annotations(self, image_id):
+        return [self.annotation_list[i] for i in self.annotation_indices(image_id)]
+    def category_ids(self, image_id):
+        return self.ann_category_ids[self.annotation_indices(image_id)]
+    def items(self):
+        """(image id, annotations) for every image that has annotations."""
+        for image_id in self.group_image_ids:
+            yield int(image_id), self.annotations(int(image_id))
+
+    def duplicate_annotation_ids(self):
+        ids, counts = np.unique(self.ann_ids, return_counts=True)
+        return ids[counts > 1]
+    def orphan_annotation_image_ids(self):
+        """image_id of every annotation that references a non-existing image."""
+        image_ids = np.fromiter(self.image_rows.keys(), dtype=np.int64, count=len(self.image_rows))
+        return self.ann_image_ids[~np.isin(self.ann_image_ids, image_ids)]
+
+
+def check():
+    import os
+    import tempfile
+    # a sub-mask whose polygon simplified to nothing has a NaN bbox
+    data = {
+        "images": [{"id": 1, "file_name": "1.png", "height": 4, "width": 4}],
+        "annotations": [
+            {"id": 1, "image_id": 1, "category_id": 1, "bbox": [0, 0, 2, 2], "area": 4, "segmentation": [[0, 0, 2, 0, 2, 2]]},
+            {"id": 2, "image_id": 1, "category_id": 1, "bbox": [float("nan")] * 4, "area": 0.0, "segmentation": []},
+        ],
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "nan.json")
+        with open(path, "w") as f:
+            json.dump(data, f)
+        index = CocoIndex.from_file(path)
+    annotations = index.annotations(1)
+    assert [ann["id"] for ann in annotations] == [1, 2]
+    assert np.isnan(annotations[1]["bbox"]).all()
+    print("check: load_json reads NaN bboxes (orjson %s, ujson %s)" % (orjson is not None, ujson is not None))
+
+if __name__ == '__main__':
+    check()
@@ -0,0 +1,66 @@
+import os
+import json
+import shutil
+import tempfile
+
+
+class CocoJsonWriter():
+    """
+    Writes a COCO json file while the images and annotations are created.
+    The entries are encoded as soon as they are added and spooled to two
+    temporary files next to the output, so only the entry being added is
+    held in memory. close() assembles the file in the key order of
+    get_coco_json_format, the result is the same as json.dump of the dict.
+
+    with CocoJsonWriter(path, categories) as writer:
+        writer.add_image(image)
+        writer.add_annotations(annotations)
+    """
+    def __init__(self, path, categories, info=None, licenses=None):
+        self.path = path
+        self.categories = categories
+        self.info = {} if info is None else info
+        self.licenses = [] if licenses is None else licenses
+        self.image_count = 0
+        self.annotation_count = 0
+        spool_dir = os.path.dirname(os.path.abspath(path))
+        self.__images = tempfile.TemporaryFile("w+", dir=spool_dir)
+        self.__annotations = tempfile.TemporaryFile("w+", dir=spool_dir)
+
+    @staticmethod
+    def __append(spool, index, entry):
+        if index:
+            spool.write(", ")
+        spool.write(json.dumps(entry))
+    def add_image(self, image):
+        self.__append(self.__images, self.image_count, image)
+        self.image_count += 1
+    def add_annotation(self, annotation):
+        self.__append(self.__annotations, self.annotation_count, annotation)
+        self.annotation_count += 1
+    def add_annotations(self, annotations):
+        for annotation in annotations:
+            self.add_annotation(annotation)
+
+    def close(self):
+        with open(self.path, "w") as outfile:
+            outfile.write('{"info": %s, "licenses": %s, "images": [' % (json.dumps(self.info), json.dumps(self.licenses)))
+            self.__images.seek(0)
+            shutil.copyfileobj(self.__images, outfile)
+            outfile.write('], "categories": %s, "annotations": [' % json.dumps(self.categories))
+            self.__annotations.seek(0)
+            shutil.copyfileobj(self.__annotations, outfile)
+            outfile.write(']}')
+        self.discard()
+    def discard(self):
+        self.__images.close()
+        self.__annotations.close()
+
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, *arg):
+        # don't leave a half written json behind if the conversion failed
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
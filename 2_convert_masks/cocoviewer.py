@@ -10,7 +10,6 @@ The code is modified to fit the needs of this project.
 """
 import argparse
 import colorsys
-import json
 import logging
 import os
 import random
@@ -22,6 +21,8 @@ from turtle import __forwardmethods
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont, ImageTk
 
+from coco_index import CocoIndex, load_json
+
 logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
 
 parser = argparse.ArgumentParser(description="View images with bboxes from the COCO dataset")
@@ -43,6 +44,7 @@ class Data:
         self.image_dir = image_dir
         instances, images, categories = parse_coco(annotations_file)
         self.instances = instances
+        self.index = CocoIndex(instances)  # annotations per image
         self.images = ImageList(images)  # NOTE: image list is based on annotations file
         self.categories = categories  # Dataset categories
 
@@ -56,8 +58,8 @@ class Data:
         full_path = os.path.join(self.image_dir, img_name)
 
         # Get objects and category ids
-        objects = [obj for obj in self.instances["annotations"] if obj["image_id"] == img_id]
-        obj_categories_ids = [obj["category_id"] for obj in objects]
+        objects = self.index.annotations(img_id)
+        obj_categories_ids = self.index.category_ids(img_id).tolist()
 
         # List of category ids of all objects
         img_obj_categories = [obj["category_id"] for obj in objects]
@@ -103,8 +105,7 @@ def load_annotations(fname: str) -> dict:
     """Loads annotations file."""
     logging.info(f"Parsing {fname}...")
 
-    with open(fname) as f:
-        instances = json.load(f)
+    instances = load_json(fname)
     return instances
 
 
@@ -13,9 +13,16 @@ from PIL import Image                                      # (pip install Pillow
 from skimage import measure                                # (pip install scikit-image)
 from shapely.geometry import Polygon, MultiPolygon         # (pip install Shapely)
 import json
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from tqdm import tqdm
 import argparse
+from sub_masks import extract_sub_masks
+from coco_index import CocoIndex
+from materialize import Materializer, STRATEGIES
+from annotation_cache import AnnotationCache
+from coco_writer import CocoJsonWriter
+from coco_columns import write_columns
 
 
 # SPLIT stuff
@@ -38,16 +45,17 @@ def split(path, train_val_split=0.8):
     train = np.random.choice(images, size=int(len(images) * train_val_split), replace=False)
     val = list(set(images) - set(train))
     return train, val
-def create_split_dataset(src, train, val):
+def create_split_dataset(src, train, val, materializer=None):
+    materializer = materializer or Materializer()
     dest = os.path.join(src + '_split')
     make_split_dirs(dest)
     # Copy images and masks to train and val folders
     for file in train:
-        shutil.copy(os.path.join(src, 'images', file), os.path.join(dest, 'train'))
-        shutil.copy(os.path.join(src, 'masks', file), os.path.join(dest, 'train_masks'))
+        materializer.file(os.path.join(src, 'images', file), os.path.join(dest, 'train'))
+        materializer.file(os.path.join(src, 'masks', file), os.path.join(dest, 'train_masks'))
     for file in val:
-        shutil.copy(os.path.join(src, 'images', file), os.path.join(dest, 'val'))
-        shutil.copy(os.path.join(src, 'masks', file), os.path.join(dest, 'val_masks'))
+        materializer.file(os.path.join(src, 'images', file), os.path.join(dest, 'val'))
+        materializer.file(os.path.join(src, 'masks', file), os.path.join(dest, 'val_masks'))
     return dest
 
 # COCO stuff
@@ -106,13 +114,14 @@ def create_image_annotation(file_name, width, height, image_id):
         "id": image_id
     }
     return images
-def create_annotation_format(polygon, segmentation, keypoints, image_id, category_id, annotation_id):
+def polygon_bbox_area(polygon):
     min_x, min_y, max_x, max_y = polygon.bounds
     width = max_x - min_x
     height = max_y - min_y
     bbox = (min_x, min_y, width, height)
     area = polygon.area
-
+    return bbox, area
+def create_annotation_format(bbox, area, segmentation, keypoints, image_id, category_id, annotation_id):
     annotation = {
         "segmentation": segmentation,
         "area": area,
@@ -127,28 +136,10 @@ def create_annotation_format(polygon, segmentation, keypoints, image_id, categor
     return annotation
 def create_sub_masks(mask_image, width, height):
     # Initialize a dictionary of sub-masks indexed by RGB colors
-    sub_masks = {}
-    for x in range(width):
-        for y in range(height):
-            # Get the RGB values of the pixel
-            pixel = mask_image.getpixel((x,y))[:3]
-
-            # Check to see if we have created a sub-mask...
-            pixel_str = str(pixel)
-            if IGNORE_BACKGROUND and pixel_str == "(0, 0, 0)":
-                continue
-
-            sub_mask = sub_masks.get(pixel_str)
-            if sub_mask is None:
-               # Create a sub-mask (one bit per pixel) and add to the dictionary
-                # Note: we add 1 pixel of padding in each direction
-                # because the contours module doesn"t handle cases
-                # where pixels bleed to the edge of the image
-                sub_masks[pixel_str] = Image.new("1", (width+2, height+2))
-
-            # Set the pixel value to 1 (default is 0), accounting for padding
-            sub_masks[pixel_str].putpixel((x+1, y+1), 1)
-    return sub_masks
+    # Note: the masks have 1 pixel of padding in each direction
+    # because the contours module doesn"t handle cases
+    # where pixels bleed to the edge of the image
+    return extract_sub_masks(mask_image, ignore_background=IGNORE_BACKGROUND)
 
 def detect_click(event,x,y,flags,param):
     if event == cv2.EVENT_LBUTTONUP:
@@ -183,7 +174,7 @@ def create_sub_mask_annotation(sub_mask, include_keypoint=False):
 
         # Make a polygon and simplify it
         poly = Polygon(contour)
-        poly = poly.simplify(1.0, preserve_topology=False)
+        poly = poly.simplify(SIMPLIFY_TOLERANCE, preserve_topology=False)
         
         if(poly.is_empty):
             # Go to next iteration, dont save empty values in list
@@ -204,13 +195,7 @@ def create_sub_mask_annotation(sub_mask, include_keypoint=False):
         keypoints.append((cb_params["x"], cb_params["y"], cb_params["visible"]))
 
     return polygons, segmentations, keypoints
-def create_segment_format(polygon, category_id, segment_id):
-    min_x, min_y, max_x, max_y = polygon.bounds
-    width = max_x - min_x
-    height = max_y - min_y
-    bbox = (min_x, min_y, width, height)
-    area = polygon.area
-
+def create_segment_format(bbox, area, category_id, segment_id):
     segment = {
         "id": segment_id,
         "category_id": category_id,
@@ -219,121 +204,185 @@ def create_segment_format(polygon, category_id, segment_id):
         "area": area
     }
     return segment
-def images_annotations_info(dataset_path, subset, include_keypoints):
-    # This id will be automatically increased as we go
+def create_mask_entry(mask_image, include_keypoints):
+    # Polygons, bboxes and areas of every color in the mask. This does not
+    # depend on the color table, so it can be cached and reused with -oc.
+    # Open the image and (to be sure) we convert it to RGB
+    mask_image_open = Image.open(mask_image).convert("RGB")
+    w, h = mask_image_open.size
+
+    entry = {"width": w, "height": h, "sub_masks": []}
+    sub_masks = create_sub_masks(mask_image_open, w, h)
+    for color, sub_mask in sub_masks.items():
+        if include_keypoints and color not in category_colors:
+            # don't ask for keypoints of masks that are not annotated anyway
+            break
+        polygons, segmentations, keypoints = create_sub_mask_annotation(sub_mask, include_keypoints)
+
+        # Combine the polygons to calculate the bounding box and area for multipolygon classes
+        bbox, area = polygon_bbox_area(MultiPolygon(polygons))
+        bboxes, areas = zip(*[polygon_bbox_area(polygon) for polygon in polygons]) if polygons else ((), ())
+        entry["sub_masks"].append({
+            "color": color,
+            "segmentations": segmentations,
+            "bboxes": list(bboxes),
+            "areas": list(areas),
+            "bbox": bbox,
+            "area": area,
+            "keypoints": keypoints
+        })
+    return entry
+def get_cache_params():
+    # Everything besides the mask content that changes the cached polygons
+    return {
+        "simplify_tolerance": SIMPLIFY_TOLERANCE,
+        "ignore_background": IGNORE_BACKGROUND
+    }
+def image_annotations_info(dataset_path, image, include_keypoints, cache=None):
+    # Annotations of a single image. The ids are placeholders (image id 0,
+    # annotation ids counting from 0), images_annotations_info assigns the
+    # final ids so the images can be processed independently of each other.
     annotation_id = 0
     image_id = 0
     annotations = []
-
-    annotations_panoptic = []
+    segments = []
+
+    # We make a reference to the original file in the COCO JSON file
+    original_file_name = os.path.join(image)
+    mask_image = os.path.join(dataset_path, 'masks', image)
+
+    # Keypoints are clicked by hand, those masks are never cached
+    hit = None
+    if cache is not None and not include_keypoints:
+        key = cache.key(mask_image, get_cache_params())
+        entry = cache.get(key)
+        hit = entry is not None
+    if not hit:
+        entry = create_mask_entry(mask_image, include_keypoints)
+        if hit is not None:
+            cache.put(key, entry)
     
-    images = []
-    
-    for image in tqdm(subset, desc="Creating annotations"):
-        segments = []
-
-        # We make a reference to the original file in the COCO JSON file
-        original_file_name = os.path.join(image)
-        mask_image = os.path.join(dataset_path, 'masks', image)
-
-        # Open the image and (to be sure) we convert it to RGB
-        mask_image_open = Image.open(mask_image).convert("RGB")
-        w, h = mask_image_open.size
-        
-        # "images" info 
-        image = create_image_annotation(original_file_name, w, h, image_id)
-        images.append(image)
-
-        sub_masks = create_sub_masks(mask_image_open, w, h)
-        for color, sub_mask in sub_masks.items():
-            try:
-                category_id = category_colors[color]
-            except Exception as e:
-                print(original_file_name, e, mask_image_open.mode)
-                # print the distribution of colors in the image
-                #print(mask_image_open.getcolors())
-                break
-
-
-            # "annotations" info
-            polygons, segmentations, keypoints = create_sub_mask_annotation(sub_mask, include_keypoints)
-
-
-
-            # Check if we have classes that are a multipolygon
-            if category_id in multipolygon_ids:
-                # Combine the polygons to calculate the bounding box and area
-                multi_poly = MultiPolygon(polygons)
-                                
-                annotation = create_annotation_format(multi_poly, segmentations, keypoints, image_id, category_id, annotation_id)
-                segments.append(create_segment_format(multi_poly, category_id, annotation_id))
+    # "images" info 
+    image = create_image_annotation(original_file_name, entry["width"], entry["height"], image_id)
+
+    for sub_mask in entry["sub_masks"]:
+        try:
+            category_id = category_colors[sub_mask["color"]]
+        except Exception as e:
+            print(original_file_name, e)
+            break
+
+        # "annotations" info
+        keypoints = sub_mask["keypoints"]
+
+        # Check if we have classes that are a multipolygon
+        if category_id in multipolygon_ids:
+            annotation = create_annotation_format(sub_mask["bbox"], sub_mask["area"], sub_mask["segmentations"], keypoints, image_id, category_id, annotation_id)
+            segments.append(create_segment_format(sub_mask["bbox"], sub_mask["area"], category_id, annotation_id))
+            annotations.append(annotation)
+            annotation_id += 1
+        else:
+            for segmentation, bbox, area in zip(sub_mask["segmentations"], sub_mask["bboxes"], sub_mask["areas"]):
+                annotation = create_annotation_format(bbox, area, [segmentation], keypoints, image_id, category_id, annotation_id)
+                segments.append(create_segment_format(bbox, area, category_id, annotation_id))
                 annotations.append(annotation)
                 annotation_id += 1
-            else:
-                for i in range(len(polygons)):
-                    # Cleaner to recalculate this variable
-                    segmentation = [np.array(polygons[i].exterior.coords).ravel().tolist()]
-                    
-                    annotation = create_annotation_format(polygons[i], segmentation, keypoints, image_id, category_id, annotation_id)
-                    segments.append(create_segment_format(polygons[i], category_id, annotation_id))
-                    annotations.append(annotation)
-                    annotation_id += 1
-        annotations_panoptic.append({
-            "image_id": image_id,
-            "file_name": original_file_name,
-            "segments_info": segments
-        })
-        image_id += 1
-    return images, annotations, annotations_panoptic, annotation_id
-
-
-
-def create_coco_dataset(dataset_path, train, val, include_keypoints):
-    train_coco_format = get_coco_json_format()
-    val_coco_format = get_coco_json_format()
-
-    train_coco_format_panoptic = get_coco_json_format()
-    val_coco_format_panoptic = get_coco_json_format()
-
-    train_coco_format["categories"] = create_category_annotation(category_ids)
-    val_coco_format["categories"] = create_category_annotation(category_ids)
+    return image, annotations, segments, hit
+def get_worker_settings():
+    # Module level settings changed by the command line, the workers need
+    # them as well because spawned processes do not run the __main__ block
+    return {
+        "category_ids": category_ids,
+        "category_colors": category_colors,
+        "category_colors_inv": category_colors_inv,
+        "multipolygon_ids": multipolygon_ids,
+        "IGNORE_BACKGROUND": IGNORE_BACKGROUND
+    }
+def init_worker(settings):
+    globals().update(settings)
+def iter_images_annotations(dataset_path, subset, include_keypoints, workers=1, cache=None):
+    """
+    Generator over the images of subset with the final ids assigned.
+    :return: yields (image, annotations, panoptic annotation) per image
+    """
+    # This id will be automatically increased as we go
+    annotation_id = 0
+    image_id = 0
 
-    train_coco_format_panoptic["categories"] = create_category_annotation_panoptic(category_ids)
-    val_coco_format_panoptic["categories"] = create_category_annotation_panoptic(category_ids)
+    if workers > 1:
+        pool = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(get_worker_settings(),))
+        chunksize = max(1, len(subset) // (workers * 4))
+        # map keeps the order of subset, so the ids below are the same as in a serial run
+        results = pool.map(partial(image_annotations_info, dataset_path, include_keypoints=include_keypoints, cache=cache), subset, chunksize=chunksize)
+    else:
+        pool = None
+        results = (image_annotations_info(dataset_path, image, include_keypoints, cache) for image in subset)
+
+    # Merge the per image results and assign the ids
+    try:
+        for image, image_annotations, segments, hit in tqdm(results, total=len(subset), desc="Creating annotations"):
+            if hit is not None:
+                cache.count(hit)
+            image["id"] = image_id
+            for annotation, segment in zip(image_annotations, segments):
+                annotation["image_id"] = image_id
+                annotation["id"] = annotation_id
+                segment["id"] = annotation_id
+                annotation_id += 1
+            annotation_panoptic = {
+                "image_id": image_id,
+                "file_name": image["file_name"],
+                "segments_info": segments
+            }
+            yield image, image_annotations, annotation_panoptic
+            image_id += 1
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+def images_annotations_info(dataset_path, subset, include_keypoints, workers=1, cache=None):
+    annotations = []
+    annotations_panoptic = []
+    images = []
+    for image, image_annotations, annotation_panoptic in iter_images_annotations(dataset_path, subset, include_keypoints, workers, cache):
+        images.append(image)
+        annotations.extend(image_annotations)
+        annotations_panoptic.append(annotation_panoptic)
+    return images, annotations, annotations_panoptic, len(annotations)
 
-    train_images, train_annotations, train_annotations_panoptic, train_annotation_id = images_annotations_info(dataset_path, train, include_keypoints)
-    val_images, val_annotations, val_annotations_panoptic, val_annotation_id = images_annotations_info(dataset_path, val, include_keypoints)
 
-    train_coco_format["images"], train_coco_format["annotations"], train_annotation_cnt = train_images, train_annotations, train_annotation_id
-    val_coco_format["images"], val_coco_format["annotations"], val_annotation_cnt = val_images, val_annotations, val_annotation_id
 
-    train_coco_format_panoptic["images"], train_coco_format_panoptic["annotations"], train_annotation_cnt = train_images, train_annotations_panoptic, train_annotation_id
-    val_coco_format_panoptic["images"], val_coco_format_panoptic["annotations"], val_annotation_cnt = val_images, val_annotations_panoptic, val_annotation_id
+def create_coco_dataset(dataset_path, train, val, include_keypoints, workers=1, cache=None, materializer=None):
+    materializer = materializer or Materializer()
 
     dest = dataset_path + '_coco'
     make_coco_dirs(dest)
 
     dest_panoptic = dataset_path + '_coco_panoptic'
     make_coco_dirs(dest_panoptic)
-    
-    with open(os.path.join(dest,  'annotations', 'train.json'), "w") as outfile:
-            json.dump(train_coco_format, outfile)
-    with open(os.path.join(dest,  'annotations', 'val.json'), "w") as outfile:
-            json.dump(val_coco_format, outfile)
 
-    with open(os.path.join(dest_panoptic,  'annotations', 'train.json'), "w") as outfile:
-            json.dump(train_coco_format_panoptic, outfile)
-    with open(os.path.join(dest_panoptic,  'annotations', 'val.json'), "w") as outfile:
-            json.dump(val_coco_format_panoptic, outfile)
+    categories = create_category_annotation(category_ids)
+    categories_panoptic = create_category_annotation_panoptic(category_ids)
+
+    # Instances and panoptic json are written in one pass while the annotations are created
+    annotation_cnt = {}
+    for name, subset in (('train', train), ('val', val)):
+        with CocoJsonWriter(os.path.join(dest, 'annotations', name + '.json'), categories) as writer, \
+             CocoJsonWriter(os.path.join(dest_panoptic, 'annotations', name + '.json'), categories_panoptic) as writer_panoptic:
+            for image, image_annotations, annotation_panoptic in iter_images_annotations(dataset_path, subset, include_keypoints, workers, cache):
+                writer.add_image(image)
+                writer.add_annotations(image_annotations)
+                writer_panoptic.add_image(image)
+                writer_panoptic.add_annotation(annotation_panoptic)
+        annotation_cnt[name] = writer.annotation_count
 
     # copy images folder to coco folder
-    shutil.copytree(os.path.join(dataset_path, 'images'), os.path.join(dest, 'images'), dirs_exist_ok=True)
-    shutil.copytree(os.path.join(dataset_path, 'images'), os.path.join(dest_panoptic, 'images'), dirs_exist_ok=True)
+    materializer.tree(os.path.join(dataset_path, 'images'), os.path.join(dest, 'images'))
+    materializer.tree(os.path.join(dataset_path, 'images'), os.path.join(dest_panoptic, 'images'))
 
-    shutil.copytree(os.path.join(dataset_path, 'masks'), os.path.join(dest_panoptic, 'annotations', 'masks'), dirs_exist_ok=True)
+    materializer.tree(os.path.join(dataset_path, 'masks'), os.path.join(dest_panoptic, 'annotations', 'masks'))
 
-    print("Created %d annotations for train images:" % (train_annotation_cnt))
-    print("Created %d annotations for val images:" % (val_annotation_cnt))
+    print("Created %d annotations for train images:" % (annotation_cnt['train']))
+    print("Created %d annotations for val images:" % (annotation_cnt['val']))
     return dest, dest_panoptic
 
 # YOLO stuff
@@ -403,7 +452,8 @@ def merge_multi_segment(segments):
                     nidx = abs(idx[1] - idx[0])
                     s.append(segments[i][nidx:])
     return s
-def create_yolo_dataset(dataset_path, train, val, use_segments=True):
+def create_yolo_dataset(dataset_path, train, val, use_segments=True, materializer=None):
+    materializer = materializer or Materializer()
     dest = dataset_path + '_yolo'
     coco_dataset_path = dataset_path + '_coco'
     if not os.path.exists(coco_dataset_path):
@@ -421,22 +471,15 @@ def create_yolo_dataset(dataset_path, train, val, use_segments=True):
         fn2 = Path(save_dir) / json_file.stem.replace('instances_', '') / 'images'
         fn2.mkdir()
 
-        with open(json_file) as f:
-            data = json.load(f)
-
-        # Create image dict
-        images = {'%g' % x['id']: x for x in data['images']}
-        # Create image-annotations dict
-        imgToAnns = defaultdict(list)
-        for ann in data['annotations']:
-            imgToAnns[ann['image_id']].append(ann)
+        # Index of the annotations per image
+        index = CocoIndex.from_file(json_file)
 
         # Write labels file
-        for img_id, anns in tqdm(imgToAnns.items(), desc=f'Annotations {json_file}'):
-            img = images['%g' % img_id]
+        for img_id, anns in tqdm(index.items(), total=len(index.group_rows), desc=f'Annotations {json_file}'):
+            img = index.image(img_id)
             h, w, f = img['height'], img['width'], img['file_name']
 
-            shutil.copy(os.path.join(dataset_path, 'images', f), os.path.join(dest, json_file.stem.replace('instances_', ''), 'images'))
+            materializer.file(os.path.join(dataset_path, 'images', f), os.path.join(dest, json_file.stem.replace('instances_', ''), 'images'))
 
             bboxes = []
             segments = []
@@ -505,6 +548,9 @@ category_colors_inv = {v: k for k, v in category_colors.items()}
 
 # Define the ids that are a multiplolygon. In our case: wall, roof and sky
 multipolygon_ids = [0, 1, 2, 3, 4, 5, 6, 7, 8]
+
+# Tolerance of the polygon simplification in pixels
+SIMPLIFY_TOLERANCE = 1.0
 #%%
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -516,6 +562,11 @@ if __name__ == '__main__':
     parser.add_argument('-oc', action='store_true', help='use one class, all tips are the same class')
     parser.add_argument('-ib', action='store_true', help='include background')
     parser.add_argument('-kp', action='store_true', help='include keypoint coordinates')
+    parser.add_argument('-workers', '--workers', default=1, type=int, help='number of processes for the coco annotations (ie: 8)')
+    parser.add_argument('-cache', action='store_true', help='reuse the polygons of unchanged masks from <dataset>_cache')
+    parser.add_argument('-cache_size', default=1024, type=float, help='maximum size of the annotation cache in MB (ie: 1024)')
+    parser.add_argument('-link', default='copy', choices=STRATEGIES, help='how images and masks are put into the new datasets, falls back to copy')
+    parser.add_argument('-columns', action='store_true', help='also write the coco annotations as memory mappable numpy columns (see coco_columns.py)')
 
     args = parser.parse_args()
     print(args)
@@ -530,6 +581,7 @@ if __name__ == '__main__':
         dataset_path = args.dataset
 
     IGNORE_BACKGROUND = not args.ib
+    materializer = Materializer(args.link)
     background_color = "(0, 0, 0)"
     if IGNORE_BACKGROUND:
         category_ids.pop("background")
@@ -543,20 +595,33 @@ if __name__ == '__main__':
         print("Val: ", len(val))
 
     #%%
-        split_dir = create_split_dataset(dataset_path, train, val)
+        split_dir = create_split_dataset(dataset_path, train, val, materializer)
         print("Split dataset created at: ", split_dir)    
 #%%
     if args.kp:
         cv2.namedWindow('image', cv2.WINDOW_NORMAL)
         cv2.setWindowProperty('image', cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
+        if args.workers > 1:
+            # keypoints are clicked in the main window, one image after the other
+            warnings.warn('Keypoint annotation is interactive, ignoring -workers')
+            args.workers = 1
 
     if args.coco:
         print("Creating coco dataset...")
-        coco_dir, coco_panoptic_dir = create_coco_dataset(dataset_path, train, val, args.kp)
+        cache = AnnotationCache(dataset_path + '_cache', int(args.cache_size * (1 << 20))) if args.cache else None
+        coco_dir, coco_panoptic_dir = create_coco_dataset(dataset_path, train, val, args.kp, args.workers, cache, materializer)
+        if cache is not None:
+            cache.evict()
+            cache.print_stats()
         print("Coco dataset created at: ", coco_dir)
+        if args.columns:
+            for name in ('train', 'val'):
+                columns_dir = write_columns(os.path.join(coco_dir, 'annotations', name + '.json'))
+                print("Columnar annotations written to: ", columns_dir)
         print("Coco panoptic dataset created at: ", coco_panoptic_dir)
 # %%
     if args.yolo:
         print("Creating yolo dataset...")
-        yolo_dir = create_yolo_dataset(dataset_path, train, val)
+        yolo_dir = create_yolo_dataset(dataset_path, train, val, materializer=materializer)
         print("Yolo dataset created at: ", dataset_path)
+    materializer.print_stats()
@@ -4,6 +4,7 @@
 
 #%%
 import os
+import re
 import cv2
 import warnings
 import numpy as np
@@ -13,9 +14,11 @@ from PIL import Image                                      # (pip install Pillow
 from skimage import measure                                # (pip install scikit-image)
 from shapely.geometry import Polygon, MultiPolygon         # (pip install Shapely)
 import json
-from collections import defaultdict
 from tqdm import tqdm
 import argparse
+from sub_masks import extract_sub_masks
+from coco_index import CocoIndex
+from materialize import Materializer, STRATEGIES
 
 
 # SPLIT stuff
@@ -38,24 +41,65 @@ def split(path, train_val_split=0.8):
     train = np.random.choice(images, size=int(len(images) * train_val_split), replace=False)
     val = list(set(images) - set(train))
     return train, val
-def create_split_dataset(src, train, val):
+def create_split_dataset(src, train, val, mask_groups, materializer=None):
+    materializer = materializer or Materializer()
     dest = os.path.join(src + '_split')
     make_split_dirs(dest)
-    # Copy images and masks to train and val folders
-    for file in train:
-        shutil.copy(os.path.join(src, 'images', file), os.path.join(dest, 'train'))
-        try:
-            shutil.copy(os.path.join(src, 'masks', file[:4]+'.tif'), os.path.join(dest, 'train_masks'))
-        except:
-            pass
-    for file in val:
-        shutil.copy(os.path.join(src, 'images', file), os.path.join(dest, 'val'))
-        try:
-            shutil.copy(os.path.join(src, 'masks', file[:4]+'.tif'), os.path.join(dest, 'val_masks'))
-        except:
-            pass
+    image_masks = get_image_masks(mask_groups)
+    # Copy images and masks to train and val folders, every mask only once per folder
+    for subset, images_dir, masks_dir in ((train, 'train', 'train_masks'), (val, 'val', 'val_masks')):
+        masks = set()
+        for file in subset:
+            materializer.file(os.path.join(src, 'images', file), os.path.join(dest, images_dir))
+            if file in image_masks:
+                masks.add(image_masks[file])
+        for mask in masks:
+            materializer.file(os.path.join(src, 'masks', mask), os.path.join(dest, masks_dir))
     return dest
 
+# Mask groups
+# The augmentor grabs one mask per magnification and rotation and then
+# several images with the same magnification and rotation:
+#   masks/{iteration}_mag{m}_rot{r}.tif
+#   images/{iteration}_mag{m}_rot{r}_{i}.tif
+AUGMENTOR_IMAGE_NAME = re.compile(r"^(?P<iteration>\d+)_mag(?P<mag>[^_]+)_rot(?P<rot>[^_]+)_(?P<i>\d+)(?P<ext>\.tiff?)$")
+def find_mask(dataset_path, image, multi_image):
+    """
+    Find the mask file belonging to an image.
+    :param image: image file name
+    :param multi_image: several images share one mask
+    :return: mask file name or None if there is no mask
+    """
+    candidates = []
+    if multi_image:
+        match = AUGMENTOR_IMAGE_NAME.match(image)
+        if match:
+            candidates.append('%s_mag%s_rot%s%s' % match.group('iteration', 'mag', 'rot', 'ext'))
+        else:
+            # other names, the image name is the mask name with an _{i} suffix
+            stem, ext = os.path.splitext(image)
+            candidates.append(stem.rsplit('_', 1)[0] + ext)
+    candidates.append(image)
+    for mask in candidates:
+        if os.path.isfile(os.path.join(dataset_path, 'masks', mask)):
+            return mask
+    return None
+def build_mask_groups(dataset_path, images, multi_image):
+    """
+    Index which images share a mask.
+    :return: dict of mask file name -> list of image file names, in the order of images
+    """
+    mask_groups = {}
+    for image in images:
+        mask = find_mask(dataset_path, image, multi_image)
+        if mask is None:
+            warnings.warn('No mask found for %s, image is skipped' % image)
+            continue
+        mask_groups.setdefault(mask, []).append(image)
+    return mask_groups
+def get_image_masks(mask_groups):
+    return {image: mask for mask, images in mask_groups.items() for image in images}
+
 # COCO stuff
 def make_coco_dirs(dir='new_dir/'):
     # Create folders
@@ -133,28 +177,10 @@ def create_annotation_format(polygon, segmentation, keypoints, image_id, categor
     return annotation
 def create_sub_masks(mask_image, width, height):
     # Initialize a dictionary of sub-masks indexed by RGB colors
-    sub_masks = {}
-    for x in range(width):
-        for y in range(height):
-            # Get the RGB values of the pixel
-            pixel = mask_image.getpixel((x,y))[:3]
-
-            # Check to see if we have created a sub-mask...
-            pixel_str = str(pixel)
-            if IGNORE_BACKGROUND and pixel_str == "(0, 0, 0)":
-                continue
-
-            sub_mask = sub_masks.get(pixel_str)
-            if sub_mask is None:
-               # Create a sub-mask (one bit per pixel) and add to the dictionary
-                # Note: we add 1 pixel of padding in each direction
-                # because the contours module doesn"t handle cases
-                # where pixels bleed to the edge of the image
-                sub_masks[pixel_str] = Image.new("1", (width+2, height+2))
-
-            # Set the pixel value to 1 (default is 0), accounting for padding
-            sub_masks[pixel_str].putpixel((x+1, y+1), 1)
-    return sub_masks
+    # Note: the masks have 1 pixel of padding in each direction
+    # because the contours module doesn"t handle cases
+    # where pixels bleed to the edge of the image
+    return extract_sub_masks(mask_image, ignore_background=IGNORE_BACKGROUND)
 
 def detect_click(event,x,y,flags,param):
     if event == cv2.EVENT_LBUTTONUP:
@@ -226,94 +252,87 @@ def create_segment_format(polygon, category_id, segment_id):
         "area": area
     }
     return segment
-annot_reuse = {}
-annot_reuse_pan = {}
-def images_annotations_info(dataset_path, subset, include_keypoints, multi_image):
+def mask_annotations_info(dataset_path, mask, include_keypoints):
+    # Annotations of one mask, the image and annotation ids are filled in
+    # for every image of the mask group by images_annotations_info
+    annotation_id = 0
+    image_id = 0
+    annotations = []
+    segments = []
+
+    mask_image = os.path.join(dataset_path, 'masks', mask)
+
+    # Open the image and (to be sure) we convert it to RGB
+    mask_image_open = Image.open(mask_image).convert("RGB")
+    w, h = mask_image_open.size
+
+    sub_masks = create_sub_masks(mask_image_open, w, h)
+
+    for color, sub_mask in sub_masks.items():
+        try:
+            category_id = category_colors[color]
+        except Exception as e:
+            print(mask, e, mask_image_open.mode)
+            # print the distribution of colors in the image
+            #print(mask_image_open.getcolors())
+            break
+
+
+        # "annotations" info
+        polygons, segmentations, keypoints = create_sub_mask_annotation(sub_mask, include_keypoints)
+
+        # Check if we have classes that are a multipolygon
+        if category_id in multipolygon_ids:
+            # Combine the polygons to calculate the bounding box and area
+            multi_poly = MultiPolygon(polygons)
+                            
+            annotation = create_annotation_format(multi_poly, segmentations, keypoints, image_id, category_id, annotation_id)
+            segments.append(create_segment_format(multi_poly, category_id, annotation_id))
+            annotations.append(annotation)
+            annotation_id += 1
+        else:
+            for i in range(len(polygons)):
+                # Cleaner to recalculate this variable
+                segmentation = [np.array(polygons[i].exterior.coords).ravel().tolist()]
+                
+                annotation = create_annotation_format(polygons[i], segmentation, keypoints, image_id, category_id, annotation_id)
+                segments.append(create_segment_format(polygons[i], category_id, annotation_id))
+                annotations.append(annotation)
+                annotation_id += 1
+    return {"width": w, "height": h, "annotations": annotations, "segments": segments}
+def mask_groups_annotations_info(dataset_path, mask_groups, include_keypoints):
+    # Contour every mask exactly once, no matter how many images share it
+    return {mask: mask_annotations_info(dataset_path, mask, include_keypoints) for mask in tqdm(mask_groups, desc="Creating mask annotations")}
+def images_annotations_info(subset, mask_groups, mask_annotations):
     # This id will be automatically increased as we go
     annotation_id = 0
     image_id = 0
     annotations = []
 
     annotations_panoptic = []
-
-    
     
     images = []
+
+    image_masks = get_image_masks(mask_groups)
     
-    for image in tqdm(subset, desc="Creating annotations"):
+    for image in subset:
+        if image not in image_masks:
+            continue
+        mask_info = mask_annotations[image_masks[image]]
         segments = []
 
         # We make a reference to the original file in the COCO JSON file
         original_file_name = os.path.join(image)
-
-        if multi_image:
-            mask_image = os.path.join(dataset_path, 'masks', image[:4]+'.tif')
-        else:
-            mask_image = os.path.join(dataset_path, 'masks', image)
-
-        # Open the image and (to be sure) we convert it to RGB
-        mask_image_open = Image.open(mask_image).convert("RGB")
-        w, h = mask_image_open.size
         
         # "images" info 
-        image = create_image_annotation(original_file_name, w, h, image_id)
+        image = create_image_annotation(original_file_name, mask_info["width"], mask_info["height"], image_id)
         images.append(image)
 
-        if multi_image:
-            if (original_file_name[:4] in annot_reuse.keys()):
-                print('\nalreadey annotated: ', original_file_name)
-                print('reuse annotation: ', len(annot_reuse[original_file_name[:4]]))
-                for index in range(len(annot_reuse[original_file_name[:4]])):
-                    annotation = annot_reuse[original_file_name[:4]][index].copy()
-                    annotation["id"] = annotation_id
-                    annotation["image_id"] = image_id
-                    annotations.append(annotation)
-                    annotation_panoptic = annot_reuse_pan[original_file_name[:4]][index].copy()
-                    annotation_panoptic["file_name"] = original_file_name
-                    annotations_panoptic.append(annotation_panoptic)
-                    annotation_id += 1
-                image_id += 1
-                continue
-            annot_reuse[original_file_name[:4]] = []
-            annot_reuse_pan[original_file_name[:4]] = []
-
-
-        sub_masks = create_sub_masks(mask_image_open, w, h)
-
-        for color, sub_mask in sub_masks.items():
-            try:
-                category_id = category_colors[color]
-            except Exception as e:
-                print(original_file_name, e, mask_image_open.mode)
-                # print the distribution of colors in the image
-                #print(mask_image_open.getcolors())
-                break
-
-
-            # "annotations" info
-            polygons, segmentations, keypoints = create_sub_mask_annotation(sub_mask, include_keypoints)
-
-            # Check if we have classes that are a multipolygon
-            if category_id in multipolygon_ids:
-                # Combine the polygons to calculate the bounding box and area
-                multi_poly = MultiPolygon(polygons)
-                                
-                annotation = create_annotation_format(multi_poly, segmentations, keypoints, image_id, category_id, annotation_id)
-                segments.append(create_segment_format(multi_poly, category_id, annotation_id))
-                annotations.append(annotation)
-                annotation_id += 1
-            else:
-                for i in range(len(polygons)):
-                    # Cleaner to recalculate this variable
-                    segmentation = [np.array(polygons[i].exterior.coords).ravel().tolist()]
-                    
-                    annotation = create_annotation_format(polygons[i], segmentation, keypoints, image_id, category_id, annotation_id)
-                    segments.append(create_segment_format(polygons[i], category_id, annotation_id))
-                    annotations.append(annotation)
-                    annotation_id += 1
-            if multi_image:
-                annot_reuse[original_file_name[:4]].append(annotation)
-                annot_reuse_pan[original_file_name[:4]].append({"image_id": image_id,"file_name": original_file_name,"segments_info": segments})
+        # Fan out the annotations of the mask to this image
+        for annotation, segment in zip(mask_info["annotations"], mask_info["segments"]):
+            annotations.append(dict(annotation, image_id=image_id, id=annotation_id))
+            segments.append(dict(segment, id=annotation_id))
+            annotation_id += 1
         annotations_panoptic.append({
             "image_id": image_id,
             "file_name": original_file_name,
@@ -325,7 +344,8 @@ def images_annotations_info(dataset_path, subset, include_keypoints, multi_image
 
 
 
-def create_coco_dataset(dataset_path, train, val, include_keypoints, multi_image):
+def create_coco_dataset(dataset_path, train, val, include_keypoints, mask_groups, materializer=None):
+    materializer = materializer or Materializer()
     train_coco_format = get_coco_json_format()
     val_coco_format = get_coco_json_format()
 
@@ -338,8 +358,10 @@ def create_coco_dataset(dataset_path, train, val, include_keypoints, multi_image
     train_coco_format_panoptic["categories"] = create_category_annotation_panoptic(category_ids)
     val_coco_format_panoptic["categories"] = create_category_annotation_panoptic(category_ids)
 
-    train_images, train_annotations, train_annotations_panoptic, train_annotation_id = images_annotations_info(dataset_path, train, include_keypoints, multi_image)
-    val_images, val_annotations, val_annotations_panoptic, val_annotation_id = images_annotations_info(dataset_path, val, include_keypoints, multi_image)
+    mask_annotations = mask_groups_annotations_info(dataset_path, mask_groups, include_keypoints)
+
+    train_images, train_annotations, train_annotations_panoptic, train_annotation_id = images_annotations_info(train, mask_groups, mask_annotations)
+    val_images, val_annotations, val_annotations_panoptic, val_annotation_id = images_annotations_info(val, mask_groups, mask_annotations)
 
     train_coco_format["images"], train_coco_format["annotations"], train_annotation_cnt = train_images, train_annotations, train_annotation_id
     val_coco_format["images"], val_coco_format["annotations"], val_annotation_cnt = val_images, val_annotations, val_annotation_id
@@ -364,10 +386,10 @@ def create_coco_dataset(dataset_path, train, val, include_keypoints, multi_image
             json.dump(val_coco_format_panoptic, outfile)
 
     # copy images folder to coco folder
-    shutil.copytree(os.path.join(dataset_path, 'images'), os.path.join(dest, 'images'), dirs_exist_ok=True)
-    shutil.copytree(os.path.join(dataset_path, 'images'), os.path.join(dest_panoptic, 'images'), dirs_exist_ok=True)
+    materializer.tree(os.path.join(dataset_path, 'images'), os.path.join(dest, 'images'))
+    materializer.tree(os.path.join(dataset_path, 'images'), os.path.join(dest_panoptic, 'images'))
 
-    shutil.copytree(os.path.join(dataset_path, 'masks'), os.path.join(dest_panoptic, 'annotations', 'masks'), dirs_exist_ok=True)
+    materializer.tree(os.path.join(dataset_path, 'masks'), os.path.join(dest_panoptic, 'annotations', 'masks'))
 
     print("Created %d annotations for train images:" % (train_annotation_cnt))
     print("Created %d annotations for val images:" % (val_annotation_cnt))
@@ -440,7 +462,8 @@ def merge_multi_segment(segments):
                     nidx = abs(idx[1] - idx[0])
                     s.append(segments[i][nidx:])
     return s
-def create_yolo_dataset(dataset_path, train, val, use_segments=True):
+def create_yolo_dataset(dataset_path, train, val, use_segments=True, materializer=None):
+    materializer = materializer or Materializer()
     dest = dataset_path + '_yolo'
     coco_dataset_path = dataset_path + '_coco'
     if not os.path.exists(coco_dataset_path):
@@ -458,22 +481,15 @@ def create_yolo_dataset(dataset_path, train, val, use_segments=True):
         fn2 = Path(save_dir) / json_file.stem.replace('instances_', '') / 'images'
         fn2.mkdir()
 
-        with open(json_file) as f:
-            data = json.load(f)
-
-        # Create image dict
-        images = {'%g' % x['id']: x for x in data['images']}
-        # Create image-annotations dict
-        imgToAnns = defaultdict(list)
-        for ann in data['annotations']:
-            imgToAnns[ann['image_id']].append(ann)
+        # Index of the annotations per image
+        index = CocoIndex.from_file(json_file)
 
         # Write labels file
-        for img_id, anns in tqdm(imgToAnns.items(), desc=f'Annotations {json_file}'):
-            img = images['%g' % img_id]
+        for img_id, anns in tqdm(index.items(), total=len(index.group_rows), desc=f'Annotations {json_file}'):
+            img = index.image(img_id)
             h, w, f = img['height'], img['width'], img['file_name']
 
-            shutil.copy(os.path.join(dataset_path, 'images', f), os.path.join(dest, json_file.stem.replace('instances_', ''), 'images'))
+            materializer.file(os.path.join(dataset_path, 'images', f), os.path.join(dest, json_file.stem.replace('instances_', ''), 'images'))
 
             bboxes = []
             segments = []
@@ -554,6 +570,7 @@ if __name__ == '__main__':
     parser.add_argument('-ib', action='store_true', help='include background')
     parser.add_argument('-kp', action='store_true', help='include keypoint coordinates')
     parser.add_argument('-mi', action='store_true', help='one mask for multiple images')
+    parser.add_argument('-link', default='copy', choices=STRATEGIES, help='how images and masks are put into the new datasets, falls back to copy')
 
     args = parser.parse_args()
     print(args)
@@ -568,6 +585,7 @@ if __name__ == '__main__':
         dataset_path = args.dataset
 
     IGNORE_BACKGROUND = not args.ib
+    materializer = Materializer(args.link)
     background_color = "(0, 0, 0)"
     if IGNORE_BACKGROUND:
         category_ids.pop("background")
@@ -580,8 +598,11 @@ if __name__ == '__main__':
         print("Train: ", len(train))
         print("Val: ", len(val))
 
+        mask_groups = build_mask_groups(dataset_path, list(train) + list(val), args.mi)
+        print("Masks: ", len(mask_groups))
+
     #%%
-        split_dir = create_split_dataset(dataset_path, train, val)
+        split_dir = create_split_dataset(dataset_path, train, val, mask_groups, materializer)
         print("Split dataset created at: ", split_dir)    
 #%%
     if args.kp:
@@ -590,11 +611,12 @@ if __name__ == '__main__':
 
     if args.coco:
         print("Creating coco dataset...")
-        coco_dir, coco_panoptic_dir = create_coco_dataset(dataset_path, train, val, args.kp, args.mi)
+        coco_dir, coco_panoptic_dir = create_coco_dataset(dataset_path, train, val, args.kp, mask_groups, materializer)
         print("Coco dataset created at: ", coco_dir)
         print("Coco panoptic dataset created at: ", coco_panoptic_dir)
 # %%
     if args.yolo:
         print("Creating yolo dataset...")
-        yolo_dir = create_yolo_dataset(dataset_path, train, val)
+        yolo_dir = create_yolo_dataset(dataset_path, train, val, materializer=materializer)
         print("Yolo dataset created at: ", dataset_path)
+    materializer.print_stats()
@@ -17,6 +17,7 @@ import json
 from collections import defaultdict
 from tqdm import tqdm
 import argparse
+from sub_masks import extract_sub_masks
 
 
 # SPLIT stuff
@@ -109,28 +110,10 @@ def create_annotation_format(polygon, segmentation, image_id, category_id, annot
     return annotation
 def create_sub_masks(mask_image, width, height):
     # Initialize a dictionary of sub-masks indexed by RGB colors
-    sub_masks = {}
-    for x in range(width):
-        for y in range(height):
-            # Get the RGB values of the pixel
-            pixel = mask_image.getpixel((x,y))[:3]
-
-            # Check to see if we have created a sub-mask...
-            pixel_str = str(pixel)
-            if IGNORE_BACKGROUND and pixel_str == "(0, 0, 0)":
-                continue
-
-            sub_mask = sub_masks.get(pixel_str)
-            if sub_mask is None:
-               # Create a sub-mask (one bit per pixel) and add to the dictionary
-                # Note: we add 1 pixel of padding in each direction
-                # because the contours module doesn"t handle cases
-                # where pixels bleed to the edge of the image
-                sub_masks[pixel_str] = Image.new("1", (width+2, height+2))
-
-            # Set the pixel value to 1 (default is 0), accounting for padding
-            sub_masks[pixel_str].putpixel((x+1, y+1), 1)
-    return sub_masks
+    # Note: the masks have 1 pixel of padding in each direction
+    # because the contours module doesn"t handle cases
+    # where pixels bleed to the edge of the image
+    return extract_sub_masks(mask_image, ignore_background=IGNORE_BACKGROUND)
 def create_sub_mask_annotation(sub_mask):
     # Find contours (boundary lines) around each sub-mask
     # Note: there could be multiple contours if the object
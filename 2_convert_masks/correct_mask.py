@@ -2,34 +2,84 @@
 import cv2
 import numpy as np
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from PIL import Image
-from scipy.spatial import distance
-
-def increase_hsv(mask_folder):
-    colors = np.array([(0, 255, 255), (30, 255, 255), (135, 255, 255), (15, 255, 255), (120, 255, 255), (90, 127, 255), (60, 255, 255), (0, 0, 128), (0, 0, 0)])
-    colors_nosat = np.array([(0, 255), (30, 255), (135, 255), (15, 255), (120, 255), (90, 255), (60, 255), (0, 128), (0, 0)])
-    for root, dirs, files in os.walk(mask_folder):
-        for file in files:
-            if file.endswith(".tif"):
-                print(os.path.join(root, file))
-                img = Image.open(os.path.join(root, file))
-                hsv_img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2HSV)
-
-                hsv_img[hsv_img[:, :, 2] < 5, :] = 0
-
-                # Calculate the error for each color in the list
-                errors = distance.cdist(hsv_img.reshape(-1, 3), colors, 'cityblock')
-                # Get the color with the smallest error
-                best_colors = colors[errors.argmin(axis=1)]
-                # Reshape back to the original image shape and convert to 8-bit
-                hsv_img = (best_colors.reshape(hsv_img.shape) + 0.5).astype(np.uint8)
-                
-                
-
-                # Convert back to BGR
-                img = cv2.cvtColor(hsv_img, cv2.COLOR_HSV2BGR)
-                img = np.where((img==127) | (img==254), img+1, img)
-                cv2.imwrite(os.path.join(root, file), img)
-
-increase_hsv(r"D:\datasets\50\50img\masks")
-# %%=
\ No newline at end of file
+
+# HSV (opencv 8 bit ranges, H 0-179) of the mask colors
+COLORS = np.array([(0, 255, 255), (30, 255, 255), (135, 255, 255), (15, 255, 255), (120, 255, 255), (90, 127, 255), (60, 255, 255), (0, 0, 128), (0, 0, 0)])
+# pixels darker than this are background
+MIN_VALUE = 5
+# rows converted at once, bounds the memory of the index arrays
+TILE_ROWS = 256
+
+
+@lru_cache(maxsize=1)
+def get_palette_lut():
+    """
+    Index of the nearest color (L1 distance in HSV, first color on ties)
+    for every HSV value, 180 x 256 x 256 uint8 = 11.25 MB.
+    """
+    h, s, v = np.arange(180, dtype=np.int16), np.arange(256, dtype=np.int16), np.arange(256, dtype=np.int16)
+    lut = np.zeros((180, 256, 256), dtype=np.uint8)
+    best = np.full(lut.shape, np.iinfo(np.int16).max, dtype=np.int16)
+    # the L1 distance is separable, one color at a time keeps the memory at two tables
+    for i, (ch, cs, cv) in enumerate(COLORS):
+        errors = np.abs(h - ch)[:, None, None] + np.abs(s - cs)[None, :, None] + np.abs(v - cv)[None, None, :]
+        closer = errors < best
+        lut[closer] = i
+        best[closer] = errors[closer]
+    lut[:, :, :MIN_VALUE] = lut[0, 0, 0]
+    return lut
+@lru_cache(maxsize=1)
+def get_palette_bgr():
+    # BGR of the colors, 127 and 254 are not used in the masks
+    bgr = cv2.cvtColor(COLORS.astype(np.uint8)[None], cv2.COLOR_HSV2BGR)[0]
+    return np.where((bgr == 127) | (bgr == 254), bgr + 1, bgr)
+
+def correct_image(rgb):
+    """Snap every pixel of an RGB image to the nearest mask color, returns BGR."""
+    lut = get_palette_lut()
+    palette = get_palette_bgr()
+    out = np.empty(rgb.shape[:2] + (3,), dtype=np.uint8)
+    for start in range(0, rgb.shape[0], TILE_ROWS):
+        hsv = cv2.cvtColor(np.ascontiguousarray(rgb[start:start + TILE_ROWS]), cv2.COLOR_RGB2HSV)
+        out[start:start + TILE_ROWS] = palette[lut[hsv[:, :, 0], hsv[:, :, 1], hsv[:, :, 2]]]
+    return out
+
+def correct_mask(path, dry_run=False):
+    """
+    Correct one mask file in place.
+    :return: number of pixels that changed (or would change with dry_run)
+    """
+    rgb = np.array(Image.open(path))
+    img = correct_image(rgb)
+    changed = int(np.any(img != rgb[:, :, 2::-1], axis=2).sum())
+    if not dry_run:
+        cv2.imwrite(path, img)
+    return changed
+
+def increase_hsv(mask_folder, workers=1, dry_run=False):
+    paths = [os.path.join(root, file) for root, dirs, files in os.walk(mask_folder) for file in files if file.endswith(".tif")]
+    # build the lookup table before the pool is started, forked workers share it
+    get_palette_lut()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            changes = list(pool.map(correct_mask, paths, [dry_run] * len(paths)))
+    else:
+        changes = [correct_mask(path, dry_run) for path in paths]
+    for path, changed in zip(paths, changes):
+        print("%s: %d pixels %s" % (path, changed, "would change" if dry_run else "changed"))
+    return dict(zip(paths, changes))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Snap the colors of the masks to the mask palette")
+    parser.add_argument('-masks', required=True, type=str, help='mask folder (ie: D:\\datasets\\50\\50img\\masks)')
+    parser.add_argument('-workers', default=1, type=int, help='number of processes (ie: 8)')
+    parser.add_argument('-dry_run', action='store_true', help='only report how many pixels would change')
+    args = parser.parse_args()
+
+    changes = increase_hsv(args.masks, args.workers, args.dry_run)
+    print("%d files, %d pixels %s" % (len(changes), sum(changes.values()), "would change" if args.dry_run else "changed"))
+# %%
@@ -7,9 +7,9 @@ import json
 import cv2
 import pandas as pd
 from PIL import Image
-from collections import defaultdict
 
 from utils import *
+from coco_index import CocoIndex
 
 
 # Convert INFOLKS JSON file into YOLO-format labels ----------------------------
@@ -261,19 +261,12 @@ def convert_coco_json(json_dir='../coco/annotations/', use_segments=False, cls91
     for json_file in sorted(Path(json_dir).resolve().glob('*.json')):
         fn = Path(save_dir) / 'labels' / json_file.stem.replace('instances_', '')  # folder name
         fn.mkdir()
-        with open(json_file) as f:
-            data = json.load(f)
-
-        # Create image dict
-        images = {'%g' % x['id']: x for x in data['images']}
-        # Create image-annotations dict
-        imgToAnns = defaultdict(list)
-        for ann in data['annotations']:
-            imgToAnns[ann['image_id']].append(ann)
+        # Index of the annotations per image
+        index = CocoIndex.from_file(json_file)
 
         # Write labels file
-        for img_id, anns in tqdm(imgToAnns.items(), desc=f'Annotations {json_file}'):
-            img = images['%g' % img_id]
+        for img_id, anns in tqdm(index.items(), total=len(index.group_rows), desc=f'Annotations {json_file}'):
+            img = index.image(img_id)
             h, w, f = img['height'], img['width'], img['file_name']
 
             bboxes = []
@@ -0,0 +1,96 @@
+import os
+import errno
+import shutil
+import warnings
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl to share the extents of a file on btrfs/xfs/ocfs2 (linux/fs.h)
+FICLONE = 0x40049409
+
+STRATEGIES = ['copy', 'hardlink', 'symlink', 'reflink']
+
+
+class Materializer():
+    """
+    Puts files of the source dataset into the generated dataset folders.
+    strategy:
+        copy        full copy of every file (default)
+        hardlink    new directory entry for the same file, same filesystem only
+        symlink     link to the absolute source path
+        reflink     copy on write clone, needs btrfs/xfs on linux
+    If a link can not be created (different filesystems, no permission,
+    unsupported filesystem) the file is copied instead.
+    Note: hardlinked files share their content with the source dataset,
+    writing into them in place (e.g. correct_mask) changes the source too.
+    """
+    def __init__(self, strategy='copy'):
+        if strategy not in STRATEGIES:
+            raise ValueError("strategy is one of %s" % ", ".join(STRATEGIES))
+        self.strategy = strategy
+        self.files_linked = 0
+        self.files_copied = 0
+        self.fallbacks = 0
+        self.bytes_copied = 0
+        self.bytes_avoided = 0
+
+    def file(self, src, dst, copy_function=shutil.copy):
+        """
+        Materialize a single file, dst can be a directory like in shutil.copy.
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        size = os.path.getsize(src)
+        if self.strategy != 'copy':
+            try:
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                self.__link(src, dst)
+                self.files_linked += 1
+                self.bytes_avoided += size
+                return dst
+            except OSError as e:
+                if self.fallbacks == 0:
+                    reason = "different filesystems" if e.errno == errno.EXDEV else e.strerror
+                    warnings.warn("%s of %s failed (%s), copying instead" % (self.strategy, src, reason))
+                self.fallbacks += 1
+        copy_function(src, dst)
+        self.files_copied += 1
+        self.bytes_copied += size
+        return dst
+    def tree(self, src, dst):
+        """
+        Materialize a directory tree, existing files in dst are replaced like
+        shutil.copytree(src, dst, dirs_exist_ok=True).
+        """
+        for root, dirs, files in os.walk(src):
+            dst_root = os.path.join(dst, os.path.relpath(root, src))
+            os.makedirs(dst_root, exist_ok=True)
+            for file in files:
+                self.file(os.path.join(root, file), os.path.join(dst_root, file), shutil.copy2)
+        return dst
+
+    def __link(self, src, dst):
+        if self.strategy == 'hardlink':
+            os.link(src, dst)
+        elif self.strategy == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+        elif self.strategy == 'reflink':
+            if fcntl is None:
+                raise OSError(errno.EOPNOTSUPP, "reflink is only supported on linux")
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                except OSError:
+                    fdst.close()
+                    os.remove(dst)
+                    raise
+            shutil.copymode(src, dst)
+
+    def print_stats(self):
+        print("Files (%s): %d linked, %d copied (%d fallbacks), %.1f MB written, %.1f MB avoided" % (
+            self.strategy, self.files_linked, self.files_copied, self.fallbacks,
+            self.bytes_copied / (1 << 20), self.bytes_avoided / (1 << 20)))
@@ -1,5 +1,6 @@
 #%%
 import json
+from coco_index import CocoIndex, load_json
 
 def merge_coco_files(json_files, output_file):
     merged_data = {
@@ -12,8 +13,7 @@ def merge_coco_files(json_files, output_file):
     annotation_id_offset = 0
 
     for json_file in json_files:
-        with open(json_file) as f:
-            data = json.load(f)
+        data = load_json(json_file)
 
         # Calculate new IDs for images and annotations
         for image in data['images']:
@@ -35,25 +35,17 @@ def merge_coco_files(json_files, output_file):
         json.dump(merged_data, f)
 
 def check_ids(json_file):
-    with open(json_file) as f:
-        data = json.load(f)
-
-    image_ids = {image['id'] for image in data['images']}
-    annotation_ids = [annotation['id'] for annotation in data['annotations']]
-    annotation_image_ids = [annotation['image_id'] for annotation in data['annotations']]
+    index = CocoIndex.from_file(json_file)
 
     # Check for duplicate IDs
-    unique_annotation_ids = set(annotation_ids)
-    if len(annotation_ids) != len(unique_annotation_ids):
+    if len(index.duplicate_annotation_ids()):
         print("Error: Duplicate annotation IDs found.")
 
     # Check for annotations referencing non-existing images
-    for annotation_image_id in annotation_image_ids:
-        if annotation_image_id not in image_ids:
-            print(f"Error: Annotation with image_id {annotation_image_id} has no matching image.")
+    for annotation_image_id in index.orphan_annotation_image_ids():
+        print(f"Error: Annotation with image_id {annotation_image_id} has no matching image.")
 def check_segments(json_file):
-    with open(json_file) as f:
-        data = json.load(f)
+    data = load_json(json_file)
     print(f"Checking {json_file}")
     for annotation in data['annotations']:
         if 'segmentation' in annotation:
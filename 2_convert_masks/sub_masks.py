@@ -0,0 +1,98 @@
+#%%
+import time
+import argparse
+import numpy as np
+from PIL import Image                                      # (pip install Pillow)
+
+
+def pack_rgb(mask_array):
+    # Pack the RGB channels of a (h, w, 3) uint8 array into one uint32 label per pixel
+    mask_array = mask_array[:, :, :3].astype(np.uint32)
+    return (mask_array[:, :, 0] << 16) | (mask_array[:, :, 1] << 8) | mask_array[:, :, 2]
+def label_to_color(label):
+    # Inverse of pack_rgb, returns the same key format as str(pixel) of the old implementation
+    label = int(label)
+    return str(((label >> 16) & 0xFF, (label >> 8) & 0xFF, label & 0xFF))
+def extract_sub_masks(mask_image, ignore_background=True):
+    """
+    Split a color coded mask into one boolean mask per color.
+    :param mask_image: PIL image or (h, w, 3) uint8 array
+    :param ignore_background: skip the (0, 0, 0) color
+    :return: dict of "(r, g, b)" -> bool array of shape (h+2, w+2)
+    The masks have 1 pixel of padding in each direction because the contours
+    module doesn't handle cases where pixels bleed to the edge of the image.
+    The keys are ordered by their first occurrence when scanning column by
+    column, the same order the getpixel/putpixel implementation produced.
+    """
+    labels = pack_rgb(np.asarray(mask_image))
+    h, w = labels.shape
+
+    # Scan in column major order (x outer, y inner) to keep the old key order
+    colors, first_index, inverse = np.unique(labels.T.ravel(), return_index=True, return_inverse=True)
+    inverse = inverse.reshape(w, h).T
+    order = np.argsort(first_index, kind="stable")
+    if ignore_background:
+        order = order[colors[order] != 0]
+
+    # All sub-masks in one broadcast comparison against the color index image
+    stack = np.zeros((len(order), h + 2, w + 2), dtype=bool)
+    np.equal(inverse[None, :, :], order[:, None, None], out=stack[:, 1:-1, 1:-1])
+
+    return {label_to_color(colors[k]): stack[i] for i, k in enumerate(order)}
+
+def create_sub_masks_pixelwise(mask_image, width, height, ignore_background=True):
+    # Reference implementation with getpixel/putpixel, only used for the benchmark
+    sub_masks = {}
+    for x in range(width):
+        for y in range(height):
+            pixel_str = str(mask_image.getpixel((x,y))[:3])
+            if ignore_background and pixel_str == "(0, 0, 0)":
+                continue
+            if pixel_str not in sub_masks:
+                sub_masks[pixel_str] = Image.new("1", (width+2, height+2))
+            sub_masks[pixel_str].putpixel((x+1, y+1), 1)
+    return sub_masks
+
+def synthetic_mask(width, height, n_tips=8, seed=0):
+    # Black mask with a few tip-like colored wedges, colors taken from the tip palette
+    palette = [(255, 0, 0), (255, 255, 0), (128, 0, 255), (255, 128, 0), (0, 0, 255), (128, 255, 255), (0, 255, 0), (128, 128, 128)]
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((height, width, 3), dtype=np.uint8)
+    yy, xx = np.mgrid[0:height, 0:width]
+    for i in range(n_tips):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        angle = rng.uniform(0, 2 * np.pi)
+        length = rng.uniform(0.2, 0.5) * min(width, height)
+        dx, dy = xx - x0, yy - y0
+        along = dx * np.cos(angle) + dy * np.sin(angle)
+        across = np.abs(-dx * np.sin(angle) + dy * np.cos(angle))
+        mask[(along > 0) & (along < length) & (across < along * 0.15)] = palette[i % len(palette)]
+    return Image.fromarray(mask)
+def benchmark(width, height, repeat=3, pixelwise=True):
+    mask = synthetic_mask(width, height)
+    print("Synthetic mask: %dx%d" % (width, height))
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fast = extract_sub_masks(mask)
+    t_fast = (time.perf_counter() - start) / repeat
+    print("numpy:     %8.3f s per mask, %d sub-masks" % (t_fast, len(fast)))
+
+    if pixelwise:
+        start = time.perf_counter()
+        slow = create_sub_masks_pixelwise(mask, width, height)
+        t_slow = time.perf_counter() - start
+        print("pixelwise: %8.3f s per mask, %d sub-masks" % (t_slow, len(slow)))
+        print("speedup:   %8.1fx" % (t_slow / t_fast))
+        same = list(fast.keys()) == list(slow.keys()) and all(np.array_equal(fast[k], np.array(slow[k])) for k in slow)
+        print("identical: ", same)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the numpy sub-mask extraction against the pixelwise one")
+    parser.add_argument('-width', default=1024, type=int, help='mask width (ie: 3072)')
+    parser.add_argument('-height', default=768, type=int, help='mask height (ie: 2304)')
+    parser.add_argument('-repeat', default=3, type=int, help='repetitions of the numpy path')
+    parser.add_argument('-skip_pixelwise', action='store_true', help='only time the numpy path')
+    args = parser.parse_args()
+    benchmark(args.width, args.height, args.repeat, not args.skip_pixelwise)
+# %%
@@ -5,6 +5,7 @@ import PIL.Image as Image
 from skimage import measure                                # (pip install scikit-image)
 from shapely.geometry import Polygon, MultiPolygon         # (pip install Shapely
 import time
+from sub_masks import extract_sub_masks
 #%%
 def detect_click(event,x,y,flags,param):
     global mouseX,mouseY
@@ -18,28 +19,10 @@ def detect_click(event,x,y,flags,param):
 #%%
 def create_sub_masks(mask_image, width, height):
     # Initialize a dictionary of sub-masks indexed by RGB colors
-    sub_masks = {}
-    for x in range(width):
-        for y in range(height):
-            # Get the RGB values of the pixel
-            pixel = mask_image.getpixel((x,y))[:3]
-
-            # Check to see if we have created a sub-mask...
-            pixel_str = str(pixel)
-            if True and pixel_str == "(0, 0, 0)":
-                continue
-
-            sub_mask = sub_masks.get(pixel_str)
-            if sub_mask is None:
-               # Create a sub-mask (one bit per pixel) and add to the dictionary
-                # Note: we add 1 pixel of padding in each direction
-                # because the contours module doesn"t handle cases
-                # where pixels bleed to the edge of the image
-                sub_masks[pixel_str] = Image.new("1", (width+2, height+2))
-
-            # Set the pixel value to 1 (default is 0), accounting for padding
-            sub_masks[pixel_str].putpixel((x+1, y+1), 1)
-    return sub_masks
+    # Note: the masks have 1 pixel of padding in each direction
+    # because the contours module doesn"t handle cases
+    # where pixels bleed to the edge of the image
+    return extract_sub_masks(mask_image, ignore_background=True)
 def create_sub_mask_annotation(sub_mask):
     # Find contours (boundary lines) around each sub-mask
     # Note: there could be multiple contours if the object